@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# vsphere-guest-run
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+"""Benchmark vsphere-guest-run against a local stand-in of vSphere.
+
+Reports the latency percentiles and the SOAP round trips of each
+operation, the transfer throughput and the scaling of running commands on
+many VMs at increasing concurrency. With --save the results are written
+as JSON, with --compare they are checked against such a file and the exit
+code is 1 when a p95 latency grew by more than --tolerance or an operation
+makes over 10% more SOAP or HTTP round trips, so regressions fail CI.
+
+    python tests/benchmark.py --vms 5000 --soap-latency 2
+    python tests/benchmark.py --quick --compare tests/benchmark-baseline.json
+
+tests/benchmark-baseline.json is the baseline of the tox benchmark env,
+regenerated with --quick --save when an expected change lands.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import urllib3
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakevsphere import FakeVSphere  # noqa: E402
+from vsphere_guest_run.parts import download_file_in_parts  # noqa: E402
+from vsphere_guest_run.parts import upload_file_in_parts  # noqa: E402
+from vsphere_guest_run.vsphere import CAPTURE_SINGLE  # noqa: E402
+from vsphere_guest_run.vsphere import VSphere  # noqa: E402
+
+USER = 'user'
+PASSWORD = 'password'
+MB = 1024 * 1024
+ROUND_TRIP_TOLERANCE = 1.1
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0.0
+    k = (len(values) - 1) * p / 100.0
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+
+class Benchmark(object):
+    def __init__(self, fake, vs, work_dir):
+        self.fake = fake
+        self.vs = vs
+        self.work_dir = work_dir
+        self.results = {}
+
+    def measure(self, name, fn, iterations, size=None):
+        """Run fn iterations times, record latencies and round trips."""
+        fn()
+        self.fake.reset_stats()
+        latencies = []
+        start = time.time()
+        for i in range(iterations):
+            t = time.time()
+            fn()
+            latencies.append(time.time() - t)
+        elapsed = time.time() - start
+        stats = self.fake.stats()
+        result = {
+            'iterations': iterations,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p95_ms': percentile(latencies, 95) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'soap_calls': sum(stats['soap'].values()) / float(iterations),
+            'http_requests': stats['http_requests'] / float(iterations),
+            'http_connections': stats['http_connections']
+        }
+        if size is not None:
+            result['mb_per_s'] = size * iterations / elapsed / MB
+        self.results[name] = result
+        return result
+
+    def scaling(self, command, levels, vms_per_level):
+        for level in levels:
+            vms = [
+                self.vs.get_vm_by_moid(vm['moid'])
+                for vm in self.fake.vms[:vms_per_level]
+            ]
+            self.fake.reset_stats()
+            latencies = []
+            start = time.time()
+            errors = 0
+            for vm, result, e in self.vs.execute_program_in_guests(
+                    vms,
+                    USER,
+                    PASSWORD,
+                    command,
+                    max_workers=level,
+                    capture=CAPTURE_SINGLE):
+                latencies.append(time.time() - start)
+                if e is not None or result[0] != 0:
+                    errors += 1
+            elapsed = time.time() - start
+            stats = self.fake.stats()
+            self.results['run_many_c%s' % level] = {
+                'iterations': len(vms),
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000,
+                'p99_ms': percentile(latencies, 99) * 1000,
+                'soap_calls': sum(stats['soap'].values()) / float(len(vms)),
+                'http_requests': stats['http_requests'] / float(len(vms)),
+                'http_connections': stats['http_connections'],
+                'ops_per_s': len(vms) / elapsed,
+                'errors': errors
+            }
+
+    def one_broken(self, command, count):
+        """Run command on count VMs, one at a time, the first one broken.
+
+        The guest operations of the broken VM fail, all the others must
+        still succeed.
+        """
+        vms = [
+            self.vs.get_vm_by_moid(vm['moid'])
+            for vm in self.fake.vms[:count]
+        ]
+        self.fake.broken_vms.add(vms[0]._moId)
+        start = time.time()
+        errors = []
+        try:
+            for vm, result, e in self.vs.execute_program_in_guests(
+                    vms, USER, PASSWORD, command, max_workers=1):
+                if e is not None:
+                    errors.append('%s: %s' % (vm._moId, e))
+        finally:
+            self.fake.broken_vms.discard(vms[0]._moId)
+        print('run_many_one_broken: %s VMs in %.2fs, %s errors' %
+              (len(vms), time.time() - start, len(errors)))
+        return errors
+
+    def run(self, args):
+        vs = self.vs
+        vm = vs.get_vm_by_moid(self.fake.vms[0]['moid'])
+        self.measure(
+            'run',
+            lambda: vs.execute_program_in_guest(
+                vm, USER, PASSWORD, 'echo hello', wait_for_completion=True),
+            args.iterations)
+        self.measure(
+            'run_single_capture',
+            lambda: vs.execute_program_in_guest(
+                vm,
+                USER,
+                PASSWORD,
+                'echo hello',
+                wait_for_completion=True,
+                capture=CAPTURE_SINGLE),
+            args.iterations)
+        self.measure(
+            'run_no_output',
+            lambda: vs.execute_program_in_guest(
+                vm,
+                USER,
+                PASSWORD,
+                'true',
+                wait_for_completion=True,
+                get_output=False),
+            args.iterations)
+        self.measure(
+            'run_batch_10',
+            lambda: vs.execute_commands_in_guest(vm, USER, PASSWORD,
+                                                 ['echo hello'] * 10),
+            args.iterations)
+
+        size = args.size * MB
+        source = os.path.join(self.work_dir, 'source')
+        with open(source, 'wb') as f:
+            for i in range(args.size):
+                f.write(os.urandom(MB))
+        target = os.path.join(self.work_dir, 'target')
+        self.measure(
+            'upload',
+            lambda: vs.upload_local_file_to_guest(
+                vm, USER, PASSWORD, source, target, overwrite=True),
+            args.transfers,
+            size=size)
+        local = os.path.join(self.work_dir, 'local')
+        self.measure(
+            'download',
+            lambda: vs.download_file_to_local(vm, USER, PASSWORD, target,
+                                              local),
+            args.transfers,
+            size=size)
+        part_size = max(1, size // args.parts)
+        self.measure(
+            'upload_parts',
+            lambda: upload_file_in_parts(
+                vs,
+                vm,
+                USER,
+                PASSWORD,
+                source,
+                target,
+                part_size=part_size,
+                max_workers=args.parts,
+                overwrite=True),
+            args.transfers,
+            size=size)
+        self.measure(
+            'download_parts',
+            lambda: download_file_in_parts(
+                vs,
+                vm,
+                USER,
+                PASSWORD,
+                target,
+                local,
+                part_size=part_size,
+                max_workers=args.parts),
+            args.transfers,
+            size=size)
+
+        listing = os.path.join(self.work_dir, 'listing')
+        os.mkdir(listing)
+        for i in range(args.files):
+            open(os.path.join(listing, 'f%s' % i), 'w').close()
+        self.measure(
+            'list_files',
+            lambda: list(vs.iter_files_in_guest(vm, USER, PASSWORD, listing)),
+            args.iterations)
+
+        self.measure('list_vms', lambda: vs.list_vms(), args.list_iterations)
+        moids = [vm['moid'] for vm in self.fake.vms[:100]]
+        self.measure('vm_info_100', lambda: vs.vms_to_dicts(moids),
+                     args.iterations)
+
+        self.scaling('sleep %s' % (args.command_ms / 1000.0),
+                     args.concurrency, args.scaling_vms)
+        self.broken_errors = self.one_broken('true', args.broken_vms)
+
+
+def print_results(results):
+    columns = [
+        'p50_ms', 'p95_ms', 'p99_ms', 'soap_calls', 'http_requests',
+        'mb_per_s', 'ops_per_s'
+    ]
+    print('%-20s' % 'operation' + ''.join('%14s' % c for c in columns))
+    for name, result in results.items():
+        row = '%-20s' % name
+        for column in columns:
+            value = result.get(column)
+            row += '%14s' % ('' if value is None else '%.2f' % value)
+        print(row)
+
+
+def compare(results, baseline, tolerance):
+    """Return the regressions of results over a baseline."""
+    regressions = []
+    for name, base in baseline.items():
+        result = results.get(name)
+        if result is None:
+            continue
+        if result['p95_ms'] > base['p95_ms'] * tolerance:
+            regressions.append('%s: p95 %.2fms > %.2fms' %
+                               (name, result['p95_ms'], base['p95_ms']))
+        for key in ('soap_calls', 'http_requests'):
+            if result[key] > base[key] * ROUND_TRIP_TOLERANCE + 0.01:
+                regressions.append('%s: %s %.2f > %.2f' %
+                                   (name, key, result[key], base[key]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--vms', type=int, default=2000,
+                        help='inventory size')
+    parser.add_argument('--soap-latency', type=float, default=1.0,
+                        help='latency of each SOAP call in ms')
+    parser.add_argument('--http-latency', type=float, default=1.0,
+                        help='latency of each HTTP request in ms')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--list-iterations', type=int, default=10)
+    parser.add_argument('--transfers', type=int, default=5)
+    parser.add_argument('--size', type=int, default=32,
+                        help='transfer size in MB')
+    parser.add_argument('--parts', type=int, default=4,
+                        help='number of parts of the parallel transfers')
+    parser.add_argument('--http-mbps', type=float, default=0,
+                        help='throughput limit of each transfer in MB/s, '
+                        '0 for none')
+    parser.add_argument('--files', type=int, default=2000,
+                        help='number of files in the listed directory')
+    parser.add_argument('--concurrency', default='1,4,16,64',
+                        help='concurrency levels of run_many')
+    parser.add_argument('--scaling-vms', type=int, default=64,
+                        help='number of VMs run_many runs on')
+    parser.add_argument('--broken-vms', type=int, default=20,
+                        help='number of VMs of the run with a broken VM')
+    parser.add_argument('--command-ms', type=int, default=200,
+                        help='duration of the run_many command in ms')
+    parser.add_argument('--no-tls', action='store_true',
+                        help='serve file transfers over plain HTTP')
+    parser.add_argument('--quick', action='store_true',
+                        help='small sizes, for CI')
+    parser.add_argument('--save', help='write the results as JSON')
+    parser.add_argument('--compare', help='JSON results to compare with')
+    parser.add_argument('--tolerance', type=float, default=2.0,
+                        help='allowed p95 growth factor with --compare')
+    args = parser.parse_args()
+    if args.quick:
+        args.vms = min(args.vms, 500)
+        args.iterations = min(args.iterations, 20)
+        args.list_iterations = min(args.list_iterations, 5)
+        args.size = min(args.size, 4)
+        args.files = min(args.files, 500)
+        args.scaling_vms = min(args.scaling_vms, 16)
+        args.concurrency = '1,4,16'
+    args.concurrency = [int(c) for c in args.concurrency.split(',')]
+
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    fake = FakeVSphere(
+        vms=args.vms,
+        soap_latency=args.soap_latency / 1000.0,
+        http_latency=args.http_latency / 1000.0,
+        tls=not args.no_tls,
+        http_bandwidth=args.http_mbps * MB)
+    fake.start()
+    vs = VSphere('localhost', USER, PASSWORD, verify=False)
+    fake.attach(vs)
+    work_dir = tempfile.mkdtemp(prefix='vgr-bench-%s-' % uuid.uuid1())
+    try:
+        benchmark = Benchmark(fake, vs, work_dir)
+        benchmark.run(args)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+        fake.stop()
+    print_results(benchmark.results)
+    failures = []
+    if len(benchmark.broken_errors) != 1:
+        failures.append('one broken VM made %s VMs fail: %s' %
+                        (len(benchmark.broken_errors),
+                         '; '.join(benchmark.broken_errors[:3])))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(benchmark.results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(benchmark.results, json.load(f),
+                                  args.tolerance)
+        failures += regressions
+    for failure in failures:
+        print('regression: %s' % failure)
+    if len(failures) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
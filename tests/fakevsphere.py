@@ -0,0 +1,560 @@
+# vsphere-guest-run
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+"""Local stand-in for the parts of vSphere used by vsphere-guest-run.
+
+FakeVSphere emulates the service content (ContainerView, PropertyCollector
+with WaitForUpdatesEx, and the guest process and file managers) and runs
+an HTTPS file-transfer endpoint like the one of ESXi. Every managed
+method call counts as one SOAP round trip and sleeps soap_latency
+seconds, every HTTP request sleeps http_latency seconds. http_bandwidth
+limits the bytes per second of each transfer, like the single connection
+throughput to an ESXi host, and ranges=False makes GET ignore Range
+headers. The guest is the local machine: programs are run with /bin/sh and
+guest paths are local paths.
+
+    fake = FakeVSphere(vms=1000, soap_latency=0.002)
+    fake.start()
+    vs = VSphere('localhost', 'user', 'password', verify=False)
+    fake.attach(vs)
+"""
+
+import datetime
+import http.server
+import itertools
+import os
+import shutil
+import socketserver
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+
+from pyVmomi import vim
+from pyVmomi import vmodl
+
+FILE_CHUNK_SIZE = 64 * 1024
+
+
+class FakeContainerView(vim.view.ContainerView):
+    def DestroyView(self):
+        self._fake.soap('DestroyView')
+        with self._fake.lock:
+            self._fake.views.discard(self._moId)
+
+
+class FakeVSphere(object):
+    def __init__(self,
+                 vms=100,
+                 soap_latency=0.0,
+                 http_latency=0.0,
+                 tls=True,
+                 http_bandwidth=None,
+                 ranges=True):
+        self.soap_latency = soap_latency
+        self.http_latency = http_latency
+        self.http_bandwidth = http_bandwidth
+        self.ranges = ranges
+        self.tls = tls
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.http_requests = 0
+        self.http_connections = 0
+        self.views = set()
+        self.processes = {}
+        self.transfers = {}
+        self.retrievals = {}
+        self.broken_vms = set()
+        self.changes = []
+        self.changed = threading.Condition(self.lock)
+        self.ids = itertools.count(1)
+        self.vms = [self._vm(i) for i in range(1, vms + 1)]
+        self._vms_by_moid = {vm['moid']: vm for vm in self.vms}
+        self._server = None
+        self._cert_dir = None
+        self.process_manager = _Namespace(
+            StartProgramInGuest=self._soap(self.start_program),
+            ListProcessesInGuest=self._soap(self.list_processes))
+        self.file_manager = _Namespace(
+            InitiateFileTransferToGuest=self._soap(self.transfer_to_guest),
+            InitiateFileTransferFromGuest=self._soap(self.transfer_from_guest),
+            ListFilesInGuest=self._soap(self.list_files),
+            MakeDirectoryInGuest=self._soap(self.make_directory),
+            MoveFileInGuest=self._soap(self.move_file),
+            DeleteFileInGuest=self._soap(self.delete_file),
+            DeleteDirectoryInGuest=self._soap(self.delete_directory))
+        self.property_collector = _Namespace(
+            RetrievePropertiesEx=self._soap(self.retrieve_properties),
+            ContinueRetrievePropertiesEx=self._soap(
+                self.continue_retrieve_properties),
+            CancelRetrievePropertiesEx=self._soap(
+                self.cancel_retrieve_properties),
+            CreatePropertyCollector=self._soap(
+                self.create_property_collector))
+        self.content = _Namespace(
+            rootFolder=vim.Folder('group-d1'),
+            viewManager=_Namespace(
+                CreateContainerView=self._soap(self.create_container_view)),
+            propertyCollector=self.property_collector,
+            guestOperationsManager=_Namespace(
+                processManager=self.process_manager,
+                fileManager=self.file_manager),
+            sessionManager=_Namespace(
+                currentSession=_Namespace(userName='user'),
+                Logout=self._soap(lambda: None, name='Logout')))
+        self.service_instance = _Namespace(
+            RetrieveContent=self._soap(lambda: self.content,
+                                       name='RetrieveContent'),
+            content=self.content,
+            _stub=None)
+
+    def _vm(self, i):
+        return {
+            'moid': 'vm-%s' % i,
+            'name': 'vm-%05d' % i,
+            'config.uuid': str(uuid.UUID(int=i)),
+            'config.hardware.numCPU': 2,
+            'config.hardware.memoryMB': 4096,
+            'config.guestFullName': 'Other 3.x or later Linux (64-bit)',
+            'config.guestId': 'other3xLinux64Guest',
+            'config.version': 'vmx-13',
+            'guest.guestState': 'running',
+            'guest.toolsRunningStatus': 'guestToolsRunning',
+            'runtime.powerState': 'poweredOn'
+        }
+
+    def _soap(self, method, name=None):
+        name = name or method.__name__
+
+        def call(*args, **kwargs):
+            self.soap(name)
+            return method(*args, **kwargs)
+
+        call.__name__ = name
+        return call
+
+    def soap(self, name):
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if self.soap_latency > 0:
+            time.sleep(self.soap_latency)
+
+    def soap_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def stats(self):
+        with self.lock:
+            return {
+                'soap': dict(self.calls),
+                'http_requests': self.http_requests,
+                'http_connections': self.http_connections
+            }
+
+    def reset_stats(self):
+        with self.lock:
+            self.calls = {}
+            self.http_requests = 0
+            self.http_connections = 0
+
+    def start(self):
+        """Start the file-transfer endpoint on a free localhost port."""
+        fake = self
+
+        class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+            daemon_threads = True
+            request_queue_size = 128
+
+        self._server = Server(('127.0.0.1', 0), _make_handler(fake))
+        if self.tls:
+            self._cert_dir = tempfile.mkdtemp(prefix='vgr-bench-')
+            cert, key = _self_signed_cert(self._cert_dir)
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(cert, key)
+            self._server.socket = context.wrap_socket(
+                self._server.socket, server_side=True)
+        thread = threading.Thread(
+            target=self._server.serve_forever, name='vgr-fake-http')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._cert_dir is not None:
+            shutil.rmtree(self._cert_dir, ignore_errors=True)
+            self._cert_dir = None
+        for process in list(self.processes.values()):
+            if process.poll() is None:
+                process.kill()
+
+    def attach(self, vs):
+        """Make a VSphere instance use this fake instead of a vCenter."""
+        vs.service_instance = self.service_instance
+        vs.invalidate_cache()
+
+    def _url(self, transfer):
+        key = '/guestFile?id=%s' % next(self.ids)
+        with self.lock:
+            self.transfers[key] = transfer
+        return '%s://127.0.0.1:%s%s' % ('https' if self.tls else 'http',
+                                        self._server.server_address[1], key)
+
+    def start_program(self, vm, creds, spec):
+        if vm._moId in self.broken_vms:
+            raise vim.fault.GuestOperationsUnavailable()
+        command = spec.programPath
+        if spec.arguments:
+            command = '%s %s' % (command, spec.arguments)
+        process = subprocess.Popen(
+            ['/bin/sh', '-c', command],
+            cwd=spec.workingDirectory or None,
+            stdin=subprocess.DEVNULL)
+        with self.lock:
+            self.processes[process.pid] = process
+        return process.pid
+
+    def list_processes(self, vm, creds, pids=None):
+        result = []
+        with self.lock:
+            processes = dict(self.processes)
+        for pid in pids or processes:
+            process = processes.get(pid)
+            if process is None:
+                continue
+            result.append(
+                vim.vm.guest.ProcessManager.ProcessInfo(
+                    pid=pid,
+                    name='sh',
+                    owner=creds.username,
+                    cmdLine=' '.join(process.args),
+                    exitCode=process.poll()))
+        return result
+
+    def transfer_to_guest(self, vm, creds, path, file_attribute, size,
+                          overwrite):
+        if os.path.exists(path) and not overwrite:
+            raise vim.fault.FileAlreadyExists(file=path)
+        if not os.path.isdir(os.path.dirname(path) or '.'):
+            raise vim.fault.FileNotFound(file=path)
+        return self._url((path, file_attribute))
+
+    def transfer_from_guest(self, vm, creds, path):
+        if not os.path.isfile(path):
+            raise vim.fault.FileNotFound(file=path)
+        return vim.vm.guest.FileManager.FileTransferInformation(
+            size=os.path.getsize(path),
+            url=self._url(path),
+            attributes=vim.vm.guest.FileManager.FileAttributes())
+
+    def list_files(self, vm, creds, path, index=0, maxResults=None,
+                   matchPattern=None):
+        if not os.path.isdir(path):
+            raise vim.fault.FileNotFound(file=path)
+        names = ['.', '..'] + sorted(os.listdir(path))
+        end = len(names) if maxResults is None else index + maxResults
+        files = []
+        for name in names[index:end]:
+            st = os.lstat(os.path.join(path, name))
+            if os.path.isdir(os.path.join(path, name)):
+                kind = 'directory'
+            elif os.path.islink(os.path.join(path, name)):
+                kind = 'symlink'
+            else:
+                kind = 'file'
+            mtime = datetime.datetime.fromtimestamp(st.st_mtime,
+                                                    datetime.timezone.utc)
+            files.append(
+                vim.vm.guest.FileManager.FileInfo(
+                    path=name,
+                    type=kind,
+                    size=st.st_size,
+                    attributes=vim.vm.guest.FileManager.FileAttributes(
+                        modificationTime=mtime)))
+        return vim.vm.guest.FileManager.ListFileInfo(
+            files=files, remaining=max(0, len(names) - end))
+
+    def make_directory(self, vm, creds, path, createParentDirectories):
+        if createParentDirectories:
+            os.makedirs(path, exist_ok=True)
+        else:
+            os.mkdir(path)
+
+    def move_file(self, vm, creds, src, dst, overwrite):
+        if os.path.exists(dst) and not overwrite:
+            raise vim.fault.FileAlreadyExists(file=dst)
+        os.replace(src, dst)
+
+    def delete_file(self, vm, creds, path):
+        if not os.path.isfile(path):
+            raise vim.fault.FileNotFound(file=path)
+        os.remove(path)
+
+    def delete_directory(self, vm, creds, path, recursive):
+        if recursive:
+            shutil.rmtree(path)
+        else:
+            os.rmdir(path)
+
+    def create_container_view(self, container, type, recursive):
+        view = FakeContainerView('session[fake]view-%s' % next(self.ids))
+        view._fake = self
+        with self.lock:
+            self.views.add(view._moId)
+        return view
+
+    def retrieve_properties(self, specSet, options):
+        objects = []
+        for filter_spec in specSet:
+            path_set = None
+            for property_spec in filter_spec.propSet:
+                if not property_spec.all:
+                    path_set = list(property_spec.pathSet or [])
+            for object_spec in filter_spec.objectSet:
+                if isinstance(object_spec.obj, vim.view.ContainerView):
+                    vms = self.vms
+                else:
+                    vm = self._vms_by_moid.get(object_spec.obj._moId)
+                    vms = [] if vm is None else [vm]
+                for vm in vms:
+                    objects.append(self._object_content(vm, path_set))
+        token = str(next(self.ids))
+        with self.lock:
+            self.retrievals[token] = (objects, options.maxObjects)
+        return self.continue_retrieve_properties(token, count=False)
+
+    def continue_retrieve_properties(self, token, count=True):
+        with self.lock:
+            objects, page_size = self.retrievals.pop(token)
+        page_size = page_size or len(objects)
+        page, rest = objects[:page_size], objects[page_size:]
+        next_token = None
+        if len(rest) > 0:
+            next_token = str(next(self.ids))
+            with self.lock:
+                self.retrievals[next_token] = (rest, page_size)
+        return vmodl.query.PropertyCollector.RetrieveResult(
+            objects=page, token=next_token)
+
+    def cancel_retrieve_properties(self, token):
+        with self.lock:
+            self.retrievals.pop(token, None)
+
+    def set_vm_property(self, moid, name, value):
+        """Change a property of a VM, as reported by WaitForUpdatesEx."""
+        with self.changed:
+            self._vms_by_moid[moid][name] = value
+            self.changes.append((moid, name))
+            self.changed.notify_all()
+
+    def remove_vm(self, moid):
+        with self.changed:
+            vm = self._vms_by_moid.pop(moid)
+            self.vms.remove(vm)
+            self.changes.append((moid, None))
+            self.changed.notify_all()
+
+    def create_property_collector(self):
+        filters = []
+
+        def create_filter(spec, partialUpdates):
+            filters.append(spec)
+
+        def wait_for_updates(version, options):
+            return self.wait_for_updates(filters, version, options)
+
+        return _Namespace(
+            CreateFilter=self._soap(create_filter, name='CreateFilter'),
+            WaitForUpdatesEx=self._soap(
+                wait_for_updates, name='WaitForUpdatesEx'),
+            Destroy=self._soap(lambda: None, name='Destroy'))
+
+    def wait_for_updates(self, filters, version, options):
+        start = 0 if not version else int(version)
+        timeout = options.maxWaitSeconds
+        with self.changed:
+            if version and len(self.changes) == start and timeout != 0:
+                self.changed.wait(timeout)
+            changes = self.changes[start:]
+            end = len(self.changes)
+            vms = dict(self._vms_by_moid)
+        if version and len(changes) == 0:
+            return None
+        filter_updates = []
+        for spec in filters:
+            path_set = spec.propSet[0].pathSet
+            moids = []
+            view = False
+            for object_spec in spec.objectSet:
+                if isinstance(object_spec.obj, vim.view.ContainerView):
+                    moids.extend(vms)
+                    view = True
+                else:
+                    moids.append(object_spec.obj._moId)
+            updates = []
+            if not version:
+                for moid in moids:
+                    if moid in vms:
+                        updates.append(
+                            self._object_update('enter', vms[moid], path_set))
+            else:
+                changed = {}
+                for moid, name in changes:
+                    if moid in moids or (view and name is None):
+                        changed.setdefault(moid, set()).add(name)
+                for moid, names in changed.items():
+                    if moid not in vms:
+                        updates.append(
+                            vmodl.query.PropertyCollector.ObjectUpdate(
+                                kind='leave', obj=vim.VirtualMachine(moid)))
+                    elif names & set(path_set):
+                        updates.append(
+                            self._object_update(
+                                'modify', vms[moid], names & set(path_set)))
+            filter_updates.append(
+                vmodl.query.PropertyCollector.FilterUpdate(
+                    objectSet=updates))
+        return vmodl.query.PropertyCollector.UpdateSet(
+            version=str(end), filterSet=filter_updates, truncated=False)
+
+    def _object_update(self, kind, vm, path_set):
+        return vmodl.query.PropertyCollector.ObjectUpdate(
+            kind=kind,
+            obj=vim.VirtualMachine(vm['moid']),
+            changeSet=[
+                vmodl.query.PropertyCollector.Change(
+                    name=path, op='assign', val=vm.get(path))
+                for path in path_set if vm.get(path) is not None
+            ])
+
+    def _object_content(self, vm, path_set):
+        if path_set is None:
+            path_set = [key for key in vm if key != 'moid']
+        props = [
+            vmodl.DynamicProperty(name=path, val=vm[path])
+            for path in path_set if vm.get(path) is not None
+        ]
+        return vmodl.query.PropertyCollector.ObjectContent(
+            obj=vim.VirtualMachine(vm['moid']), propSet=props)
+
+
+class _Namespace(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def _make_handler(fake):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # the headers and the body are separate writes, without TCP_NODELAY
+        # every non-empty response waits for a delayed ACK
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            http.server.BaseHTTPRequestHandler.setup(self)
+            with fake.lock:
+                fake.http_connections += 1
+
+        def _transfer(self):
+            with fake.lock:
+                fake.http_requests += 1
+                transfer = fake.transfers.pop(self.path, None)
+            if fake.http_latency > 0:
+                time.sleep(fake.http_latency)
+            if transfer is None:
+                self.send_error(404)
+            return transfer
+
+        def _throttle(self, start, sent):
+            if fake.http_bandwidth:
+                delay = start + sent / float(fake.http_bandwidth) - \
+                    time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+        def do_GET(self):
+            path = self._transfer()
+            if path is None:
+                return
+            size = os.path.getsize(path)
+            start = 0
+            end = size
+            byte_range = self.headers.get('Range')
+            if fake.ranges and byte_range is not None and \
+                    byte_range.startswith('bytes='):
+                first, _, last = byte_range[6:].partition('-')
+                start = min(size, int(first))
+                if last:
+                    end = min(size, int(last) + 1)
+                self.send_response(206)
+                self.send_header('Content-Range',
+                                 'bytes %s-%s/%s' % (start, end - 1, size))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(end - start))
+            self.end_headers()
+            with open(path, 'rb') as f:
+                f.seek(start)
+                remaining = end - start
+                began = time.time()
+                while remaining > 0:
+                    chunk = f.read(min(remaining, FILE_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    try:
+                        self.wfile.write(chunk)
+                    except (ConnectionError, ssl.SSLError):
+                        # the client may close a response it does not need
+                        self.close_connection = True
+                        return
+                    remaining -= len(chunk)
+                    self._throttle(began, end - start - remaining)
+
+        def do_PUT(self):
+            transfer = self._transfer()
+            if transfer is None:
+                return
+            path, file_attribute = transfer
+            length = int(self.headers.get('Content-Length', 0))
+            remaining = length
+            began = time.time()
+            with open(path, 'wb') as f:
+                while remaining > 0:
+                    chunk = self.rfile.read(min(remaining, FILE_CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    remaining -= len(chunk)
+                    self._throttle(began, length - remaining)
+            permissions = getattr(file_attribute, 'permissions', None)
+            if permissions:
+                os.chmod(path, permissions)
+            mtime = getattr(file_attribute, 'modificationTime', None)
+            if mtime is not None:
+                os.utime(path, (mtime.timestamp(), mtime.timestamp()))
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def _self_signed_cert(directory):
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.check_call(
+        [
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+            '-subj', '/CN=localhost', '-days', '1', '-keyout', key, '-out',
+            cert
+        ],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    return cert, key
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# vsphere-guest-run
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+"""Check that the vgr CLI starts within a time budget.
+
+Runs 'vgr --help' and 'vgr version' in fresh interpreters and exits with
+1 when the median time they take on top of a bare interpreter start is
+over --budget milliseconds, or when they import one of the modules that
+only the commands talking to vSphere need.
+
+    python tests/startup.py --budget 200
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ['pyVmomi', 'pyVim', 'requests', 'pygments', 'pkg_resources']
+COMMANDS = [['--help'], ['version']]
+PROBE = '''
+import sys
+from vsphere_guest_run.vgr import vgr
+try:
+    vgr(sys.argv[1:])
+except SystemExit as e:
+    if e.code not in (None, 0):
+        raise
+sys.stderr.write('\\nVGR-MODULES %s\\n' % ' '.join(sorted(sys.modules)))
+'''
+
+
+def elapsed(args, env):
+    start = time.time()
+    subprocess.run(
+        args,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        check=False)
+    return time.time() - start
+
+
+def median_time(args, env, runs):
+    return statistics.median(elapsed(args, env) for i in range(runs))
+
+
+def imported_modules(command, env):
+    result = subprocess.run(
+        [sys.executable, '-c', PROBE] + command,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=False)
+    for line in result.stderr.decode().splitlines():
+        if line.startswith('VGR-MODULES '):
+            return set(line.split()[1:])
+    raise Exception('vgr %s failed:\n%s' %
+                    (' '.join(command), result.stderr.decode()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--budget',
+        type=float,
+        default=200,
+        help='max startup time over a bare interpreter, in ms')
+    parser.add_argument('--runs', type=int, default=7)
+    args = parser.parse_args()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [p for p in [env.get('PYTHONPATH')] if p])
+    env['VGR_URL'] = 'user:password@localhost'
+    failures = []
+    baseline = median_time([sys.executable, '-c', 'pass'], env, args.runs)
+    print('python: %.1fms' % (baseline * 1000))
+    for command in COMMANDS:
+        name = 'vgr %s' % ' '.join(command)
+        overhead = median_time(
+            [sys.executable, '-m', 'vsphere_guest_run.vgr'] + command, env,
+            args.runs) - baseline
+        print('%s: +%.1fms' % (name, overhead * 1000))
+        if overhead * 1000 > args.budget:
+            failures.append('%s takes %.1fms, over the %.0fms budget' %
+                            (name, overhead * 1000, args.budget))
+        heavy = [
+            module for module in HEAVY_MODULES
+            if module in imported_modules(command, env)
+        ]
+        if len(heavy) > 0:
+            failures.append('%s imports %s' % (name, json.dumps(heavy)))
+    for failure in failures:
+        print('FAIL: %s' % failure)
+    if len(failures) > 0:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+# vsphere-guest-run
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+"""Tests of the name checks of the archive transfers."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from fakevsphere import FakeVSphere
+from vsphere_guest_run import archive
+from vsphere_guest_run.vsphere import VSphere
+
+
+class VerifyTest(unittest.TestCase):
+    def test_same_names(self):
+        archive._verify(set(), set())
+
+    def test_missing(self):
+        with self.assertRaisesRegex(
+                Exception, r'^archive verification failed, 2 files '
+                r'missing: a, b/c$'):
+            archive._verify({'b/c', 'a'}, set())
+
+    def test_unexpected(self):
+        with self.assertRaisesRegex(
+                Exception, r'^archive verification failed, 1 files '
+                r'unexpected: x$'):
+            archive._verify(set(), {'x'})
+
+    def test_missing_and_unexpected(self):
+        with self.assertRaisesRegex(
+                Exception, r'1 files missing: a; 1 files unexpected: b$'):
+            archive._verify({'a'}, {'b'})
+
+    def test_names_shown(self):
+        names = set('f%02d' % n for n in range(20))
+        with self.assertRaises(Exception) as cm:
+            archive._verify(names, set())
+        self.assertIn('20 files missing: f00, f01, f02, f03, f04',
+                      str(cm.exception))
+        self.assertNotIn('f05', str(cm.exception))
+
+    def test_member_names(self):
+        self.assertEqual(
+            archive._member_names(b'./\n./a\n./d/\n./d/b\nc\n\n'),
+            {'a', 'd', 'd/b', 'c'})
+
+
+class ArchiveTransferTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeVSphere(vms=1, tls=False)
+        self.fake.start()
+        self.addCleanup(self.fake.stop)
+        self.vs = VSphere('localhost', 'user', 'password', verify=False)
+        self.fake.attach(self.vs)
+        self.vm = self.vs.get_vm_by_moid('vm-1')
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.source = os.path.join(self.dir, 'source')
+        os.makedirs(os.path.join(self.source, 'd'))
+        for name in ('a', os.path.join('d', 'b')):
+            with open(os.path.join(self.source, name), 'w') as f:
+                f.write(name)
+        self.target = os.path.join(self.dir, 'target')
+
+    def tamper(self, fn):
+        """Make fn(stdout) rewrite the tar output of the guest."""
+        execute = self.vs.execute_program_in_guest
+
+        def execute_program_in_guest(*args, **kwargs):
+            result = execute(*args, **kwargs)
+            return [result[0], fn(result[1])] + result[2:]
+
+        self.vs.execute_program_in_guest = execute_program_in_guest
+
+    def guest_archives(self):
+        return [
+            name for name in os.listdir('/tmp')
+            if name.startswith(tuple('0123456789abcdef')) and
+            '.tar' in name
+        ]
+
+    def upload(self):
+        return archive.upload_archive_to_guest(
+            self.vs, self.vm, 'user', 'password', self.source, self.target)
+
+    def download(self):
+        return archive.download_archive_from_guest(
+            self.vs, self.vm, 'user', 'password', self.source, self.target)
+
+    def test_upload(self):
+        before = self.guest_archives()
+        result = self.upload()
+        self.assertEqual((result.files, result.size), (2, 4))
+        with open(os.path.join(self.target, 'd', 'b')) as f:
+            self.assertEqual(f.read(), os.path.join('d', 'b'))
+        self.assertEqual(self.guest_archives(), before)
+
+    def test_upload_unexpected(self):
+        self.tamper(lambda out: out + b'./ghost\n')
+        with self.assertRaisesRegex(Exception, '1 files unexpected: ghost'):
+            self.upload()
+
+    def test_upload_missing(self):
+        self.tamper(lambda out: out.replace(b'./d/b\n', b''))
+        with self.assertRaisesRegex(Exception, '1 files missing: d/b'):
+            self.upload()
+
+    def test_download(self):
+        result = self.download()
+        self.assertEqual((result.files, result.size), (2, 4))
+        with open(os.path.join(self.target, 'a')) as f:
+            self.assertEqual(f.read(), 'a')
+
+    def test_download_missing(self):
+        self.tamper(lambda out: out + b'./ghost\n')
+        with self.assertRaisesRegex(Exception, '1 files missing: ghost'):
+            self.download()
+
+    def test_download_unexpected(self):
+        self.tamper(lambda out: out.replace(b'./a\n', b''))
+        with self.assertRaisesRegex(Exception, '1 files unexpected: a'):
+            self.download()
+
+    def test_download_skips_symlinks(self):
+        os.symlink('a', os.path.join(self.source, 'link'))
+        result = self.download()
+        self.assertEqual(result.files, 2)
+        self.assertFalse(os.path.lexists(os.path.join(self.target, 'link')))
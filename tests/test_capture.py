@@ -0,0 +1,183 @@
+# vsphere-guest-run
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+"""Tests of the CAPTURE_SINGLE and GuestBatch capture file framing."""
+
+import io
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from vsphere_guest_run.vsphere import CAPTURE_SCRIPT
+from vsphere_guest_run.vsphere import GuestBatch
+from vsphere_guest_run.vsphere import read_batch
+from vsphere_guest_run.vsphere import read_capture
+
+
+def _split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+class ReadCaptureTest(unittest.TestCase):
+    def read(self, chunks):
+        stdout = io.BytesIO()
+        stderr = io.BytesIO()
+        result = read_capture(chunks, stdout, stderr)
+        return result, stdout.getvalue(), stderr.getvalue()
+
+    def test_single_chunk(self):
+        self.assertEqual(
+            self.read([b'VGR-CAPTURE 3 6 4\nhello\noops']),
+            ((3, 6, 4), b'hello\n', b'oops'))
+
+    def test_any_chunk_boundaries(self):
+        data = b'VGR-CAPTURE 0 10 5\n0123456789abcde'
+        for size in range(1, len(data) + 1):
+            self.assertEqual(
+                self.read(_split(data, size)),
+                ((0, 10, 5), b'0123456789', b'abcde'), size)
+
+    def test_empty_chunks(self):
+        self.assertEqual(
+            self.read([b'', b'VGR-CAPTURE 1 ', b'', b'2 1\n', b'', b'ab',
+                       b'', b'c']), ((1, 2, 1), b'ab', b'c'))
+
+    def test_empty_output(self):
+        self.assertEqual(
+            self.read([b'VGR-CAPTURE 0 0 0\n']), ((0, 0, 0), b'', b''))
+
+    def test_output_with_header_like_lines(self):
+        body = b'VGR-CAPTURE 9 9 9\n\n'
+        self.assertEqual(
+            self.read([b'VGR-CAPTURE 0 %d 0\n' % len(body) + body]),
+            ((0, len(body), 0), body, b''))
+
+    def test_empty_file(self):
+        with self.assertRaisesRegex(Exception, 'invalid capture file header'):
+            self.read([])
+
+    def test_truncated_header(self):
+        for data in (b'VGR-CAP', b'VGR-CAPTURE 0', b'VGR-CAPTURE 0 5'):
+            with self.assertRaisesRegex(Exception,
+                                        'invalid capture file header'):
+                self.read([data])
+
+    def test_header_without_newline(self):
+        with self.assertRaisesRegex(Exception, 'truncated capture file'):
+            self.read([b'VGR-CAPTURE 0 5 0'])
+
+    def test_invalid_header(self):
+        for data in (b'VGR-BATCH 0 1 0\nx', b'VGR-CAPTURE 0 1 0 0\nx',
+                     b'hello\n'):
+            with self.assertRaisesRegex(Exception,
+                                        'invalid capture file header'):
+                self.read([data])
+
+    def test_truncated_output(self):
+        for data in (b'VGR-CAPTURE 0 5 0\nabc', b'VGR-CAPTURE 0 2 3\nab',
+                     b'VGR-CAPTURE 0 2 3\nabcd'):
+            with self.assertRaisesRegex(Exception, 'truncated capture file'):
+                self.read(_split(data, 4))
+
+    def test_capture_script(self):
+        directory = tempfile.mkdtemp()
+        try:
+            files = {}
+            for name in ('out', 'err', 'cap'):
+                files[name] = os.path.join(directory, name)
+            extra = os.path.join(directory, 'extra')
+            open(extra, 'w').close()
+            files['command'] = ("printf 'a\\nb'; printf '\\000\\377' >&2; "
+                                "exit 7")
+            files['cleanup'] = ' %s' % extra
+            rc = subprocess.call(['/bin/sh', '-c', CAPTURE_SCRIPT % files])
+            self.assertEqual(rc, 7)
+            self.assertEqual(sorted(os.listdir(directory)), ['cap'])
+            with open(files['cap'], 'rb') as f:
+                self.assertEqual(
+                    self.read(_split(f.read(), 3)),
+                    ((7, 3, 2), b'a\nb', b'\x00\xff'))
+        finally:
+            shutil.rmtree(directory)
+
+
+class ReadBatchTest(unittest.TestCase):
+    def test_frames(self):
+        data = (b'VGR-BATCH 0 0 1000000000 1500000000 3 0\nhi\n'
+                b'VGR-BATCH 1 2 2000000000 2000000000 0 4\nerr\n')
+        self.assertEqual(
+            read_batch(data, ['echo hi', 'false']), [{
+                'command': 'echo hi',
+                'exit_code': 0,
+                'duration': 0.5,
+                'stdout': b'hi\n',
+                'stderr': b''
+            }, {
+                'command': 'false',
+                'exit_code': 2,
+                'duration': 0,
+                'stdout': b'',
+                'stderr': b'err\n'
+            }])
+
+    def test_empty(self):
+        self.assertEqual(read_batch(b'', ['true']), [])
+
+    def test_commands_not_run(self):
+        data = b'VGR-BATCH 0 1 1 1 0 0\n'
+        results = read_batch(data, ['false', 'true'])
+        self.assertEqual([r['command'] for r in results], ['false'])
+
+    def test_date_without_nanoseconds(self):
+        data = b'VGR-BATCH 0 0 1500000000N 1500000002%N 0 0\n'
+        self.assertEqual(read_batch(data, ['true'])[0]['duration'], 2)
+
+    def test_truncated_header(self):
+        for data in (b'VGR-BATCH 0 0 1 2 0', b'VGR-BATCH 0 0 1 2 0 0\n'
+                     b'VGR-BA'):
+            with self.assertRaisesRegex(Exception,
+                                        'truncated batch capture file'):
+                read_batch(data, ['true'])
+
+    def test_truncated_output(self):
+        with self.assertRaisesRegex(Exception,
+                                    'truncated batch capture file'):
+            read_batch(b'VGR-BATCH 0 0 1 2 5 1\nhello', ['true'])
+
+    def test_invalid_header(self):
+        for data in (b'VGR-CAPTURE 0 0 0\n', b'VGR-BATCH 0 0 1 2 0\n'):
+            with self.assertRaisesRegex(Exception,
+                                        'invalid batch capture header'):
+                read_batch(data, ['true'])
+
+    def test_batch_script(self):
+        commands = ['echo one', 'echo two >&2; exit 3', 'printf x']
+        batch = GuestBatch(commands)
+        try:
+            rc = subprocess.call(['/bin/sh', '-c', batch.script])
+            self.assertEqual(rc, 3)
+            self.assertFalse(os.path.exists(batch.stdout_file))
+            with open(batch.capture_file, 'rb') as f:
+                results = read_batch(f.read(), commands)
+        finally:
+            os.remove(batch.capture_file)
+        self.assertEqual([(r['exit_code'], r['stdout'], r['stderr'])
+                          for r in results], [(0, b'one\n', b''),
+                                              (3, b'', b'two\n'),
+                                              (0, b'x', b'')])
+        for result in results:
+            self.assertGreaterEqual(result['duration'], 0)
+
+    def test_batch_script_stop_on_error(self):
+        commands = ['exit 4', 'echo never']
+        batch = GuestBatch(commands, stop_on_error=True)
+        try:
+            rc = subprocess.call(['/bin/sh', '-c', batch.script])
+            with open(batch.capture_file, 'rb') as f:
+                results = read_batch(f.read(), commands)
+        finally:
+            os.remove(batch.capture_file)
+        self.assertEqual(rc, 4)
+        self.assertEqual([r['command'] for r in results], ['exit 4'])
@@ -0,0 +1,233 @@
+# vsphere-guest-run
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+"""Tests of the rate limits, retries and circuit breakers of Scheduler."""
+
+import unittest
+from unittest import mock
+
+from pyVmomi import vim
+
+from vsphere_guest_run.scheduler import CircuitBreaker
+from vsphere_guest_run.scheduler import RetryBudget
+from vsphere_guest_run.scheduler import Scheduler
+from vsphere_guest_run.scheduler import TokenBucket
+
+
+class Clock(object):
+    """Stands in for the time module, sleep() only advances the clock."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class ClockTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch('vsphere_guest_run.scheduler.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TokenBucketTest(ClockTest):
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=10, burst=3)
+        self.assertEqual([bucket.acquire() for i in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(bucket.acquire(), 0.1)
+        self.assertAlmostEqual(bucket.acquire(), 0.1)
+        self.assertEqual(len(self.clock.slept), 2)
+
+    def test_refill_capped_at_burst(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        bucket.acquire()
+        bucket.acquire()
+        self.clock.now += 60
+        self.assertEqual([bucket.acquire() for i in range(2)], [0, 0])
+        self.assertAlmostEqual(bucket.acquire(), 0.1)
+
+    def test_partial_refill(self):
+        bucket = TokenBucket(rate=4, burst=1)
+        bucket.acquire()
+        self.clock.now += 0.125
+        self.assertAlmostEqual(bucket.acquire(), 0.125)
+
+    def test_unlimited(self):
+        bucket = TokenBucket(rate=None, burst=0)
+        self.assertEqual([bucket.acquire() for i in range(100)], [0] * 100)
+        self.assertEqual(self.clock.slept, [])
+
+
+class RetryBudgetTest(unittest.TestCase):
+    def test_burst(self):
+        budget = RetryBudget(ratio=0.5, burst=2)
+        self.assertEqual([budget.withdraw() for i in range(3)],
+                         [True, True, False])
+
+    def test_deposits(self):
+        budget = RetryBudget(ratio=0.5, burst=2)
+        budget.withdraw()
+        budget.withdraw()
+        budget.deposit()
+        self.assertFalse(budget.withdraw())
+        budget.deposit()
+        self.assertTrue(budget.withdraw())
+        self.assertFalse(budget.withdraw())
+
+    def test_deposits_capped_at_burst(self):
+        budget = RetryBudget(ratio=1, burst=2)
+        for i in range(10):
+            budget.deposit()
+        self.assertEqual([budget.withdraw() for i in range(3)],
+                         [True, True, False])
+
+
+class CircuitBreakerTest(ClockTest):
+    def test_opens_after_threshold(self):
+        breaker = CircuitBreaker(threshold=3, reset=30)
+        for i in range(2):
+            breaker.before('vc')
+            breaker.failure()
+        self.assertFalse(breaker.is_open())
+        breaker.failure()
+        self.assertTrue(breaker.is_open())
+        with self.assertRaisesRegex(Exception, 'circuit open for vc after 3 '
+                                    'failures, retry in 30 seconds'):
+            breaker.before('vc')
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(threshold=2, reset=30)
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertFalse(breaker.is_open())
+
+    def test_single_trial_after_reset(self):
+        breaker = CircuitBreaker(threshold=1, reset=30)
+        breaker.failure()
+        self.clock.now += 29
+        self.assertRaises(Exception, breaker.before, 'vc')
+        self.clock.now += 1
+        breaker.before('vc')
+        with self.assertRaisesRegex(Exception, 'retry in 1 seconds'):
+            breaker.before('vc')
+
+    def test_trial_success_closes(self):
+        breaker = CircuitBreaker(threshold=2, reset=30)
+        breaker.failure()
+        breaker.failure()
+        self.clock.now += 30
+        breaker.before('vc')
+        breaker.success()
+        self.assertFalse(breaker.is_open())
+        breaker.before('vc')
+        breaker.failure()
+        self.assertFalse(breaker.is_open())
+
+    def test_trial_failure_opens_again(self):
+        breaker = CircuitBreaker(threshold=5, reset=30)
+        for i in range(5):
+            breaker.failure()
+        self.clock.now += 30
+        breaker.before('vc')
+        breaker.failure()
+        self.assertTrue(breaker.is_open())
+        self.clock.now += 29
+        self.assertRaises(Exception, breaker.before, 'vc')
+        self.clock.now += 1
+        breaker.before('vc')
+
+
+class SchedulerTest(ClockTest):
+    def scheduler(self, **kwargs):
+        kwargs.setdefault('rate', None)
+        kwargs.setdefault('host_rate', None)
+        return Scheduler(**kwargs)
+
+    def failing(self, errors, result='ok'):
+        errors = list(errors)
+
+        def fn():
+            if len(errors) > 0:
+                raise errors.pop(0)
+            return result
+
+        return mock.Mock(side_effect=fn)
+
+    def test_retries_transient_errors(self):
+        scheduler = self.scheduler()
+        fn = self.failing([ConnectionError(), TimeoutError()])
+        self.assertEqual(scheduler.call('vc', fn), 'ok')
+        self.assertEqual(fn.call_count, 3)
+        self.assertEqual(scheduler.stats['retries'], 2)
+        self.assertEqual(len(self.clock.slept), 2)
+        self.assertFalse(scheduler.breaker('vc').is_open())
+
+    def test_does_not_retry_other_errors(self):
+        scheduler = self.scheduler()
+        fn = self.failing([vim.fault.FileNotFound()])
+        self.assertRaises(vim.fault.FileNotFound, scheduler.call, 'vc', fn)
+        self.assertEqual(fn.call_count, 1)
+
+    def test_call_once_only_retries_rejected_calls(self):
+        scheduler = self.scheduler()
+        fn = self.failing([vim.fault.GuestOperationsUnavailable()])
+        self.assertEqual(scheduler.call_once('vc', fn), 'ok')
+        fn = self.failing([ConnectionError()])
+        self.assertRaises(ConnectionError, scheduler.call_once, 'vc', fn)
+        self.assertEqual(fn.call_count, 1)
+
+    def test_max_retries(self):
+        scheduler = self.scheduler(max_retries=2)
+        fn = self.failing([ConnectionError()] * 5)
+        self.assertRaises(ConnectionError, scheduler.call, 'vc', fn)
+        self.assertEqual(fn.call_count, 3)
+
+    def test_retry_budget(self):
+        scheduler = self.scheduler(budget=RetryBudget(ratio=0, burst=1))
+        fn = self.failing([ConnectionError()] * 5)
+        self.assertRaises(ConnectionError, scheduler.call, 'vc', fn)
+        self.assertEqual(fn.call_count, 2)
+
+    def test_failed_call_counts_once_for_the_breaker(self):
+        scheduler = self.scheduler(breaker_threshold=2, max_retries=3)
+        fn = self.failing([ConnectionError()] * 10)
+        self.assertRaises(ConnectionError, scheduler.call, 'vc', fn)
+        self.assertEqual(fn.call_count, 4)
+        self.assertEqual(scheduler.breaker('vc').failures, 1)
+        self.assertRaises(ConnectionError, scheduler.call, 'vc', fn)
+        self.assertTrue(scheduler.breaker('vc').is_open())
+        calls = fn.call_count
+        self.assertRaisesRegex(Exception, 'circuit open', scheduler.call,
+                               'vc', fn)
+        self.assertEqual(fn.call_count, calls)
+        self.assertFalse(scheduler.breaker('other').is_open())
+
+    def test_guest_faults_do_not_open_the_circuit(self):
+        scheduler = self.scheduler(breaker_threshold=1, max_retries=0)
+        fn = self.failing([vim.fault.GuestOperationsUnavailable()] * 3)
+        for i in range(3):
+            self.assertRaises(vim.fault.GuestOperationsUnavailable,
+                              scheduler.call, 'vc', fn)
+        self.assertFalse(scheduler.breaker('vc').is_open())
+
+    def test_vm_slots_per_vcenter(self):
+        scheduler = self.scheduler(vm_processes=2)
+        vm = vim.VirtualMachine('vm-1')
+        self.assertIs(scheduler.vm_semaphore('vc1', vm),
+                      scheduler.vm_semaphore('vc1', 'vm-1'))
+        self.assertIsNot(scheduler.vm_semaphore('vc1', vm),
+                         scheduler.vm_semaphore('vc2', vm))
+        with scheduler.vm_slot('vc1', vm), scheduler.vm_slot('vc1', vm):
+            semaphore = scheduler.vm_semaphore('vc1', vm)
+            self.assertFalse(semaphore.acquire(blocking=False))
+            self.assertTrue(
+                scheduler.vm_semaphore('vc2', vm).acquire(blocking=False))
+        self.assertTrue(semaphore.acquire(blocking=False))
@@ -0,0 +1,116 @@
+# vsphere-guest-run
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+"""Tests of the batched process polls of ProcessTracker."""
+
+import unittest
+
+from pyVmomi import vim
+
+from fakevsphere import FakeVSphere
+from vsphere_guest_run.tracker import ProcessTracker
+from vsphere_guest_run.vsphere import VSphere
+
+TIMEOUT = 10
+
+
+class ProcessTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeVSphere(vms=2, tls=False)
+        self.fake.start()
+        self.addCleanup(self.fake.stop)
+        self.vs = VSphere('localhost', 'user', 'password', verify=False)
+        self.fake.attach(self.vs)
+        self.pm = self.vs.get_process_manager()
+        self.creds = self.vs.get_credentials('user', 'password')
+        self.tracker = ProcessTracker(min_interval=0.02, max_interval=0.1)
+
+    def start(self, vm, command):
+        spec = vim.vm.guest.ProcessManager.ProgramSpec(
+            programPath='/bin/sh', arguments='-c %r' % command)
+        return self.pm.StartProgramInGuest(vm, self.creds, spec)
+
+    def vm(self, moid):
+        return self.vs.get_vm_by_moid(moid)
+
+    def test_exit_codes(self):
+        vm = self.vm('vm-1')
+        futures = [
+            self.tracker.track(self.pm, vm, self.creds,
+                               self.start(vm, 'sleep 0.1; exit %s' % n))
+            for n in range(3)
+        ]
+        self.assertEqual(
+            [f.result(TIMEOUT).exitCode for f in futures], [0, 1, 2])
+        self.assertEqual(self.tracker.pending(), 0)
+
+    def test_one_poll_for_all_the_processes_of_a_vm(self):
+        vm = self.vm('vm-1')
+        pids = [self.start(vm, 'sleep 0.3') for n in range(4)]
+        self.fake.reset_stats()
+        futures = [
+            self.tracker.track(self.pm, vm, self.creds, pid) for pid in pids
+        ]
+        for future in futures:
+            future.result(TIMEOUT)
+        polls = self.fake.stats()['soap']['list_processes']
+        self.assertGreater(polls, 1)
+        self.assertEqual(max(f.polls for f in futures), polls)
+        self.assertLess(polls, sum(f.polls for f in futures))
+
+    def test_one_watcher_per_vm(self):
+        polls = []
+
+        def call(fn, vm, creds, pids):
+            polls.append((vm._moId, sorted(pids)))
+            return fn(vm, creds, pids)
+
+        tracker = ProcessTracker(min_interval=0.02, max_interval=0.1,
+                                 call=call)
+        pids = {}
+        for moid in ('vm-1', 'vm-2'):
+            vm = self.vm(moid)
+            pids[moid] = sorted(self.start(vm, 'sleep 0.3') for n in range(2))
+        futures = []
+        for moid in ('vm-1', 'vm-2'):
+            for pid in pids[moid]:
+                futures.append(
+                    tracker.track(self.pm, self.vm(moid), self.creds, pid))
+        for future in futures:
+            future.result(TIMEOUT)
+        for moid, polled in polls:
+            self.assertTrue(set(polled) <= set(pids[moid]), polled)
+        for moid in ('vm-1', 'vm-2'):
+            self.assertIn((moid, pids[moid]), polls)
+
+    def test_process_added_while_polling(self):
+        vm = self.vm('vm-1')
+        first = self.tracker.track(self.pm, vm, self.creds,
+                                   self.start(vm, 'sleep 0.4'))
+        second = self.tracker.track(self.pm, vm, self.creds,
+                                    self.start(vm, 'exit 5'))
+        self.assertEqual(second.result(TIMEOUT).exitCode, 5)
+        self.assertFalse(first.done())
+        self.assertEqual(first.result(TIMEOUT).exitCode, 0)
+
+    def test_process_not_found(self):
+        vm = self.vm('vm-1')
+        future = self.tracker.track(self.pm, vm, self.creds, 999999999)
+        with self.assertRaisesRegex(Exception, 'process not found'):
+            future.result(TIMEOUT)
+
+    def test_failed_poll_fails_the_polled_processes(self):
+        vm = self.vm('vm-1')
+
+        def call(fn, *args):
+            raise vim.fault.GuestOperationsUnavailable()
+
+        tracker = ProcessTracker(call=call)
+        futures = [
+            tracker.track(self.pm, vm, self.creds, self.start(vm, 'true'))
+            for n in range(2)
+        ]
+        for future in futures:
+            self.assertRaises(vim.fault.GuestOperationsUnavailable,
+                              future.result, TIMEOUT)
+        self.assertEqual(tracker.pending(), 0)
@@ -0,0 +1,323 @@
+# vsphere-guest-run
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import functools
+import itertools
+import time
+
+from vsphere_guest_run.events import Event
+from vsphere_guest_run.tracker import BACKOFF
+from vsphere_guest_run.tracker import MAX_INTERVAL
+from vsphere_guest_run.tracker import MIN_INTERVAL
+from vsphere_guest_run.vsphere import CAPTURE_FILES
+from vsphere_guest_run.vsphere import CAPTURE_SINGLE
+from vsphere_guest_run.vsphere import CHUNK_SIZE
+from vsphere_guest_run.vsphere import GuestProgram
+from vsphere_guest_run.vsphere import LIST_PAGE_SIZE
+from vsphere_guest_run.vsphere import RM_CMD
+from vsphere_guest_run.vsphere import VSphere
+
+MAX_CONCURRENCY = 256
+MAX_THREADS = 16
+
+
+class AsyncVSphere(object):
+    """asyncio counterpart of VSphere.
+
+    The blocking SOAP calls and HTTP transfers run in a thread pool of
+    max_threads threads. Guest processes are waited for through the
+    ProcessTracker of the VSphere, which polls all the processes of a VM
+    together, so no thread of the pool is held while a command runs. At
+    most max_concurrency guest operations are in flight at the same time,
+    and the guest process slots of a VM are the ones of the scheduler,
+    shared with the blocking API. Other keyword arguments are passed to
+    VSphere.
+    """
+
+    def __init__(self,
+                 host,
+                 user,
+                 password,
+                 verify=True,
+                 port=443,
+                 max_concurrency=MAX_CONCURRENCY,
+                 max_threads=MAX_THREADS,
+                 **kwargs):
+        kwargs.setdefault('http_pool_size', max_threads)
+        self.vs = VSphere(
+            host, user, password, verify=verify, port=port, **kwargs)
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_workers=max_threads)
+        self._semaphore = None
+
+    def _limit(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    @contextlib.asynccontextmanager
+    async def _vm_slot(self, vm):
+        """Hold one of the guest process slots of vm, without a thread."""
+        semaphore = self.vs.scheduler.vm_semaphore(self.vs.host, vm)
+        interval = MIN_INTERVAL
+        while not semaphore.acquire(blocking=False):
+            await asyncio.sleep(interval)
+            interval = min(interval * BACKOFF, MAX_INTERVAL)
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    async def _run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def _iterate(self, iterator, batch):
+        """Yield the items of a blocking iterator, batch at a time."""
+        while True:
+            async with self._limit():
+                items = await self._run(
+                    lambda: list(itertools.islice(iterator, batch)))
+            for item in items:
+                yield item
+            if len(items) < batch:
+                return
+
+    async def connect(self):
+        await self._run(self.vs.connect)
+
+    async def logout(self):
+        await self._run(self.vs.logout)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def get_vm_by_moid(self, moid):
+        return self.vs.get_vm_by_moid(moid)
+
+    def _emit(self, phase, vm, start, calls=1, error=None):
+        self.vs.emit(
+            Event(
+                phase,
+                vm=getattr(vm, '_moId', vm),
+                duration=time.time() - start,
+                calls=calls,
+                error=error))
+
+    async def execute_program_in_guest(self,
+                                       vm,
+                                       user,
+                                       password,
+                                       command,
+                                       wait_for_completion=False,
+                                       get_output=True,
+                                       rm_cmd=RM_CMD,
+                                       stdout=None,
+                                       stderr=None,
+                                       chunk_size=CHUNK_SIZE,
+                                       capture=CAPTURE_FILES,
+                                       cleanup_files=None,
+                                       timeout=None):
+        """Run a program in the guest, see VSphere.execute_program_in_guest.
+
+        timeout is the number of seconds to wait for the program to exit.
+        """
+        async with self._vm_slot(vm), self._limit():
+            program = GuestProgram(
+                command,
+                get_output=get_output,
+                capture=capture,
+                cleanup_files=cleanup_files)
+            creds = self.vs.get_credentials(user, password)
+            pm = await self._run(self.vs.get_process_manager)
+            start = time.time()
+            try:
+                pid = await self._run(self.vs._call_once,
+                                      pm.StartProgramInGuest, vm, creds,
+                                      program.spec)
+            except Exception as e:
+                self._emit('start', vm, start, error=str(e))
+                raise
+            self._emit('start', vm, start)
+            if not wait_for_completion:
+                return [pid]
+            info = None
+            if get_output and program.capture == CAPTURE_SINGLE:
+                info = await self._run(self.vs._poll_capture, vm, creds,
+                                       program)
+            if info is None:
+                process = await self.wait_for_process(
+                    vm, creds, pid, timeout=timeout)
+                program.exit_code = process.exitCode
+            output = []
+            if get_output:
+                output = await self._run(
+                    self.vs.collect_output,
+                    vm,
+                    user,
+                    password,
+                    program,
+                    stdout=stdout,
+                    stderr=stderr,
+                    chunk_size=chunk_size,
+                    rm_cmd=rm_cmd,
+                    info=info)
+            return [program.exit_code] + output
+
+    async def wait_for_process(self, vm, creds, pid, timeout=None):
+        """Wait until the guest process exits, return its GuestProcessInfo.
+
+        The process is polled by the ProcessTracker together with the
+        other processes of the VM, sync or async. After a timeout it is
+        still polled until it exits.
+        """
+        pm = await self._run(self.vs.get_process_manager)
+        start = time.time()
+        future = self.vs.process_tracker.track(pm, vm, creds, pid)
+        try:
+            try:
+                process = await asyncio.wait_for(
+                    asyncio.shield(asyncio.wrap_future(future)), timeout)
+            except asyncio.TimeoutError:
+                raise Exception('timeout waiting for process (pid=%s) '
+                                '(vm=%s)' % (pid, vm))
+        except Exception as e:
+            self._emit('wait', vm, start, calls=future.polls, error=str(e))
+            raise
+        self._emit('wait', vm, start, calls=future.polls)
+        return process
+
+    async def execute_program_in_guests(self, vms, user, password, command,
+                                        **kwargs):
+        """Run a command on many VMs, yield (vm, result, exception).
+
+        Results are yielded in completion order, the number of commands
+        running at the same time is bounded by max_concurrency.
+        """
+
+        async def run(vm):
+            try:
+                result = await self.execute_program_in_guest(
+                    vm,
+                    user,
+                    password,
+                    command,
+                    wait_for_completion=True,
+                    **kwargs)
+                return vm, result, None
+            except Exception as e:
+                return vm, None, e
+
+        for future in asyncio.as_completed([run(vm) for vm in vms]):
+            yield await future
+
+    async def execute_script_in_guest(self,
+                                      vm,
+                                      user,
+                                      password,
+                                      content,
+                                      target_file=None,
+                                      wait_for_completion=False,
+                                      get_output=True,
+                                      delete_script=True,
+                                      interpreter=None,
+                                      **kwargs):
+        """Upload a script and run it, see VSphere.execute_script_in_guest."""
+        async with self._limit():
+            target, command = await self._run(self.vs._upload_script, vm,
+                                              user, password, content,
+                                              target_file, interpreter)
+        delete = wait_for_completion and delete_script
+        result = await self.execute_program_in_guest(
+            vm,
+            user,
+            password,
+            command,
+            wait_for_completion=wait_for_completion,
+            get_output=get_output,
+            cleanup_files=[target] if delete and get_output else None,
+            **kwargs)
+        if delete and not get_output:
+            await self.delete_file_in_guest(vm, user, password, target)
+        return result
+
+    async def upload_file_to_guest(self, vm, user, password, data,
+                                   target_file, file_attribute=None,
+                                   overwrite=False):
+        async with self._limit():
+            return await self._run(self.vs.upload_file_to_guest, vm, user,
+                                   password, data, target_file,
+                                   file_attribute, overwrite)
+
+    async def upload_local_file_to_guest(self, vm, user, password, source,
+                                         target_file, file_attribute=None,
+                                         overwrite=False):
+        async with self._limit():
+            return await self._run(self.vs.upload_local_file_to_guest, vm,
+                                   user, password, source, target_file,
+                                   file_attribute, overwrite)
+
+    async def download_file_from_guest(self, vm, user, password,
+                                       source_file):
+        async with self._limit():
+            return await self._run(self.vs.download_file_from_guest, vm, user,
+                                   password, source_file)
+
+    async def download_file_to_local(self,
+                                     vm,
+                                     user,
+                                     password,
+                                     source_file,
+                                     target,
+                                     chunk_size=CHUNK_SIZE):
+        async with self._limit():
+            return await self._run(self.vs.download_file_to_local, vm, user,
+                                   password, source_file, target, chunk_size)
+
+    async def iter_files_in_guest(self,
+                                  vm,
+                                  user,
+                                  password,
+                                  file_path,
+                                  pattern=None,
+                                  page_size=LIST_PAGE_SIZE):
+        """Yield all the entries of a guest directory, page by page."""
+        async for file_info in self._iterate(
+                self.vs.iter_files_in_guest(vm, user, password, file_path,
+                                            pattern, page_size), page_size):
+            yield file_info
+
+    async def list_files_in_guest(self, vm, user, password, file_path,
+                                  pattern=None):
+        return [
+            file_info async for file_info in self.iter_files_in_guest(
+                vm, user, password, file_path, pattern)
+        ]
+
+    async def make_directory_in_guest(self, vm, user, password,
+                                      directory_path, create_parents=True):
+        async with self._limit():
+            await self._run(self.vs.make_directory_in_guest, vm, user,
+                            password, directory_path, create_parents)
+
+    async def move_file_in_guest(self, vm, user, password, src_file_path,
+                                 trg_file_path, overwrite):
+        async with self._limit():
+            await self._run(self.vs.move_file_in_guest, vm, user, password,
+                            src_file_path, trg_file_path, overwrite)
+
+    async def delete_file_in_guest(self, vm, user, password, file_path):
+        async with self._limit():
+            await self._run(self.vs.delete_file_in_guest, vm, user, password,
+                            file_path)
+
+    async def list_vms(self, **kwargs):
+        return await self._run(self.vs.list_vms, **kwargs)
+
+    async def vms_to_dicts(self, vms, **kwargs):
+        return await self._run(self.vs.vms_to_dicts, vms, **kwargs)
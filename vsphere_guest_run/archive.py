@@ -0,0 +1,226 @@
+# vsphere-guest-run
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import os
+import posixpath
+import shlex
+import tarfile
+import tempfile
+import uuid
+
+from vsphere_guest_run.vsphere import CAPTURE_SINGLE
+
+UNPACK_SCRIPT = ('mkdir -p %(dir)s && tar -x%(z)svf %(archive)s -C %(dir)s; '
+                 'rc=$?; rm -f %(archive)s; exit $rc')
+PACK_SCRIPT = ('cd %(dir)s && tar -c%(z)svf %(archive)s %(members)s; '
+               'rc=$?; rm -f %(list)s; exit $rc')
+VERIFY_NAMES = 5
+
+
+class ArchiveResult(object):
+    def __init__(self, files, size, archive_size):
+        self.files = files
+        self.size = size
+        self.archive_size = archive_size
+
+    def __str__(self):
+        return '%s files (%s bytes) in a %s bytes archive' % (
+            self.files, self.size, self.archive_size)
+
+
+def _member_name(name):
+    name = posixpath.normpath(name.strip())
+    if name.startswith('./'):
+        name = name[2:]
+    return name
+
+
+def _member_names(output):
+    names = set()
+    for line in output.decode(errors='replace').splitlines():
+        name = _member_name(line)
+        if name not in ('', '.'):
+            names.add(name)
+    return names
+
+
+def _verify(missing, unexpected):
+    """Raise when names are missing from or unexpected in an archive."""
+    problems = []
+    for names, what in ((missing, 'missing'), (unexpected, 'unexpected')):
+        if len(names) > 0:
+            problems.append('%s files %s: %s' % (len(names), what, ', '.join(
+                sorted(names)[:VERIFY_NAMES])))
+    if len(problems) > 0:
+        raise Exception('archive verification failed, %s' %
+                        '; '.join(problems))
+
+
+def _remove(vs, vm, user, password, path):
+    try:
+        vs.delete_file_in_guest(vm, user, password, path)
+    except Exception:
+        pass
+
+
+def _run(vs, vm, user, password, script, callback):
+    result = vs.execute_program_in_guest(
+        vm,
+        user,
+        password,
+        script,
+        wait_for_completion=True,
+        get_output=True,
+        capture=CAPTURE_SINGLE,
+        callback=callback)
+    if result[0] != 0:
+        raise Exception('tar failed in guest with exit code %s: %s' %
+                        (result[0], result[2].decode(errors='replace')))
+    return result[1]
+
+
+def upload_archive_to_guest(vs,
+                            vm,
+                            user,
+                            password,
+                            local_dir,
+                            remote_dir,
+                            paths=None,
+                            compress=True,
+                            callback=None):
+    """Upload many files to the guest as a single archive.
+
+    The files under local_dir, or only paths (relative to local_dir), are
+    packed into a (gzip compressed) tar archive spooled to a local
+    temporary file, with symlinks replaced by what they point to as
+    sync_to_guest() does, uploaded with one transfer and unpacked into
+    remote_dir by one guest process. The names listed by tar in the guest
+    are checked against the packed ones. The archive is removed from the
+    guest whether unpacking succeeded or not. Returns an ArchiveResult.
+    """
+    if paths is None:
+        paths = ['.']
+    with tempfile.TemporaryFile() as f:
+        names = set()
+        files = 0
+        size = 0
+        seen = set()
+
+        def once(member):
+            # skip the symlinked directories leading back to one already
+            # packed, e.g. one of their parents
+            if member.isdir():
+                real = os.path.realpath(os.path.join(local_dir, member.name))
+                if real in seen:
+                    return None
+                seen.add(real)
+            return member
+
+        with tarfile.open(fileobj=f, mode='w:gz' if compress else 'w',
+                          dereference=True) as tar:
+            for path in paths:
+                tar.add(os.path.join(local_dir, path), arcname=path,
+                        filter=once)
+            for member in tar.getmembers():
+                name = _member_name(member.name)
+                if name != '.':
+                    names.add(name)
+                if member.isfile():
+                    files += 1
+                    size += member.size
+        archive_size = f.tell()
+        f.seek(0)
+        archive = '/tmp/%s.tar%s' % (uuid.uuid1(), '.gz' if compress else '')
+        try:
+            vs.upload_file_to_guest(vm, user, password, f, archive)
+            output = _run(
+                vs, vm, user, password, UNPACK_SCRIPT % {
+                    'dir': shlex.quote(remote_dir),
+                    'z': 'z' if compress else '',
+                    'archive': archive
+                }, callback)
+        except Exception:
+            _remove(vs, vm, user, password, archive)
+            raise
+    unpacked = _member_names(output)
+    _verify(names - unpacked, unpacked - names)
+    return ArchiveResult(files, size, archive_size)
+
+
+def download_archive_from_guest(vs,
+                                vm,
+                                user,
+                                password,
+                                remote_dir,
+                                local_dir,
+                                paths=None,
+                                compress=True,
+                                callback=None):
+    """Download many files from the guest as a single archive.
+
+    One guest process packs remote_dir, or only paths (relative to
+    remote_dir), into a tar archive that is downloaded with one transfer,
+    streamed to a local temporary file and extracted into local_dir. The
+    extracted names are checked against the ones listed by tar in the
+    guest, symlinks and special files are not extracted. The archive is
+    removed from the guest also when packing or the transfer failed.
+    Returns an ArchiveResult.
+    """
+    file_uuid = uuid.uuid1()
+    archive = '/tmp/%s.tar%s' % (file_uuid, '.gz' if compress else '')
+    list_file = ''
+    members = '.'
+    if paths is not None:
+        list_file = '/tmp/%s.list' % file_uuid
+        members = '-T %s' % list_file
+    with tempfile.TemporaryFile() as f:
+        try:
+            if paths is not None:
+                vs.upload_file_to_guest(
+                    vm, user, password,
+                    ''.join('%s\n' % path for path in paths), list_file)
+            output = _run(
+                vs, vm, user, password, PACK_SCRIPT % {
+                    'dir': shlex.quote(remote_dir),
+                    'z': 'z' if compress else '',
+                    'archive': archive,
+                    'members': members,
+                    'list': list_file
+                }, callback)
+            packed = _member_names(output)
+            archive_size = vs.download_file_to_local(vm, user, password,
+                                                     archive, f)
+        except Exception:
+            if paths is not None:
+                _remove(vs, vm, user, password, list_file)
+            raise
+        finally:
+            _remove(vs, vm, user, password, archive)
+        f.seek(0)
+        names = set()
+        files = 0
+        size = 0
+        skipped = set()
+        with tarfile.open(fileobj=f, mode='r:gz' if compress else 'r') as tar:
+            members = []
+            for member in tar:
+                name = _member_name(member.name)
+                if name.startswith('/') or name == '..' or \
+                        name.startswith('../'):
+                    raise Exception('unsafe path in archive: %s' % name)
+                if not (member.isfile() or member.isdir()):
+                    skipped.add(name)
+                    continue
+                members.append(member)
+                if name != '.':
+                    names.add(name)
+                if member.isfile():
+                    files += 1
+                    size += member.size
+            if hasattr(tarfile, 'data_filter'):
+                tar.extractall(local_dir, members=members, filter='data')
+            else:
+                tar.extractall(local_dir, members=members)
+    _verify(packed - names - skipped, names - packed)
+    return ArchiveResult(files, size, archive_size)
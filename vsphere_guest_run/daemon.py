@@ -0,0 +1,400 @@
+# vsphere-guest-run
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import base64
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+# This module is imported by the thin vgr clients, it must not import
+# pyVmomi or requests at the top level, see tests/startup.py
+
+SOCKET_PATH = os.path.join(os.path.expanduser('~'), '.vgr', 'vgr.sock')
+JOBS = 16
+KEEPALIVE = 600
+OPERATIONS = ('run', 'script', 'upload', 'download', 'status')
+REQUIRED = {
+    'run': ('vm', 'guest_user', 'guest_password', 'command'),
+    'script': ('vm', 'guest_user', 'guest_password', 'script'),
+    'upload': ('vm', 'guest_user', 'guest_password', 'local_file',
+               'remote_file'),
+    'download': ('vm', 'guest_user', 'guest_password', 'remote_file'),
+    'status': ()
+}
+PART_SIZE_MB = 64
+
+
+def submit(path, job, stdout=None, stderr=None):
+    """Send a job to the daemon listening on path and wait for its result.
+
+    The output of run and script jobs, and the content of a download to
+    no local_file, is written to the stdout and stderr binary file objects
+    as it is received. Returns the result message of the job, raises an
+    Exception with the message of the daemon when the job failed.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            raise Exception('no vgr daemon listening on %s, start one with '
+                            '\'vgr serve\'' % path)
+        sock.sendall(json.dumps(job).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            for line in f:
+                message = json.loads(line.decode('utf-8'))
+                if message['type'] in ('stdout', 'stderr'):
+                    stream = stdout if message['type'] == 'stdout' else stderr
+                    if stream is not None:
+                        stream.write(base64.b64decode(message['data']))
+                        stream.flush()
+                elif message['type'] == 'result':
+                    return message
+                elif message['type'] == 'error':
+                    raise Exception(message['message'])
+        raise Exception('vgr daemon closed the connection')
+    finally:
+        sock.close()
+
+
+class _Channel(object):
+    """Sends the messages of a job to its client.
+
+    Once the client went away the messages are dropped, so that a job
+    started in the guest still runs to completion and cleans up.
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.sent = 0
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        line = json.dumps(message).encode('utf-8') + b'\n'
+        with self._lock:
+            if self.closed:
+                return
+            try:
+                self.wfile.write(line)
+                self.wfile.flush()
+                self.sent += 1
+            except OSError:
+                self.closed = True
+
+    def stream(self, name):
+        return _Stream(self, name)
+
+
+class _Stream(object):
+    """Binary file object writing to a channel as stdout or stderr frames."""
+
+    def __init__(self, channel, name):
+        self.channel = channel
+        self.name = name
+
+    def write(self, data):
+        if len(data) > 0:
+            self.channel.send({
+                'type': self.name,
+                'data': base64.b64encode(data).decode('ascii')
+            })
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if len(line) == 0:
+            return
+        channel = _Channel(self.wfile)
+        try:
+            job = json.loads(line.decode('utf-8'))
+        except ValueError:
+            channel.send({'type': 'error', 'message': 'invalid job'})
+            return
+        self.server.daemon.handle(job, channel)
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+class Daemon(object):
+    """Runs guest jobs for thin vgr clients over a local Unix socket.
+
+    vs is kept logged in: the session is checked every keepalive seconds,
+    which also keeps it from expiring while idle, and a job failing
+    because the session was lost is run again after a new login, unless
+    it already started something in the guest. resolve(vm_id) returns the
+    VM of a job. At most jobs jobs run at the same time, the others wait
+    for a slot.
+
+    The protocol is one JSON object per line. The client sends a job, e.g.
+    {"op": "run", "vm": "vm-42", "guest_user": ..., "guest_password": ...,
+    "command": "uname -a"}, and receives stdout and stderr messages with
+    base64 data, then a result or an error message.
+    """
+
+    def __init__(self,
+                 vs,
+                 resolve,
+                 path=SOCKET_PATH,
+                 jobs=JOBS,
+                 keepalive=KEEPALIVE,
+                 log=None):
+        self.vs = vs
+        self.resolve = resolve
+        self.path = path
+        self.keepalive = keepalive
+        self.log = log or (lambda message: None)
+        self.stats = {'running': 0, 'waiting': 0, 'completed': 0,
+                      'failed': 0, 'logins': 0}
+        self.jobs = jobs
+        self._slots = threading.BoundedSemaphore(jobs)
+        self._lock = threading.Lock()
+        self._login_lock = threading.Lock()
+        self._resolve_lock = threading.Lock()
+        self._generation = 0
+        self._local = threading.local()
+        self._stopped = threading.Event()
+        self._server = None
+        self.vs.add_sink(self._track)
+
+    def bind(self):
+        """Create the socket, readable and writable only by the user."""
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, mode=0o700)
+        if os.path.exists(self.path):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                raise Exception('a vgr daemon is already listening on %s' %
+                                self.path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                os.remove(self.path)
+            finally:
+                sock.close()
+        self._server = _Server(self.path, _Handler, bind_and_activate=False)
+        self._server.daemon = self
+        umask = os.umask(0o077)
+        try:
+            self._server.server_bind()
+        finally:
+            os.umask(umask)
+        self._server.server_activate()
+
+    def serve_forever(self):
+        if self._server is None:
+            self.bind()
+        keepalive = threading.Thread(target=self._keep_alive)
+        keepalive.daemon = True
+        keepalive.start()
+        try:
+            self._server.serve_forever()
+        finally:
+            self._stopped.set()
+            self._server.server_close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def shutdown(self):
+        """Stop serving, from another thread than serve_forever()."""
+        self._server.shutdown()
+
+    def _keep_alive(self):
+        while not self._stopped.wait(self.keepalive):
+            generation = self._generation
+            try:
+                session = self.vs.get_content().sessionManager.currentSession
+            except Exception as e:
+                if not self._is_not_authenticated(e):
+                    self.log('session check failed: %s' % e)
+                    continue
+                session = None
+            if session is None:
+                try:
+                    self._login(generation)
+                except Exception as e:
+                    self.log('login failed: %s' % e)
+
+    def _login(self, generation):
+        """Login again, unless another thread did since generation."""
+        with self._login_lock:
+            if self._generation != generation:
+                return
+            self.vs.invalidate_cache()
+            self.vs.connect()
+            self._generation += 1
+            with self._lock:
+                self.stats['logins'] += 1
+        self.log('logged in again on %s' % self.vs.host)
+
+    def _is_not_authenticated(self, e):
+        from pyVmomi import vim
+        return isinstance(e, vim.fault.NotAuthenticated)
+
+    def _track(self, event):
+        # Only the events of the thread running the job are seen here, the
+        # part transfers run in worker threads and count as effects as
+        # soon as they start, see _upload() and _download()
+        job = getattr(self._local, 'job', None)
+        if job is not None and event.error is None and \
+                event.phase in ('start', 'upload', 'file'):
+            job['effects'] += 1
+
+    def handle(self, job, channel):
+        op = job.get('op')
+        if op not in OPERATIONS:
+            channel.send({
+                'type': 'error',
+                'message': 'unknown operation: %s' % op
+            })
+            return
+        missing = [key for key in REQUIRED[op] if job.get(key) is None]
+        if len(missing) > 0:
+            channel.send({
+                'type': 'error',
+                'message': 'missing field: %s' % ', '.join(missing)
+            })
+            return
+        if op == 'status':
+            with self._lock:
+                result = dict(self.stats)
+            result.update({'type': 'result', 'host': self.vs.host,
+                           'jobs': self.jobs})
+            channel.send(result)
+            return
+        with self._lock:
+            self.stats['waiting'] += 1
+        self._slots.acquire()
+        with self._lock:
+            self.stats['waiting'] -= 1
+            self.stats['running'] += 1
+        start = time.time()
+        try:
+            result = self._execute(op, job, channel)
+        except Exception as e:
+            with self._lock:
+                self.stats['failed'] += 1
+            channel.send({'type': 'error', 'message': str(e)})
+            return
+        finally:
+            self._slots.release()
+            with self._lock:
+                self.stats['running'] -= 1
+        with self._lock:
+            self.stats['completed'] += 1
+        result.update({'type': 'result', 'duration': time.time() - start})
+        channel.send(result)
+
+    def _execute(self, op, job, channel):
+        state = {'effects': 0}
+        self._local.job = state
+        try:
+            while True:
+                generation = self._generation
+                sent = channel.sent
+                try:
+                    return getattr(self, '_%s' % op)(job, channel)
+                except Exception as e:
+                    if not self._is_not_authenticated(e) or \
+                            state['effects'] > 0 or channel.sent > sent or \
+                            state.get('retried'):
+                        raise
+                state['retried'] = True
+                self._login(generation)
+        finally:
+            self._local.job = None
+
+    def _vm(self, job):
+        with self._resolve_lock:
+            return self.resolve(job['vm'])
+
+    def _run_options(self, job):
+        options = {}
+        for key in ('rm_cmd', 'capture', 'follow'):
+            if job.get(key) is not None:
+                options[key] = job[key]
+        return options
+
+    def _run(self, job, channel):
+        result = self.vs.execute_program_in_guest(
+            self._vm(job),
+            job['guest_user'],
+            job['guest_password'],
+            job['command'],
+            wait_for_completion=True,
+            wait_time=1,
+            get_output=True,
+            stdout=channel.stream('stdout'),
+            stderr=channel.stream('stderr'),
+            **self._run_options(job))
+        return {'exit_code': result[0]}
+
+    def _script(self, job, channel):
+        result = self.vs.execute_script_in_guest(
+            self._vm(job),
+            job['guest_user'],
+            job['guest_password'],
+            base64.b64decode(job['script']),
+            wait_for_completion=True,
+            wait_time=1,
+            get_output=True,
+            stdout=channel.stream('stdout'),
+            stderr=channel.stream('stderr'),
+            **self._run_options(job))
+        return {'exit_code': result[0]}
+
+    def _upload(self, job, channel):
+        if job.get('parallel', 1) > 1:
+            from vsphere_guest_run.parts import upload_file_in_parts
+            self._local.job['effects'] += 1
+            result = upload_file_in_parts(
+                self.vs,
+                self._vm(job),
+                job['guest_user'],
+                job['guest_password'],
+                job['local_file'],
+                job['remote_file'],
+                part_size=job.get('part_size', PART_SIZE_MB) * 1024 * 1024,
+                max_workers=job['parallel'])
+            channel.stream('stderr').write(('%s\n' % result).encode())
+            return {'bytes': result.size}
+        self.vs.upload_local_file_to_guest(
+            self._vm(job), job['guest_user'], job['guest_password'],
+            job['local_file'], job['remote_file'])
+        return {'bytes': os.path.getsize(job['local_file'])}
+
+    def _download(self, job, channel):
+        target = job.get('local_file')
+        if job.get('parallel', 1) > 1 and target is not None:
+            from vsphere_guest_run.parts import download_file_in_parts
+            self._local.job['effects'] += 1
+            result = download_file_in_parts(
+                self.vs,
+                self._vm(job),
+                job['guest_user'],
+                job['guest_password'],
+                job['remote_file'],
+                target,
+                part_size=job.get('part_size', PART_SIZE_MB) * 1024 * 1024,
+                max_workers=job['parallel'])
+            channel.stream('stderr').write(('%s\n' % result).encode())
+            return {'bytes': result.size}
+        if target is None:
+            target = channel.stream('stdout')
+        size = self.vs.download_file_to_local(
+            self._vm(job), job['guest_user'], job['guest_password'],
+            job['remote_file'], target)
+        return {'bytes': size}
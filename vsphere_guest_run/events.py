@@ -0,0 +1,177 @@
+# vsphere-guest-run
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import json
+import threading
+import time
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                    30, 60)
+
+
+class Event(object):
+    """A completed phase of a guest operation.
+
+    phase is e.g. 'login', 'start', 'wait', 'output', 'cleanup', 'upload'
+    or 'download'. vm is the moid of the VM, duration is in seconds, bytes
+    the number of bytes transferred and calls the number of vSphere API
+    round trips made. error is the message of the exception that ended
+    the phase, None on success.
+    """
+
+    def __init__(self,
+                 phase,
+                 vm=None,
+                 duration=0.0,
+                 bytes=0,
+                 calls=0,
+                 error=None):
+        self.phase = phase
+        self.vm = vm
+        self.duration = duration
+        self.bytes = bytes
+        self.calls = calls
+        self.error = error
+        self.timestamp = time.time()
+
+    def to_dict(self):
+        return {
+            'phase': self.phase,
+            'vm': self.vm,
+            'duration': self.duration,
+            'bytes': self.bytes,
+            'calls': self.calls,
+            'error': self.error,
+            'timestamp': self.timestamp
+        }
+
+    def __str__(self):
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+
+class JsonLinesSink(object):
+    """Event sink writing one JSON object per event to a text stream."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = '%s\n' % event
+        with self._lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+
+class Histogram(object):
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for n, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[n] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+
+class Metrics(object):
+    """Counters and duration histograms of the events, per phase.
+
+    Metrics is itself an event sink; VSphere feeds every event to its
+    metrics attribute.
+    """
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.phases = {}
+
+    def __call__(self, event):
+        with self._lock:
+            phase = self.phases.get(event.phase)
+            if phase is None:
+                phase = {
+                    'ok': 0,
+                    'error': 0,
+                    'calls': 0,
+                    'bytes': 0,
+                    'duration': Histogram(self.buckets)
+                }
+                self.phases[event.phase] = phase
+            phase['ok' if event.error is None else 'error'] += 1
+            phase['calls'] += event.calls
+            phase['bytes'] += event.bytes
+            phase['duration'].observe(event.duration)
+
+    def summary(self):
+        """Return one dict per phase, in the order they first happened."""
+        rows = []
+        with self._lock:
+            for name, phase in self.phases.items():
+                histogram = phase['duration']
+                rows.append({
+                    'phase': name,
+                    'count': histogram.count,
+                    'errors': phase['error'],
+                    'seconds': histogram.sum,
+                    'mean': histogram.sum / histogram.count,
+                    'max': histogram.max,
+                    'calls': phase['calls'],
+                    'bytes': phase['bytes']
+                })
+        return rows
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = [
+            '# HELP vgr_phase_total Guest operation phases completed.',
+            '# TYPE vgr_phase_total counter'
+        ]
+        with self._lock:
+            phases = sorted(self.phases.items())
+            for name, phase in phases:
+                for status in ('ok', 'error'):
+                    lines.append('vgr_phase_total{phase="%s",status="%s"} %s' %
+                                 (name, status, phase[status]))
+            lines.append('# HELP vgr_api_calls_total vSphere API round trips.')
+            lines.append('# TYPE vgr_api_calls_total counter')
+            for name, phase in phases:
+                lines.append('vgr_api_calls_total{phase="%s"} %s' %
+                             (name, phase['calls']))
+            lines.append('# HELP vgr_bytes_total Bytes transferred.')
+            lines.append('# TYPE vgr_bytes_total counter')
+            for name, phase in phases:
+                lines.append('vgr_bytes_total{phase="%s"} %s' %
+                             (name, phase['bytes']))
+            lines.append('# HELP vgr_phase_duration_seconds Duration of the '
+                         'guest operation phases.')
+            lines.append('# TYPE vgr_phase_duration_seconds histogram')
+            for name, phase in phases:
+                histogram = phase['duration']
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append('vgr_phase_duration_seconds_bucket'
+                                 '{phase="%s",le="%s"} %s' %
+                                 (name, bound, cumulative))
+                lines.append('vgr_phase_duration_seconds_bucket'
+                             '{phase="%s",le="+Inf"} %s' %
+                             (name, histogram.count))
+                lines.append('vgr_phase_duration_seconds_sum{phase="%s"} %s' %
+                             (name, histogram.sum))
+                lines.append(
+                    'vgr_phase_duration_seconds_count{phase="%s"} %s' %
+                    (name, histogram.count))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,215 @@
+# vsphere-guest-run
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import hashlib
+import json
+import os
+import pyVmomi
+from pyVmomi import vim
+import re
+import threading
+import time
+
+from vsphere_guest_run.vsphere import VM_INFO_PROPERTIES
+
+INVENTORY_DIR = os.path.join(os.path.expanduser('~'), '.vgr', 'inventory')
+INVENTORY_PROPERTIES = VM_INFO_PROPERTIES
+MAX_OBJECT_UPDATES = 1000
+MOID_PATTERN = re.compile(r'^vm-\d+$')
+
+
+def snapshot_path(user, host, port, directory=INVENTORY_DIR):
+    key = '%s@%s:%s' % (user, host, port)
+    name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+    return os.path.join(directory, '%s.json' % name)
+
+
+class Inventory(object):
+    """Local cache of the VM inventory with name, uuid and state indexes.
+
+    load() retrieves all the VMs once through a PropertyCollector filter
+    on a container view, update() then applies only what changed since
+    the previous call with WaitForUpdatesEx. A compact snapshot of the
+    cache can be saved to disk and loaded by later processes, which can
+    answer lookups without walking the inventory again. The snapshot does
+    not include the update version: a version only applies to the
+    PropertyCollector created by load(), which is destroyed with the
+    session, so an inventory loaded from a snapshot is refreshed with
+    load(), not update().
+    """
+
+    def __init__(self, vs=None, path_set=INVENTORY_PROPERTIES):
+        self.vs = vs
+        self.path_set = path_set
+        self.vms = {}
+        self.version = None
+        self.timestamp = None
+        self._by_name = {}
+        self._by_uuid = {}
+        self._by_state = {}
+        self._lock = threading.RLock()
+        self._collector = None
+        self._view = None
+
+    def load(self):
+        content = self.vs.get_content()
+        self._view = self.vs._call_once(
+            content.viewManager.CreateContainerView, content.rootFolder,
+            [vim.VirtualMachine], True)
+        self._collector = self.vs._call_once(
+            content.propertyCollector.CreatePropertyCollector)
+        filter_spec = self.vs.create_filter_spec(
+            self._view, vim.VirtualMachine, self.path_set)
+        self.vs._call_once(
+            self._collector.CreateFilter, filter_spec, partialUpdates=False)
+        with self._lock:
+            self.vms = {}
+            self._reindex()
+            self.version = ''
+        self.update(timeout=0)
+
+    def update(self, timeout=0):
+        """Apply the changes since the last update, return their count.
+
+        Waits up to timeout seconds for a change to happen, None waits
+        until there is one. Only valid after load(), in the same process.
+        """
+        if self._collector is None:
+            raise Exception('inventory update needs load() first')
+        options = pyVmomi.vmodl.query.PropertyCollector.WaitOptions()
+        options.maxWaitSeconds = timeout
+        options.maxObjectUpdates = MAX_OBJECT_UPDATES
+        count = 0
+        while True:
+            update_set = self.vs._call(self._collector.WaitForUpdatesEx,
+                                       self.version, options)
+            if update_set is None:
+                break
+            with self._lock:
+                count += self._apply(update_set)
+                self.version = update_set.version
+            if not update_set.truncated:
+                break
+            options.maxWaitSeconds = 0
+        self.timestamp = time.time()
+        return count
+
+    def is_open(self):
+        """True after load() until close(), while update() can be used."""
+        return self._collector is not None
+
+    def close(self):
+        collector, self._collector = self._collector, None
+        view, self._view = self._view, None
+        try:
+            if collector is not None:
+                self.vs._call(collector.Destroy)
+        finally:
+            if view is not None:
+                self.vs._call(view.DestroyView)
+
+    def _apply(self, update_set):
+        count = 0
+        for filter_update in update_set.filterSet:
+            for object_update in filter_update.objectSet:
+                moid = object_update.obj._moId
+                self._unindex(moid)
+                if object_update.kind == 'leave':
+                    self.vms.pop(moid, None)
+                else:
+                    vm = self.vms.setdefault(moid, {'moid': moid})
+                    for change in object_update.changeSet:
+                        if change.op in ('remove', 'indirectRemove'):
+                            vm.pop(change.name, None)
+                        else:
+                            vm[change.name] = change.val
+                    self._index(moid)
+                count += 1
+        return count
+
+    def _index(self, moid):
+        vm = self.vms[moid]
+        self._by_name.setdefault(vm.get('name'), set()).add(moid)
+        if vm.get('config.uuid') is not None:
+            self._by_uuid[vm['config.uuid']] = moid
+        self._by_state.setdefault(vm.get('guest.guestState'), set()).add(moid)
+
+    def _unindex(self, moid):
+        vm = self.vms.get(moid)
+        if vm is None:
+            return
+        self._by_name.get(vm.get('name'), set()).discard(moid)
+        if self._by_uuid.get(vm.get('config.uuid')) == moid:
+            del self._by_uuid[vm['config.uuid']]
+        self._by_state.get(vm.get('guest.guestState'), set()).discard(moid)
+
+    def _reindex(self):
+        self._by_name = {}
+        self._by_uuid = {}
+        self._by_state = {}
+        for moid in self.vms:
+            self._index(moid)
+
+    def get(self, moid):
+        with self._lock:
+            return self.vms.get(moid)
+
+    def find(self, key):
+        """Return the moids of the VMs with key as moid, uuid or name."""
+        with self._lock:
+            if key in self.vms:
+                return [key]
+            if key in self._by_uuid:
+                return [self._by_uuid[key]]
+            return sorted(self._by_name.get(key, set()))
+
+    def find_by_state(self, state):
+        with self._lock:
+            return sorted(self._by_state.get(state, set()))
+
+    def list(self):
+        with self._lock:
+            return [dict(vm) for vm in self.vms.values()]
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, mode=0o700)
+        with self._lock:
+            snapshot = {
+                'timestamp': self.timestamp,
+                'path_set': self.path_set,
+                'vms': [{k: _jsonable(v)
+                         for k, v in vm.items()}
+                        for vm in self.vms.values()]
+            }
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(snapshot, f, separators=(',', ':'))
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def from_snapshot(cls, path, vs=None):
+        """Load a snapshot saved with save(), None if there is none."""
+        try:
+            with open(path, 'r') as f:
+                snapshot = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        inventory = cls(vs, path_set=snapshot.get('path_set'))
+        inventory.timestamp = snapshot.get('timestamp')
+        inventory.vms = {vm['moid']: vm for vm in snapshot.get('vms', [])}
+        inventory._reindex()
+        return inventory
+
+    def age(self):
+        if self.timestamp is None:
+            return None
+        return time.time() - self.timestamp
+
+
+def _jsonable(value):
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
@@ -0,0 +1,319 @@
+# vsphere-guest-run
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import math
+import os
+from pyVmomi import vim
+import shlex
+import threading
+
+from vsphere_guest_run.sync import local_sha256
+from vsphere_guest_run.vsphere import CAPTURE_SINGLE
+from vsphere_guest_run.vsphere import RangeNotSupported
+
+PART_SIZE = 64 * 1024 * 1024
+PART_WORKERS = 4
+ASSEMBLE_SCRIPT = (
+    '%(check)scd %(dir)s && cat %(parts)s > %(tmp)s || '
+    '{ %(cleanup)s; exit 1; }; '
+    'digest=$(sha256sum < %(tmp)s | cut -c1-64); '
+    'if [ "$digest" != %(sha256)s ]; then %(cleanup)s; '
+    'echo "sha256 mismatch: $digest" >&2; exit 3; fi; '
+    'mv -f %(tmp)s %(target)s; rc=$?; %(cleanup)s; exit $rc')
+EXISTS_CHECK = ('if [ -e %(target)s ]; then %(cleanup)s; '
+                'echo "%(target)s exists" >&2; exit 4; fi; ')
+CLEANUP = 'cd / && rm -rf %(parts)s.vgr-parts-*'
+
+
+class PartsResult(object):
+    def __init__(self, size, parts, parts_sent, sha256):
+        self.size = size
+        self.parts = parts
+        self.parts_sent = parts_sent
+        self.sha256 = sha256
+
+    def __str__(self):
+        return '%s bytes in %s parts, %s transferred, %s resumed, sha256 ' \
+            '%s' % (self.size, self.parts, self.parts_sent,
+                    self.parts - self.parts_sent, self.sha256)
+
+
+class _FileRange(object):
+    """Binary file object reading length bytes of f from offset."""
+
+    def __init__(self, f, offset, length):
+        self.f = f
+        self.offset = offset
+        self.length = length
+        self.position = 0
+        f.seek(offset)
+
+    def __len__(self):
+        return self.length
+
+    def tell(self):
+        return self.position
+
+    def read(self, size=-1):
+        remaining = self.length - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        data = self.f.read(size)
+        self.position += len(data)
+        return data
+
+
+def _ranges(size, part_size):
+    """Return the (offset, length) of the parts of a file of size bytes."""
+    count = max(1, int(math.ceil(size / float(part_size))))
+    return [(n * part_size, min(part_size, size - n * part_size))
+            for n in range(count)]
+
+
+def _part_name(n):
+    return '%06d' % n
+
+
+def _run(vs, vm, user, password, script, callback):
+    result = vs.execute_program_in_guest(
+        vm,
+        user,
+        password,
+        script,
+        wait_for_completion=True,
+        get_output=True,
+        capture=CAPTURE_SINGLE,
+        callback=callback)
+    return result[0], result[1].decode(errors='replace'), \
+        result[2].decode(errors='replace')
+
+
+def _transfer(parts, transfer, max_workers, extra, callback):
+    """Run transfer(n, offset, length) for parts, max_workers at a time.
+
+    extra is run in the same pool, its future is returned. All the parts
+    are attempted even when some fail; the first error is then raised.
+    """
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers + 1) as executor:
+        extra_future = executor.submit(extra)
+        futures = {}
+        for n, offset, length in parts:
+            futures[executor.submit(transfer, n, offset, length)] = n
+        for done, future in enumerate(as_completed(futures)):
+            try:
+                future.result()
+            except Exception as e:
+                errors.append((futures[future], e))
+                continue
+            if callback is not None:
+                callback('part %s done (%s/%s)' % (futures[future], done + 1,
+                                                   len(futures)))
+    if len(errors) > 0:
+        raise Exception('%s of %s parts failed, run again to resume; part '
+                        '%s: %s' % (len(errors), len(futures), errors[0][0],
+                                    errors[0][1]))
+    return extra_future
+
+
+def upload_file_in_parts(vs,
+                         vm,
+                         user,
+                         password,
+                         local_file,
+                         remote_file,
+                         part_size=PART_SIZE,
+                         max_workers=PART_WORKERS,
+                         overwrite=False,
+                         callback=None):
+    """Upload a large local file to the guest as parts sent concurrently.
+
+    The parts are uploaded by max_workers concurrent transfers into a
+    directory next to remote_file, named after the local file, its size,
+    its modification time and part_size. One guest process concatenates
+    them, checks the sha256 of the result against the one of the local
+    file, computed while the parts are sent, and moves it to remote_file.
+    When a part fails, the parts already in the guest are kept and only
+    the missing ones, or the ones of the wrong size, are sent by the next
+    call with the same arguments. Once the guest process ran, whether it
+    succeeded or not, the parts directories of remote_file are removed,
+    including the ones left by earlier uploads of another version of the
+    file. Unless overwrite, an existing remote_file is reported before
+    sending anything. Requires sha256sum in the guest. Returns a
+    PartsResult.
+    """
+    if not overwrite:
+        try:
+            vs.get_file_info_in_guest(vm, user, password, remote_file)
+        except vim.fault.FileNotFound:
+            pass
+        else:
+            raise vim.fault.FileAlreadyExists(file=remote_file)
+    size = os.path.getsize(local_file)
+    key = '%s:%s:%s:%s' % (os.path.abspath(local_file), size,
+                           os.stat(local_file).st_mtime_ns, part_size)
+    parts_dir = '%s.vgr-parts-%s' % (
+        remote_file, hashlib.sha256(key.encode('utf-8')).hexdigest()[:16])
+    ranges = _ranges(size, part_size)
+    uploaded = {}
+    try:
+        for file_info in vs.iter_files_in_guest(vm, user, password,
+                                                parts_dir):
+            uploaded[file_info.path] = file_info.size
+    except vim.fault.FileNotFound:
+        vs.make_directory_in_guest(vm, user, password, parts_dir)
+    missing = [(n, offset, length)
+               for n, (offset, length) in enumerate(ranges)
+               if uploaded.get(_part_name(n)) != length]
+
+    def upload(n, offset, length):
+        with open(local_file, 'rb') as f:
+            vs.upload_file_to_guest(vm, user, password,
+                                    _FileRange(f, offset, length),
+                                    '%s/%s' % (parts_dir, _part_name(n)),
+                                    overwrite=True)
+
+    sha256 = _transfer(missing, upload, max_workers,
+                       lambda: local_sha256(local_file), callback).result()
+    cleanup = CLEANUP % {'parts': shlex.quote(remote_file)}
+    check = ''
+    if not overwrite:
+        check = EXISTS_CHECK % {
+            'target': shlex.quote(remote_file),
+            'cleanup': cleanup
+        }
+    rc, out, err = _run(
+        vs, vm, user, password, ASSEMBLE_SCRIPT % {
+            'check': check,
+            'dir': shlex.quote(parts_dir),
+            'parts': ' '.join(_part_name(n) for n in range(len(ranges))),
+            'tmp': shlex.quote('%s.vgr-tmp' % parts_dir),
+            'sha256': sha256,
+            'target': shlex.quote(remote_file),
+            'cleanup': cleanup
+        }, callback)
+    if rc != 0:
+        raise Exception('reassembly failed in guest with exit code %s: %s' %
+                        (rc, err.strip()))
+    return PartsResult(size, len(ranges), len(missing), sha256)
+
+
+def _load_state(path, state):
+    try:
+        with open(path, 'r') as f:
+            saved = json.load(f)
+    except (IOError, OSError, ValueError):
+        return []
+    if any(saved.get(key) != value for key, value in state.items()):
+        return []
+    return saved.get('done', [])
+
+
+def _save_state(path, state, done):
+    saved = dict(state)
+    saved['done'] = sorted(done)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(saved, f)
+    os.replace(path + '.tmp', path)
+
+
+def download_file_in_parts(vs,
+                           vm,
+                           user,
+                           password,
+                           remote_file,
+                           local_file,
+                           part_size=PART_SIZE,
+                           max_workers=PART_WORKERS,
+                           callback=None):
+    """Download a large guest file as parts fetched concurrently.
+
+    Each part is a byte range of remote_file, fetched by one of
+    max_workers concurrent transfers and written in place into
+    local_file + '.vgr-part'. The parts done are recorded in
+    local_file + '.vgr-parts', so that after a failure the next call
+    only fetches the missing ones, as long as the guest file has the same
+    size and modification time. Meanwhile one guest process computes the
+    sha256 of remote_file, which is checked against the local copy before
+    it is moved to local_file. Requires sha256sum in the guest. Returns a
+    PartsResult.
+
+    When the ESXi host ignores the byte ranges, the parts not started yet
+    are skipped and the file is downloaded as a single stream instead,
+    rather than reading it from the start once per part.
+    """
+    info = vs.get_file_info_in_guest(vm, user, password, remote_file)
+    size = info.size
+    modified = None
+    if info.attributes is not None and \
+            info.attributes.modificationTime is not None:
+        modified = info.attributes.modificationTime.isoformat()
+    state = {
+        'source': remote_file,
+        'size': size,
+        'modified': modified,
+        'part_size': part_size
+    }
+    data_file = local_file + '.vgr-part'
+    state_file = local_file + '.vgr-parts'
+    ranges = _ranges(size, part_size)
+    done = set()
+    if os.path.exists(data_file):
+        done = set(_load_state(state_file, state))
+    with open(data_file, 'r+b' if len(done) > 0 else 'wb') as f:
+        f.truncate(size)
+    missing = [(n, offset, length)
+               for n, (offset, length) in enumerate(ranges)
+               if n not in done and length > 0]
+    lock = threading.Lock()
+    whole = threading.Event()
+
+    def download(n, offset, length):
+        if whole.is_set():
+            return
+        with open(data_file, 'r+b') as f:
+            f.seek(offset)
+            try:
+                vs.download_range_from_guest(vm, user, password, remote_file,
+                                             f, offset, length)
+            except RangeNotSupported:
+                whole.set()
+                return
+            os.fsync(f.fileno())
+        with lock:
+            done.add(n)
+            _save_state(state_file, state, done)
+
+    def guest_sha256():
+        rc, out, err = _run(vs, vm, user, password,
+                            'sha256sum < %s' % shlex.quote(remote_file),
+                            callback)
+        if rc != 0:
+            raise Exception('sha256sum failed in guest: %s' % err.strip())
+        return out[:64]
+
+    expected = _transfer(missing, download, max_workers, guest_sha256,
+                         callback).result()
+    parts, parts_sent = len(ranges), len(missing)
+    if whole.is_set():
+        if callback is not None:
+            callback('byte ranges not supported, downloading %s as a single '
+                     'stream' % remote_file)
+        vs.download_file_to_local(vm, user, password, remote_file, data_file)
+        parts = parts_sent = 1
+    sha256 = local_sha256(data_file)
+    if sha256 != expected:
+        os.remove(data_file)
+        if os.path.exists(state_file):
+            os.remove(state_file)
+        raise Exception('sha256 mismatch for %s: %s, %s in guest' %
+                        (remote_file, sha256, expected))
+    os.replace(data_file, local_file)
+    if os.path.exists(state_file):
+        os.remove(state_file)
+    return PartsResult(size, parts, parts_sent, sha256)
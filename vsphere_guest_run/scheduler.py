@@ -0,0 +1,326 @@
+# vsphere-guest-run
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import contextlib
+import http.client
+from pyVmomi import vim
+from pyVmomi import vmodl
+import random
+import requests
+import threading
+import time
+
+RATE = 200
+BURST = 400
+HOST_RATE = 50
+HOST_BURST = 100
+VM_PROCESSES = 8
+MAX_RETRIES = 5
+RETRY_BASE = 0.25
+RETRY_MAX = 30
+RETRY_BUDGET = 0.2
+RETRY_BUDGET_BURST = 10
+BREAKER_THRESHOLD = 5
+BREAKER_RESET = 30
+
+REJECTED_FAULTS = (vim.fault.GuestOperationsUnavailable,
+                   vim.fault.TooManyGuestLogons, ConnectionRefusedError)
+TRANSIENT_FAULTS = (vmodl.fault.HostCommunication,
+                    vmodl.fault.HostNotConnected, vmodl.fault.RequestCanceled,
+                    ConnectionError, TimeoutError, http.client.HTTPException,
+                    requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout)
+# faults of one VM or of the ESXi host running it, vCenter itself answered
+GUEST_FAULTS = (vim.fault.GuestOperationsUnavailable,
+                vim.fault.TooManyGuestLogons, vmodl.fault.HostNotConnected,
+                vmodl.fault.HostCommunication)
+
+
+def is_rejected(e):
+    """Whether e means the server refused the call before acting on it."""
+    if isinstance(e, REJECTED_FAULTS):
+        return True
+    return isinstance(e, http.client.HTTPException) and \
+        str(e).startswith('503')
+
+
+def is_transient(e):
+    """Whether the call that raised e may succeed if retried later."""
+    return is_rejected(e) or isinstance(e, TRANSIENT_FAULTS)
+
+
+def is_host_failure(e):
+    """Whether e counts toward the circuit breaker of the host called.
+
+    The faults of a single VM, like a VM without running Tools, are
+    retried but do not open the circuit of the whole vCenter.
+    """
+    return is_transient(e) and not isinstance(e, GUEST_FAULTS)
+
+
+class TokenBucket(object):
+    """Allows rate calls per second on average, and bursts of burst calls.
+
+    A rate of None does not limit anything.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.timestamp = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available.
+
+        Returns the number of seconds slept.
+        """
+        if self.rate is None:
+            return 0
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens +
+                              (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= 1
+            delay = 0 if self.tokens >= 0 else -self.tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+class RetryBudget(object):
+    """Bounds the retries to a ratio of the calls made.
+
+    Every call deposits ratio tokens, up to burst, and every retry
+    withdraws one. When a host fails for everyone the retries add at most
+    ratio extra load instead of multiplying it, while a few isolated
+    failures can always be retried.
+    """
+
+    def __init__(self, ratio=RETRY_BUDGET, burst=RETRY_BUDGET_BURST):
+        self.ratio = ratio
+        self.burst = burst
+        self.balance = burst
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self.balance = min(self.balance + self.ratio, self.burst)
+
+    def withdraw(self):
+        with self._lock:
+            if self.balance < 1:
+                return False
+            self.balance -= 1
+            return True
+
+
+class CircuitBreaker(object):
+    """Stops calling a host after threshold consecutive failed calls.
+
+    The circuit stays open for reset seconds, then a single trial call is
+    let through; its success closes the circuit, its failure opens it
+    again.
+    """
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, reset=BREAKER_RESET):
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self._lock = threading.Lock()
+
+    def before(self, key):
+        with self._lock:
+            if self.opened is None:
+                return
+            remaining = self.opened + self.reset - time.time()
+            if remaining <= 0 and not self.trial:
+                self.trial = True
+                return
+        raise Exception('circuit open for %s after %s failures, retry in '
+                        '%.0f seconds' % (key, self.failures,
+                                          max(1, remaining)))
+
+    def is_open(self):
+        with self._lock:
+            return self.opened is not None
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.threshold:
+                self.opened = time.time()
+            self.trial = False
+
+
+class Scheduler(object):
+    """Rate limits, retries and circuit breakers for vSphere calls.
+
+    API calls to a vCenter (or ESXi) are limited by a token bucket of rate
+    calls per second per vCenter, file transfers by a token bucket of
+    host_rate per ESXi host. Calls failing with a transient error are
+    retried up to max_retries times after an exponential backoff with full
+    jitter, within a RetryBudget shared by all the calls. Each host has a
+    CircuitBreaker, to which a call failing with is_host_failure() counts
+    once however many times it is retried. At most vm_processes guest
+    processes run at the same time on a VM, VMs being keyed by vCenter
+    and moid since moids are only unique within a vCenter.
+
+    One Scheduler is shared by all the VSphere instances of the process
+    unless they are given their own.
+    """
+
+    def __init__(self,
+                 rate=RATE,
+                 burst=BURST,
+                 host_rate=HOST_RATE,
+                 host_burst=HOST_BURST,
+                 vm_processes=VM_PROCESSES,
+                 max_retries=MAX_RETRIES,
+                 retry_base=RETRY_BASE,
+                 retry_max=RETRY_MAX,
+                 budget=None,
+                 breaker_threshold=BREAKER_THRESHOLD,
+                 breaker_reset=BREAKER_RESET):
+        self.rate = rate
+        self.burst = burst
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.vm_processes = vm_processes
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.budget = budget if budget is not None else RetryBudget()
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.stats = {'calls': 0, 'retries': 0, 'throttled': 0.0}
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._breakers = {}
+        self._vm_slots = {}
+
+    def _get(self, table, key, factory):
+        with self._lock:
+            value = table.get(key)
+            if value is None:
+                value = factory()
+                table[key] = value
+            return value
+
+    def bucket(self, key, transfer=False):
+        if transfer:
+            return self._get(self._buckets, ('host', key),
+                             lambda: TokenBucket(self.host_rate,
+                                                 self.host_burst))
+        return self._get(self._buckets, ('vcenter', key),
+                         lambda: TokenBucket(self.rate, self.burst))
+
+    def breaker(self, key):
+        return self._get(self._breakers, key,
+                         lambda: CircuitBreaker(self.breaker_threshold,
+                                                self.breaker_reset))
+
+    def call(self, key, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs) on vCenter key, retrying transient errors.
+
+        Only for calls that can safely be repeated.
+        """
+        return self._call(key, False, is_transient, fn, args, kwargs)
+
+    def call_once(self, key, fn, *args, **kwargs):
+        """Like call(), but only retries errors raised before fn took effect.
+
+        For calls that must not be repeated, like StartProgramInGuest.
+        """
+        return self._call(key, False, is_rejected, fn, args, kwargs)
+
+    def transfer(self, key, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs) for a file transfer with ESXi host key.
+
+        Transfers are rate limited and stop on an open circuit, but not
+        retried: their URLs are single use and their data may be a stream.
+        """
+        return self._call(key, True, None, fn, args, kwargs)
+
+    def _call(self, key, transfer, retryable, fn, args, kwargs):
+        bucket = self.bucket(key, transfer)
+        breaker = self.breaker(key)
+        attempt = 0
+        counted = False
+        while True:
+            breaker.before(key)
+            throttled = bucket.acquire()
+            with self._lock:
+                self.stats['calls'] += 1
+                self.stats['throttled'] += throttled
+            self.budget.deposit()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                if not is_host_failure(e):
+                    breaker.success()
+                elif not counted:
+                    breaker.failure()
+                    counted = True
+                if retryable is None or not retryable(e) or \
+                        attempt >= self.max_retries or \
+                        breaker.is_open() or not self.budget.withdraw():
+                    raise
+                with self._lock:
+                    self.stats['retries'] += 1
+                time.sleep(self.backoff(attempt))
+                attempt += 1
+                continue
+            breaker.success()
+            return result
+
+    def backoff(self, attempt):
+        """Return the delay before retry attempt, with full jitter."""
+        return random.uniform(
+            0, min(self.retry_max, self.retry_base * 2**attempt))
+
+    def vm_slot(self, key, vm):
+        """Context manager holding one of the guest process slots of vm.
+
+        key is the vCenter of vm, as for call().
+        """
+        return _held(self.vm_semaphore(key, vm))
+
+    def vm_semaphore(self, key, vm):
+        """Return the semaphore of the guest process slots of vm."""
+        return self._get(
+            self._vm_slots, (key, getattr(vm, '_moId', vm)),
+            lambda: threading.BoundedSemaphore(self.vm_processes))
+
+
+@contextlib.contextmanager
+def _held(semaphore):
+    semaphore.acquire()
+    try:
+        yield
+    finally:
+        semaphore.release()
+
+
+_default_scheduler = None
+_default_lock = threading.Lock()
+
+
+def default_scheduler():
+    """Return the Scheduler shared by the VSphere instances."""
+    global _default_scheduler
+    with _default_lock:
+        if _default_scheduler is None:
+            _default_scheduler = Scheduler()
+        return _default_scheduler
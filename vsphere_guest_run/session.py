@@ -0,0 +1,56 @@
+# vsphere-guest-run
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+import hashlib
+import json
+import os
+
+SESSION_DIR = os.path.join(os.path.expanduser('~'), '.vgr', 'sessions')
+
+
+class SessionCache(object):
+    """Stores vCenter/ESXi session cookies on disk, keyed by user@host.
+
+    The directory is created with mode 0700 and each session file with
+    mode 0600, as a session cookie grants the same access as the password
+    used to obtain it.
+    """
+
+    def __init__(self, directory=SESSION_DIR):
+        self.directory = directory
+
+    def _path(self, user, host, port):
+        key = '%s@%s:%s' % (user, host, port)
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def load(self, user, host, port):
+        try:
+            with open(self._path(user, host, port), 'r') as f:
+                session = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if session.get('user') != user or session.get('host') != host:
+            return None
+        return session.get('cookie')
+
+    def save(self, user, host, port, cookie):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, mode=0o700)
+        path = self._path(user, host, port)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({
+                'user': user,
+                'host': host,
+                'port': port,
+                'cookie': cookie
+            }, f)
+
+    def delete(self, user, host, port):
+        try:
+            os.remove(self._path(user, host, port))
+            return True
+        except OSError:
+            return False
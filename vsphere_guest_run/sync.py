@@ -0,0 +1,297 @@
+# vsphere-guest-run
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+from concurrent.futures import as_completed
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import hashlib
+import os
+import posixpath
+from pyVmomi import vim
+import shlex
+
+from vsphere_guest_run.archive import download_archive_from_guest
+from vsphere_guest_run.archive import upload_archive_to_guest
+from vsphere_guest_run.vsphere import CAPTURE_SINGLE
+
+SYNC_WORKERS = 4
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class SyncReport(object):
+    def __init__(self):
+        self.files_sent = 0
+        self.bytes_sent = 0
+        self.files_skipped = 0
+        self.bytes_skipped = 0
+        self.errors = []
+
+    def __str__(self):
+        return ('%s files sent (%s bytes), %s files skipped (%s bytes), '
+                '%s errors' % (self.files_sent, self.bytes_sent,
+                               self.files_skipped, self.bytes_skipped,
+                               len(self.errors)))
+
+
+def local_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def guest_sha256(vs, vm, user, password, directory):
+    """Return {relative path: sha256} of the files under a guest directory.
+
+    The checksums are computed in the guest by a single process.
+    """
+    command = 'cd %s && find . -type f -exec sha256sum {} +' % \
+        shlex.quote(directory)
+    result = vs.execute_program_in_guest(
+        vm,
+        user,
+        password,
+        command,
+        wait_for_completion=True,
+        get_output=True,
+        capture=CAPTURE_SINGLE)
+    if result[0] != 0:
+        raise Exception('sha256sum failed in guest: %s' %
+                        result[2].decode(errors='replace'))
+    checksums = {}
+    for line in result[1].decode().splitlines():
+        digest, _, path = line.partition('  ')
+        checksums[posixpath.normpath(path)] = digest
+    return checksums
+
+
+def _remote_index(vs, vm, user, password, directory, max_workers):
+    index = {}
+    try:
+        for path, file_info in vs.walk_files_in_guest(
+                vm, user, password, directory, max_workers=max_workers):
+            index[posixpath.relpath(path, directory)] = file_info
+    except vim.fault.FileNotFound:
+        return None
+    return index
+
+
+def _local_index(directory):
+    """Return {relative path: stat} of what is under a local directory.
+
+    Symlinked directories are followed, unless they lead to a directory
+    already indexed, e.g. one of their parents.
+    """
+    index = {}
+    seen = set([os.path.realpath(directory)])
+    for root, dirs, files in os.walk(directory, followlinks=True):
+        for name in list(dirs):
+            real = os.path.realpath(os.path.join(root, name))
+            if real in seen:
+                dirs.remove(name)
+            else:
+                seen.add(real)
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, directory).replace(os.sep, '/')
+            index[rel] = os.stat(path)
+    return index
+
+
+def _same(size, mtime, other_size, other_mtime):
+    return size == other_size and int(mtime) == int(other_mtime)
+
+
+def sync_to_guest(vs,
+                  vm,
+                  user,
+                  password,
+                  local_dir,
+                  remote_dir,
+                  checksum=False,
+                  max_workers=SYNC_WORKERS,
+                  callback=None,
+                  archive=False):
+    """Copy the files of local_dir that differ to remote_dir in the guest.
+
+    Files are compared by size and modification time, which is set on the
+    guest copy at upload, or with checksum=True by size and a sha256
+    computed in the guest. Only the changed files are uploaded, with up to
+    max_workers transfers at the same time, or all together as a single
+    archive with archive=True. Returns a SyncReport.
+    """
+    report = SyncReport()
+    remote = _remote_index(vs, vm, user, password, remote_dir, max_workers)
+    if remote is None:
+        vs.make_directory_in_guest(vm, user, password, remote_dir)
+        remote = {}
+    checksums = {}
+    if checksum and len(remote) > 0:
+        checksums = guest_sha256(vs, vm, user, password, remote_dir)
+    local = _local_index(local_dir)
+    to_send = []
+    for rel in sorted(local):
+        st = local[rel]
+        path = os.path.join(local_dir, rel)
+        remote_path = posixpath.join(remote_dir, rel)
+        if os.path.isdir(path):
+            if rel not in remote:
+                vs.make_directory_in_guest(vm, user, password, remote_path)
+            continue
+        other = remote.get(rel)
+        if other is not None and other.type == 'file':
+            if checksum:
+                same = other.size == st.st_size and \
+                    checksums.get(rel) == local_sha256(path)
+            else:
+                same = _same(st.st_size, st.st_mtime, other.size,
+                             other.attributes.modificationTime.timestamp())
+            if same:
+                report.files_skipped += 1
+                report.bytes_skipped += st.st_size
+                continue
+        to_send.append((path, remote_path, st))
+
+    if archive:
+        _transfer_archive(to_send, upload_archive_to_guest, vs, vm, user,
+                          password, local_dir, remote_dir, report, callback)
+        return report
+
+    def upload(path, remote_path, st):
+        file_attribute = vim.vm.guest.FileManager.FileAttributes(
+            modificationTime=datetime.datetime.fromtimestamp(
+                st.st_mtime, datetime.timezone.utc))
+        vs.upload_local_file_to_guest(
+            vm,
+            user,
+            password,
+            path,
+            remote_path,
+            file_attribute=file_attribute,
+            overwrite=True)
+
+    _transfer(to_send, upload, max_workers, report, callback)
+    return report
+
+
+def sync_from_guest(vs,
+                    vm,
+                    user,
+                    password,
+                    remote_dir,
+                    local_dir,
+                    checksum=False,
+                    max_workers=SYNC_WORKERS,
+                    callback=None,
+                    archive=False):
+    """Copy the files of remote_dir in the guest that differ to local_dir.
+
+    The reverse of sync_to_guest(), the local copies get the modification
+    time of the guest files. Returns a SyncReport.
+    """
+    report = SyncReport()
+    remote = _remote_index(vs, vm, user, password, remote_dir, max_workers)
+    if remote is None:
+        raise Exception('directory not found in guest: %s' % remote_dir)
+    checksums = {}
+    if checksum:
+        checksums = guest_sha256(vs, vm, user, password, remote_dir)
+    if not os.path.isdir(local_dir):
+        os.makedirs(local_dir)
+    to_send = []
+    for rel in sorted(remote):
+        file_info = remote[rel]
+        path = os.path.join(local_dir, *rel.split('/'))
+        if file_info.type == 'directory':
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            continue
+        if file_info.type != 'file':
+            continue
+        mtime = file_info.attributes.modificationTime.timestamp()
+        if os.path.isfile(path):
+            st = os.stat(path)
+            if checksum:
+                same = file_info.size == st.st_size and \
+                    checksums.get(rel) == local_sha256(path)
+            else:
+                same = _same(file_info.size, mtime, st.st_size, st.st_mtime)
+            if same:
+                report.files_skipped += 1
+                report.bytes_skipped += file_info.size
+                continue
+        to_send.append((posixpath.join(remote_dir, rel), path, file_info))
+
+    if archive:
+        _transfer_archive(to_send, download_archive_from_guest, vs, vm, user,
+                          password, remote_dir, local_dir, report, callback)
+        return report
+
+    def download(remote_path, path, file_info):
+        tmp_path = '%s.vgr-tmp' % path
+        try:
+            vs.download_file_to_local(vm, user, password, remote_path,
+                                      tmp_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, path)
+        mtime = file_info.attributes.modificationTime.timestamp()
+        os.utime(path, (mtime, mtime))
+
+    _transfer(to_send, download, max_workers, report, callback)
+    return report
+
+
+def _transfer_archive(items, transfer, vs, vm, user, password, source_dir,
+                      target_dir, report, callback):
+    if len(items) == 0:
+        return
+    paths = [
+        os.path.relpath(source, source_dir).replace(os.sep, '/')
+        for source, target, info in items
+    ]
+    try:
+        result = transfer(
+            vs,
+            vm,
+            user,
+            password,
+            source_dir,
+            target_dir,
+            paths=paths,
+            callback=None)
+    except Exception as e:
+        report.errors.append((source_dir, e))
+        if callback is not None:
+            callback('error %s -> %s' % (source_dir, target_dir), e)
+        return
+    report.files_sent += result.files
+    report.bytes_sent += result.size
+    if callback is not None:
+        callback('%s -> %s (%s)' % (source_dir, target_dir, result))
+
+
+def _transfer(items, transfer, max_workers, report, callback):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for item in items:
+            futures[executor.submit(transfer, *item)] = item
+        for future in as_completed(futures):
+            source, target, info = futures[future]
+            size = info.st_size if isinstance(info, os.stat_result) \
+                else info.size
+            try:
+                future.result()
+            except Exception as e:
+                report.errors.append((source, e))
+                if callback is not None:
+                    callback('error %s -> %s' % (source, target), e)
+                continue
+            report.files_sent += 1
+            report.bytes_sent += size
+            if callback is not None:
+                callback('%s -> %s (%s bytes)' % (source, target, size))
@@ -0,0 +1,140 @@
+# vsphere-guest-run
+# Copyright (c) 2017 VMware, Inc. All Rights Reserved.
+# SPDX-License-Identifier: BSD-2-Clause
+
+from concurrent.futures import Future
+import threading
+
+MIN_INTERVAL = 0.05
+MAX_INTERVAL = 1
+BACKOFF = 1.5
+
+
+class ProcessTracker(object):
+    """Waits for guest processes to finish.
+
+    All the pids tracked on the same VM (with the same guest user) are
+    polled together with one ListProcessesInGuest call from a single
+    watcher thread. The poll interval starts at min_interval when a
+    process is added and grows by backoff after each poll up to
+    max_interval, so short commands are noticed within tens of
+    milliseconds and long running ones do not flood vCenter.
+
+    track() returns a Future that resolves to the GuestProcessInfo of the
+    process once its exitCode is set, its polls attribute counts the
+    ListProcessesInGuest calls that included the process. The polls are
+    made with call(fn, *args), e.g. Scheduler.call() to rate limit and
+    retry them; when a poll still fails, the futures of the polled pids
+    fail with its error.
+    """
+
+    def __init__(self,
+                 min_interval=MIN_INTERVAL,
+                 max_interval=MAX_INTERVAL,
+                 backoff=BACKOFF,
+                 call=None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.call = call or _call
+        self._lock = threading.Lock()
+        self._watchers = {}
+
+    def track(self, pm, vm, creds, pid, callback=None):
+        future = Future()
+        future.polls = 0
+        key = (vm._moId, creds.username)
+        with self._lock:
+            watcher = self._watchers.get(key)
+            if watcher is None:
+                watcher = _Watcher(self, key, pm, vm, creds)
+                self._watchers[key] = watcher
+                start = True
+            else:
+                start = False
+            watcher.add(pid, future, callback)
+        if start:
+            watcher.start()
+        return future
+
+    def pending(self):
+        with self._lock:
+            return sum(len(w.waiters) for w in self._watchers.values())
+
+    def _remove_if_idle(self, watcher):
+        with self._lock:
+            if len(watcher.waiters) == 0:
+                del self._watchers[watcher.key]
+                return True
+            return False
+
+
+class _Watcher(object):
+    def __init__(self, tracker, key, pm, vm, creds):
+        self.tracker = tracker
+        self.key = key
+        self.pm = pm
+        self.vm = vm
+        self.creds = creds
+        self.waiters = {}
+        self.interval = tracker.min_interval
+        self.wakeup = threading.Event()
+
+    def add(self, pid, future, callback):
+        self.waiters.setdefault(pid, []).append((future, callback))
+        self.interval = self.tracker.min_interval
+        self.wakeup.set()
+
+    def start(self):
+        thread = threading.Thread(
+            target=self.run, name='vgr-tracker-%s' % self.vm._moId)
+        thread.daemon = True
+        thread.start()
+
+    def run(self):
+        while not self.tracker._remove_if_idle(self):
+            self.wakeup.clear()
+            with self.tracker._lock:
+                pids = list(self.waiters.keys())
+                for waiters in self.waiters.values():
+                    for future, callback in waiters:
+                        future.polls += 1
+            try:
+                processes = self.tracker.call(self.pm.ListProcessesInGuest,
+                                              self.vm, self.creds, pids)
+            except Exception as e:
+                self.fail(pids, e)
+                continue
+            self.resolve(pids, processes)
+            self.wakeup.wait(self.interval)
+            self.interval = min(self.interval * self.tracker.backoff,
+                                self.tracker.max_interval)
+
+    def resolve(self, pids, processes):
+        found = {}
+        for process in processes:
+            found[process.pid] = process
+        for pid in pids:
+            process = found.get(pid)
+            if process is not None and process.exitCode is None:
+                continue
+            with self.tracker._lock:
+                waiters = self.waiters.pop(pid, [])
+            for future, callback in waiters:
+                if process is None:
+                    future.set_exception(
+                        Exception('process not found (pid=%s) (vm=%s)' %
+                                  (pid, self.vm)))
+                else:
+                    future.set_result(process)
+
+    def fail(self, pids, e):
+        for pid in pids:
+            with self.tracker._lock:
+                waiters = self.waiters.pop(pid, [])
+            for future, callback in waiters:
+                future.set_exception(e)
+
+
+def _call(fn, *args, **kwargs):
+    return fn(*args, **kwargs)
@@ -2,15 +2,16 @@
 # Copyright (c) 2017 VMware, Inc. All Rights Reserved.
 # SPDX-License-Identifier: BSD-2-Clause
 
+import base64
 import click
+import functools
 import json
-import pkg_resources
-from pygments import formatters
-from pygments import highlight
-from pygments import lexers
-import requests
-from tabulate import tabulate
-from vsphere_guest_run.vsphere import VSphere
+import os
+import posixpath
+from vsphere_guest_run.session import SessionCache
+
+# pyVmomi, requests and pygments are slow to import, they are imported
+# only by the commands that use them, see get_vsphere()
 
 CONTEXT_SETTINGS = dict(help_option_names=['-h', '--help'])
 
@@ -28,7 +29,7 @@ def abort_if_false(ctx, param, value):
     '-u',
     '--url',
     metavar='<user:pass@host>',
-    required=True,
+    required=False,
     envvar='VGR_URL',
     help='ESXi or vCenter URL')
 @click.option(
@@ -44,7 +45,41 @@ def abort_if_false(ctx, param, value):
     required=False,
     default=False,
     help='Do not display warnings when not verifying SSL ' + 'certificates')
-def vgr(ctx, debug, url, verify_ssl_certs, disable_warnings):
+@click.option(
+    '--verify-transfer-certs/--no-verify-transfer-certs',
+    default=None,
+    envvar='VGR_VERIFY_TRANSFER_CERTS',
+    help='Verify the SSL certificates of the ESXi hosts in file transfers, '
+    'like --verify-ssl-certs by default')
+@click.option(
+    '--session-cache/--no-session-cache',
+    required=False,
+    default=False,
+    envvar='VGR_SESSION_CACHE',
+    help='Reuse the vCenter session across invocations')
+@click.option(
+    '--inventory-max-age',
+    default=300,
+    metavar='<seconds>',
+    type=click.IntRange(min=0),
+    envvar='VGR_INVENTORY_MAX_AGE',
+    help='Max age of the cached inventory used to find VMs by name')
+@click.option(
+    '--trace',
+    is_flag=True,
+    default=False,
+    envvar='VGR_TRACE',
+    help='Print a per-phase timing breakdown to stderr at the end')
+@click.option(
+    'socket_path',
+    '--socket',
+    metavar='<path>',
+    envvar='VGR_SOCKET',
+    help='Send run, run-script, upload and download to the vgr serve '
+    'daemon listening on this Unix socket')
+def vgr(ctx, debug, url, verify_ssl_certs, disable_warnings,
+        verify_transfer_certs, session_cache, inventory_max_age, trace,
+        socket_path):
     """vSphere Guest Run
 
 \b
@@ -77,11 +112,35 @@ def vgr(ctx, debug, url, verify_ssl_certs, disable_warnings):
             If this environment variable is set, the command will use its value
             as the password to login on the guest. The --guest-password
             option has precedence over the environment variable.
+        VGR_VERIFY_TRANSFER_CERTS
+            If this environment variable is set to 'false', the
+            certificates of the ESXi hosts are not verified in file
+            transfers, for hosts with self-signed certificates behind a
+            vCenter with a valid one.
+        VGR_INVENTORY_MAX_AGE
+            VMs can be given by name or uuid instead of moid, they are
+            looked up in a local inventory cache which is refreshed when it
+            is older than this number of seconds (300 by default).
+        VGR_SESSION_CACHE
+            If this environment variable is set to 'true', the session
+            cookie is saved in ~/.vgr/sessions and reused by the next
+            commands until it expires or 'vgr logout' is run.
+        VGR_TRACE
+            If this environment variable is set to 'true', the time spent
+            in each phase (login, start, wait, output, cleanup, upload,
+            download...) with the API calls made and the bytes transferred
+            is printed to stderr when the command ends.
+        VGR_SOCKET
+            If this environment variable is set, run, run-script, upload
+            and download are sent to the 'vgr serve' daemon listening on
+            this Unix socket, which keeps its vCenter session logged in,
+            instead of connecting to the vCenter. The daemon resolves the
+            VMs, so --url is not needed. 'vgr serve' listens on it too.
     """  # NOQA
     if ctx.invoked_subcommand is None:
         click.secho(ctx.get_help())
         return
-    if not verify_ssl_certs:
+    if not verify_ssl_certs or verify_transfer_certs is False:
         if disable_warnings:
             pass
         else:
@@ -92,45 +151,243 @@ def vgr(ctx, debug, url, verify_ssl_certs, disable_warnings):
                 'advised.',
                 fg='yellow',
                 err=True)
-        requests.packages.urllib3.disable_warnings()
-    tokens = url.split(':')
-    vc_user = tokens[0]
-    tokens = tokens[1].split('@')
-    vc_host = tokens[-1]
-    vc_password = ''
-    for token in tokens[:-1]:
-        if len(vc_password) > 0:
-            vc_password += '@'
-        vc_password += token
-    vs = VSphere(vc_host, vc_user, vc_password, verify=verify_ssl_certs)
     ctx.obj = {}
-    ctx.obj['vs'] = vs
+    ctx.obj['vs'] = None
+    ctx.obj['vs_args'] = None
+    if url is not None:
+        tokens = url.split(':')
+        vc_user = tokens[0]
+        tokens = tokens[1].split('@')
+        vc_host = tokens[-1]
+        vc_password = ''
+        for token in tokens[:-1]:
+            if len(vc_password) > 0:
+                vc_password += '@'
+            vc_password += token
+        ctx.obj['vs_args'] = (vc_host, vc_user, vc_password)
+    ctx.obj['verify'] = verify_ssl_certs
+    ctx.obj['transfer_verify'] = verify_transfer_certs
+    ctx.obj['session_cache'] = session_cache
+    ctx.obj['inventory_max_age'] = inventory_max_age
+    ctx.obj['socket'] = socket_path
+    ctx.obj['inventory'] = None
+    ctx.call_on_close(functools.partial(close_inventory, ctx))
+    if trace:
+        ctx.call_on_close(functools.partial(print_trace, ctx))
+
+
+def get_vsphere(ctx):
+    """Return the VSphere of the command, created on first use."""
+    if ctx.obj['vs'] is None:
+        if ctx.obj['vs_args'] is None:
+            raise click.UsageError('Missing option "-u" / "--url".')
+        import requests
+        from vsphere_guest_run.vsphere import VSphere
+        if not ctx.obj['verify'] or ctx.obj['transfer_verify'] is False:
+            requests.packages.urllib3.disable_warnings()
+        ctx.obj['vs'] = VSphere(
+            *ctx.obj['vs_args'],
+            verify=ctx.obj['verify'],
+            transfer_verify=ctx.obj['transfer_verify'],
+            session_cache=SessionCache()
+            if ctx.obj['session_cache'] else None)
+    return ctx.obj['vs']
+
+
+def submit(ctx, job):
+    """Run job on the vgr serve daemon, printing its output."""
+    from vsphere_guest_run.daemon import submit
+    return submit(
+        ctx.obj['socket'],
+        job,
+        stdout=click.get_binary_stream('stdout'),
+        stderr=click.get_binary_stream('stderr'))
+
+
+def print_trace(ctx):
+    vs = ctx.obj['vs']
+    if vs is None:
+        return
+    rows = vs.metrics.summary()
+    if len(rows) == 0:
+        return
+    line = '%-12s %6s %10s %10s %10s %6s %12s %6s'
+    click.echo(
+        line % ('phase', 'count', 'total(s)', 'mean(ms)', 'max(ms)', 'calls',
+                'bytes', 'errors'),
+        err=True)
+    for row in rows:
+        click.echo(
+            line % (row['phase'], row['count'], '%.3f' % row['seconds'],
+                    '%.1f' % (row['mean'] * 1000),
+                    '%.1f' % (row['max'] * 1000), row['calls'], row['bytes'],
+                    row['errors']),
+            err=True)
+    totals = {}
+    for key in ('count', 'seconds', 'calls', 'bytes', 'errors'):
+        totals[key] = sum(row[key] for row in rows)
+    click.echo(
+        line % ('total', totals['count'], '%.3f' % totals['seconds'], '', '',
+                totals['calls'], totals['bytes'], totals['errors']),
+        err=True)
+    stats = vs.scheduler.stats
+    if stats['retries'] > 0 or stats['throttled'] > 0:
+        click.echo(
+            '%s API calls retried, %.3fs throttled by the rate limits' %
+            (stats['retries'], stats['throttled']),
+            err=True)
+
+
+def load_inventory(ctx, refresh=False):
+    """Return the VM inventory.
+
+    The on-disk snapshot is used while it is fresh. Otherwise the
+    inventory is loaded and kept open until the command ends, e.g. for the
+    life of 'vgr serve', and the next refreshes, once it is older than the
+    max age or with refresh, apply only the changes since.
+    """
+    from vsphere_guest_run.inventory import Inventory
+    from vsphere_guest_run.inventory import INVENTORY_PROPERTIES
+    from vsphere_guest_run.inventory import snapshot_path
+    vs = get_vsphere(ctx)
+    path = snapshot_path(vs.user, vs.host, vs.port)
+    inventory = ctx.obj['inventory']
+    if inventory is None and not refresh:
+        inventory = Inventory.from_snapshot(path)
+        if inventory is not None and \
+                inventory.path_set != INVENTORY_PROPERTIES:
+            inventory = None
+        ctx.obj['inventory'] = inventory
+    if inventory is not None and not refresh and \
+            inventory.age() is not None and \
+            inventory.age() <= ctx.obj['inventory_max_age']:
+        return inventory
+    if inventory is not None and inventory.is_open():
+        try:
+            inventory.update(timeout=0)
+        except Exception:
+            # e.g. the session the inventory was loaded with expired
+            close_inventory(ctx)
+        else:
+            inventory.save(path)
+            return inventory
+    if vs.service_instance is None:
+        vs.connect()
+    inventory = Inventory(vs)
+    try:
+        inventory.load()
+    except Exception:
+        inventory.close()
+        raise
+    ctx.obj['inventory'] = inventory
+    inventory.save(path)
+    return inventory
+
+
+def close_inventory(ctx):
+    """Release the server-side objects of the command inventory, if any."""
+    inventory = ctx.obj['inventory']
+    ctx.obj['inventory'] = None
+    if inventory is not None:
+        try:
+            inventory.close()
+        except Exception:
+            pass
+
+
+def find_vm(ctx, vm_id):
+    """Return the inventory entry of the VM given by moid, name or uuid."""
+    inventory = load_inventory(ctx)
+    moids = inventory.find(vm_id)
+    if len(moids) == 0:
+        inventory = load_inventory(ctx, refresh=True)
+        moids = inventory.find(vm_id)
+    if len(moids) != 1:
+        raise click.UsageError('%s VMs found with moid, name or uuid: %s' %
+                               (len(moids), vm_id))
+    return inventory.get(moids[0])
+
+
+def get_vm(ctx, vm_id):
+    """Return the VM with vm_id as moid, or as name or uuid."""
+    from vsphere_guest_run.inventory import MOID_PATTERN
+    vs = get_vsphere(ctx)
+    if MOID_PATTERN.match(vm_id):
+        return vs.get_vm_by_moid(vm_id)
+    return vs.get_vm_by_moid(find_vm(ctx, vm_id)['moid'])
 
 
 @vgr.command(short_help='show info')
 @click.pass_context
-@click.argument('vm-moid', required=False)
-def info(ctx, vm_moid):
-    """Show info"""
-    vs = ctx.obj['vs']
-    vs.connect()
-    if vm_moid is None:
+@click.argument('vm_moids', metavar='[vm-moid]...', nargs=-1)
+def info(ctx, vm_moids):
+    """Show info
+
+\b
+    Without arguments, shows info about the vCenter or ESXi host. With
+    one or more VMs, shows their info from the local inventory cache,
+    see --inventory-max-age.
+    """
+    from pygments import formatters
+    from pygments import highlight
+    from pygments import lexers
+    from vsphere_guest_run.inventory import INVENTORY_PROPERTIES
+    vs = get_vsphere(ctx)
+    if len(vm_moids) == 0:
+        vs.connect()
         click.secho('URL: %s:*******@%s' % (vs.user, vs.host))
         click.secho('%s' % vs.service_instance.content.about)
     else:
-        vm = vs.get_vm_by_moid(vm_moid)
+        result = []
+        for vm_moid in vm_moids:
+            vm = find_vm(ctx, vm_moid)
+            result.append({
+                key: vm.get(key)
+                for key in ['moid'] + INVENTORY_PROPERTIES
+            })
+        if len(result) == 1:
+            result = result[0]
         click.echo(
             highlight(
-                json.dumps(vs.vm_to_dict(vm), indent=4, sort_keys=True),
+                json.dumps(result, indent=4, sort_keys=True),
                 lexers.JsonLexer(), formatters.TerminalFormatter()))
 
 
+@vgr.command(short_help='logout and clear the cached session')
+@click.pass_context
+def logout(ctx):
+    """Logout and clear the cached session"""
+    vs = get_vsphere(ctx)
+    if vs.session_cache is None:
+        vs.session_cache = SessionCache()
+    vs.logout()
+    click.secho('logged out')
+
+
 @vgr.command(short_help='show version')
 @click.pass_context
 def version(ctx):
     """Show version"""
-    ver = pkg_resources.require("vsphere-guest-run")[0].version
-    click.secho(ver)
+    try:
+        from importlib.metadata import PackageNotFoundError
+        from importlib.metadata import version as package_version
+    except ImportError:
+        import pkg_resources
+        PackageNotFoundError = pkg_resources.DistributionNotFound
+
+        def package_version(name):
+            return pkg_resources.get_distribution(name).version
+
+    try:
+        click.secho(package_version('vsphere-guest-run'))
+    except PackageNotFoundError:
+        click.secho('unknown')
+
+
+def output_bytes(output):
+    if isinstance(output, bytes):
+        return output
+    return output.content
 
 
 def print_command(cmd, level=0):
@@ -178,14 +435,44 @@ def help(ctx, tree):
     metavar='<rm-cmd>',
     envvar='VGR_RM_CMD',
     help='rm cmd')
+@click.option(
+    'capture',
+    '-c',
+    '--capture',
+    type=click.Choice(['files', 'single']),
+    default='files',
+    envvar='VGR_CAPTURE',
+    help='Collect output in two files, or in one framed file fetched with '
+    'a single transfer')
+@click.option(
+    'follow',
+    '-f',
+    '--follow',
+    is_flag=True,
+    default=False,
+    help='Print the output while the command runs, implies --capture files')
 @click.argument('command')
-def run(ctx, vm_moid, guest_user, guest_password, command, rm_cmd):
+def run(ctx, vm_moid, guest_user, guest_password, command, rm_cmd, capture,
+        follow):
     try:
-        vs = ctx.obj['vs']
+        if ctx.obj['socket'] is not None:
+            result = submit(
+                ctx, {
+                    'op': 'run',
+                    'vm': vm_moid,
+                    'guest_user': guest_user,
+                    'guest_password': guest_password,
+                    'command': command,
+                    'rm_cmd': rm_cmd,
+                    'capture': capture,
+                    'follow': follow
+                })
+            ctx.exit(result['exit_code'])
+        vs = get_vsphere(ctx)
         vs.connect()
         if vm_moid is None:
             pass
-        vm = vs.get_vm_by_moid(vm_moid)
+        vm = get_vm(ctx, vm_moid)
         result = vs.execute_program_in_guest(
             vm,
             guest_user,
@@ -194,14 +481,14 @@ def run(ctx, vm_moid, guest_user, guest_password, command, rm_cmd):
             wait_for_completion=True,
             wait_time=1,
             get_output=True,
-            rm_cmd=rm_cmd)
-        stdout = result[1].content.decode()
-        stderr = result[2].content.decode()
-        if len(stderr) > 0:
-            click.secho(stderr, err=True)
-        if len(stdout) > 0:
-            click.secho(stdout, err=False)
+            rm_cmd=rm_cmd,
+            stdout=click.get_binary_stream('stdout'),
+            stderr=click.get_binary_stream('stderr'),
+            capture=capture,
+            follow=follow)
         ctx.exit(result[0])
+    except click.exceptions.Exit:
+        raise
     except Exception as e:
         import traceback
         traceback.print_exc()
@@ -210,16 +497,51 @@ def run(ctx, vm_moid, guest_user, guest_password, command, rm_cmd):
 
 @vgr.command('list', short_help='list VMs')
 @click.pass_context
-def list_cmd(ctx):
-    """List VMs"""
-    vs = ctx.obj['vs']
+@click.option(
+    'page_size',
+    '--page-size',
+    default=1000,
+    metavar='<n>',
+    type=click.IntRange(min=1),
+    help='Number of VMs retrieved per request')
+@click.option(
+    '-c',
+    '--cached',
+    is_flag=True,
+    default=False,
+    help='List the VMs from the local inventory cache')
+@click.option(
+    'state',
+    '--state',
+    metavar='<guest-state>',
+    help='Only list the VMs with this guest state, e.g. running, from the '
+    'local inventory cache')
+def list_cmd(ctx, page_size, cached, state):
+    """List VMs
+
+\b
+    VMs are printed as they are retrieved, one page at a time.
+    """
+    vs = get_vsphere(ctx)
+    row = '%-50s  %-10s  %s'
+    click.secho(row % ('name', 'moid', 'state'))
+    click.secho(row % ('-' * 50, '-' * 10, '-' * 10))
+    if cached or state is not None:
+        inventory = load_inventory(ctx)
+        if state is None:
+            vms = inventory.list()
+        else:
+            vms = [inventory.get(moid)
+                   for moid in inventory.find_by_state(state)]
+        for vm in sorted(vms, key=lambda vm: vm['name']):
+            click.secho(row % (vm['name'], vm['moid'],
+                               vm.get('guest.guestState')))
+        return
     vs.connect()
-    vm_data = vs.list_vms()
-    headers = ['name', 'moid', 'state']
-    table = []
-    for vm in vm_data:
-        table.append([vm['name'], vm['obj']._moId, vm['guest.guestState']])
-    click.secho(tabulate(table, headers=headers))
+    for vm in vs.iter_vms(
+            path_set=['name', 'guest.guestState'], page_size=page_size):
+        click.secho(row % (vm['name'], vm['obj']._moId,
+                           vm.get('guest.guestState')))
 
 
 @vgr.command('run-script', short_help='run script in guest')
@@ -252,36 +574,647 @@ def list_cmd(ctx):
     metavar='<rm-cmd>',
     envvar='VGR_RM_CMD',
     help='rm cmd')
-def run_script(ctx, vm_moid, script_file, guest_user, guest_password, rm_cmd):
+@click.option(
+    'capture',
+    '-c',
+    '--capture',
+    type=click.Choice(['files', 'single']),
+    default='files',
+    envvar='VGR_CAPTURE',
+    help='Collect output in two files, or in one framed file fetched with '
+    'a single transfer')
+@click.option(
+    'follow',
+    '-f',
+    '--follow',
+    is_flag=True,
+    default=False,
+    help='Print the output while the command runs, implies --capture files')
+def run_script(ctx, vm_moid, script_file, guest_user, guest_password, rm_cmd,
+               capture, follow):
     try:
-        vs = ctx.obj['vs']
+        if ctx.obj['socket'] is not None:
+            with open(script_file, 'rb') as f:
+                script = base64.b64encode(f.read()).decode('ascii')
+            result = submit(
+                ctx, {
+                    'op': 'script',
+                    'vm': vm_moid,
+                    'guest_user': guest_user,
+                    'guest_password': guest_password,
+                    'script': script,
+                    'rm_cmd': rm_cmd,
+                    'capture': capture,
+                    'follow': follow
+                })
+            ctx.exit(result['exit_code'])
+        vs = get_vsphere(ctx)
         vs.connect()
         if vm_moid is None:
             pass
-        vm = vs.get_vm_by_moid(vm_moid)
-        with open(script_file, 'r') as f:
-            content = f.read()
-        result = vs.execute_script_in_guest(
+        vm = get_vm(ctx, vm_moid)
+        with open(script_file, 'rb') as f:
+            result = vs.execute_script_in_guest(
+                vm,
+                guest_user,
+                guest_password,
+                f,
+                target_file=None,
+                wait_for_completion=True,
+                wait_time=1,
+                get_output=True,
+                rm_cmd=rm_cmd,
+                stdout=click.get_binary_stream('stdout'),
+                stderr=click.get_binary_stream('stderr'),
+                capture=capture,
+                follow=follow)
+        ctx.exit(result[0])
+    except click.exceptions.Exit:
+        raise
+    except Exception as e:
+        import traceback
+        traceback.print_exc()
+        click.secho(str(e))
+
+
+@vgr.command(short_help='upload file to guest')
+@click.pass_context
+@click.argument('vm_moid', metavar='<vm-moid>', envvar='VGR_VM_MOID')
+@click.argument(
+    'local_file',
+    type=click.Path(exists=True, dir_okay=False),
+    metavar='<local-file>')
+@click.argument('remote_file', metavar='<remote-file>')
+@click.option(
+    'guest_user',
+    '-g',
+    '--guest-user',
+    metavar='<guest-user>',
+    envvar='VGR_GUEST_USER',
+    help='Guest OS user name')
+@click.option(
+    'guest_password',
+    '-p',
+    '--guest-password',
+    metavar='<guest-password>',
+    envvar='VGR_GUEST_PASSWORD',
+    help='Guest OS password')
+@click.option(
+    'parallel',
+    '-P',
+    '--parallel',
+    default=1,
+    metavar='<n>',
+    type=click.IntRange(min=1),
+    help='Transfer the file as parts, <n> at a time, verified with sha256 '
+    'and resumable')
+@click.option(
+    'part_size',
+    '--part-size',
+    default=64,
+    metavar='<MB>',
+    type=click.IntRange(min=1),
+    help='Size of the parts with --parallel')
+def upload(ctx, vm_moid, local_file, remote_file, guest_user, guest_password,
+           parallel, part_size):
+    """Upload a local file to the guest, streaming it from disk
+
+\b
+    With --parallel, the file is sent as parts of --part-size MB, several
+    at a time, reassembled and checked with sha256sum in the guest. When
+    the upload fails, running the same command again only sends the
+    parts missing in the guest. Parts are faster only when a single
+    transfer cannot fill the link to the ESXi host.
+    """
+    if ctx.obj['socket'] is not None:
+        submit(
+            ctx, {
+                'op': 'upload',
+                'vm': vm_moid,
+                'guest_user': guest_user,
+                'guest_password': guest_password,
+                'local_file': os.path.abspath(local_file),
+                'remote_file': remote_file,
+                'parallel': parallel,
+                'part_size': part_size
+            })
+        return
+    vs = get_vsphere(ctx)
+    vs.connect()
+    vm = get_vm(ctx, vm_moid)
+    if parallel > 1:
+        from vsphere_guest_run.parts import upload_file_in_parts
+        result = upload_file_in_parts(
+            vs,
             vm,
             guest_user,
             guest_password,
-            content,
-            target_file=None,
-            wait_for_completion=True,
+            local_file,
+            remote_file,
+            part_size=part_size * 1024 * 1024,
+            max_workers=parallel)
+        click.secho(str(result), err=True)
+        return
+    vs.upload_local_file_to_guest(vm, guest_user, guest_password, local_file,
+                                  remote_file)
+
+
+@vgr.command(short_help='download file from guest')
+@click.pass_context
+@click.argument('vm_moid', metavar='<vm-moid>', envvar='VGR_VM_MOID')
+@click.argument('remote_file', metavar='<remote-file>')
+@click.argument(
+    'local_file', type=click.Path(dir_okay=False), metavar='<local-file>')
+@click.option(
+    'guest_user',
+    '-g',
+    '--guest-user',
+    metavar='<guest-user>',
+    envvar='VGR_GUEST_USER',
+    help='Guest OS user name')
+@click.option(
+    'guest_password',
+    '-p',
+    '--guest-password',
+    metavar='<guest-password>',
+    envvar='VGR_GUEST_PASSWORD',
+    help='Guest OS password')
+@click.option(
+    'parallel',
+    '-P',
+    '--parallel',
+    default=1,
+    metavar='<n>',
+    type=click.IntRange(min=1),
+    help='Transfer the file as parts, <n> at a time, verified with sha256 '
+    'and resumable')
+@click.option(
+    'part_size',
+    '--part-size',
+    default=64,
+    metavar='<MB>',
+    type=click.IntRange(min=1),
+    help='Size of the parts with --parallel')
+def download(ctx, vm_moid, remote_file, local_file, guest_user,
+             guest_password, parallel, part_size):
+    """Download a file from the guest, use - as <local-file> for stdout
+
+\b
+    With --parallel, the file is fetched as byte ranges of --part-size
+    MB, several at a time, written in place and checked against the
+    sha256sum of the file in the guest. When the download fails, running
+    the same command again only fetches the parts not yet received. Parts
+    are faster only when a single transfer cannot fill the link to the
+    ESXi host; a host that ignores byte ranges gets a single stream.
+    """
+    if parallel > 1 and local_file == '-':
+        raise click.UsageError('--parallel needs a <local-file>')
+    if ctx.obj['socket'] is not None:
+        submit(
+            ctx, {
+                'op': 'download',
+                'vm': vm_moid,
+                'guest_user': guest_user,
+                'guest_password': guest_password,
+                'remote_file': remote_file,
+                'local_file':
+                None if local_file == '-' else os.path.abspath(local_file),
+                'parallel': parallel,
+                'part_size': part_size
+            })
+        return
+    vs = get_vsphere(ctx)
+    vs.connect()
+    vm = get_vm(ctx, vm_moid)
+    if parallel > 1:
+        from vsphere_guest_run.parts import download_file_in_parts
+        result = download_file_in_parts(
+            vs,
+            vm,
+            guest_user,
+            guest_password,
+            remote_file,
+            local_file,
+            part_size=part_size * 1024 * 1024,
+            max_workers=parallel)
+        click.secho(str(result), err=True)
+        return
+    if local_file == '-':
+        local_file = click.get_binary_stream('stdout')
+    vs.download_file_to_local(vm, guest_user, guest_password, remote_file,
+                              local_file)
+
+
+@vgr.command('ls', short_help='list files in guest')
+@click.pass_context
+@click.argument('vm_moid', metavar='<vm-moid>', envvar='VGR_VM_MOID')
+@click.argument('path', metavar='<path>')
+@click.option(
+    'guest_user',
+    '-g',
+    '--guest-user',
+    metavar='<guest-user>',
+    envvar='VGR_GUEST_USER',
+    help='Guest OS user name')
+@click.option(
+    'guest_password',
+    '-p',
+    '--guest-password',
+    metavar='<guest-password>',
+    envvar='VGR_GUEST_PASSWORD',
+    help='Guest OS password')
+@click.option(
+    '-R',
+    '--recursive',
+    is_flag=True,
+    default=False,
+    help='List subdirectories recursively')
+@click.option(
+    'max_workers',
+    '-j',
+    '--workers',
+    default=8,
+    metavar='<n>',
+    type=click.IntRange(min=1),
+    help='Max number of directories listed at the same time')
+def ls_cmd(ctx, vm_moid, path, guest_user, guest_password, recursive,
+           max_workers):
+    """List files in guest
+
+\b
+    Lists all the entries of the directory, with -R the whole tree is
+    listed with several directories listed concurrently.
+    """
+    vs = get_vsphere(ctx)
+    vs.connect()
+    vm = get_vm(ctx, vm_moid)
+    if recursive:
+
+        def onerror(directory, e):
+            click.secho('%s: %s' % (directory, e), fg='red', err=True)
+
+        files = vs.walk_files_in_guest(
+            vm,
+            guest_user,
+            guest_password,
+            path,
+            max_workers=max_workers,
+            onerror=onerror)
+    else:
+        files = ((posixpath.join(path, f.path), f)
+                 for f in vs.iter_files_in_guest(vm, guest_user,
+                                                 guest_password, path))
+    for file_path, f in files:
+        click.secho('%-9s %12s %s %s' %
+                    (f.type, f.size, f.attributes.modificationTime,
+                     file_path))
+
+
+@vgr.command(short_help='sync a directory to or from guest')
+@click.pass_context
+@click.argument('vm_moid', metavar='<vm-moid>', envvar='VGR_VM_MOID')
+@click.argument('source', metavar='<source-dir>')
+@click.argument('target', metavar='<target-dir>')
+@click.option(
+    'guest_user',
+    '-g',
+    '--guest-user',
+    metavar='<guest-user>',
+    envvar='VGR_GUEST_USER',
+    help='Guest OS user name')
+@click.option(
+    'guest_password',
+    '-p',
+    '--guest-password',
+    metavar='<guest-password>',
+    envvar='VGR_GUEST_PASSWORD',
+    help='Guest OS password')
+@click.option(
+    '--pull',
+    is_flag=True,
+    default=False,
+    help='Copy from <source-dir> in the guest to local <target-dir>')
+@click.option(
+    '--checksum',
+    is_flag=True,
+    default=False,
+    help='Compare files by sha256 instead of modification time')
+@click.option(
+    '-a',
+    '--archive',
+    is_flag=True,
+    default=False,
+    help='Transfer the changed files as a single compressed archive, '
+    'faster for many small files')
+@click.option(
+    'max_workers',
+    '-j',
+    '--workers',
+    default=4,
+    metavar='<n>',
+    type=click.IntRange(min=1),
+    help='Max number of files transferred at the same time')
+@click.option(
+    '-v', '--verbose', is_flag=True, default=False, help='Print each file')
+def sync(ctx, vm_moid, source, target, guest_user, guest_password, pull,
+         checksum, archive, max_workers, verbose):
+    """Sync a directory to or from guest
+
+\b
+    Copies only the files that changed, by default from local
+    <source-dir> to <target-dir> in the guest.
+\b
+    Examples
+        vgr sync vm-111 ./conf /etc/myapp
+        vgr sync --pull vm-111 /var/log/myapp ./logs
+    """
+    from vsphere_guest_run.sync import sync_from_guest
+    from vsphere_guest_run.sync import sync_to_guest
+    vs = get_vsphere(ctx)
+    vs.connect()
+    vm = get_vm(ctx, vm_moid)
+
+    def callback(message, exception=None):
+        if exception is not None:
+            click.secho('%s: %s' % (message, exception), fg='red', err=True)
+        elif verbose:
+            click.secho(message)
+
+    if pull:
+        report = sync_from_guest(
+            vs,
+            vm,
+            guest_user,
+            guest_password,
+            source,
+            target,
+            checksum=checksum,
+            max_workers=max_workers,
+            callback=callback,
+            archive=archive)
+    else:
+        if not os.path.isdir(source):
+            raise click.BadParameter('not a directory: %s' % source)
+        report = sync_to_guest(
+            vs,
+            vm,
+            guest_user,
+            guest_password,
+            source,
+            target,
+            checksum=checksum,
+            max_workers=max_workers,
+            callback=callback,
+            archive=archive)
+    click.secho(str(report))
+    ctx.exit(0 if len(report.errors) == 0 else 1)
+
+
+@vgr.command('run-many', short_help='run command in guest of many VMs')
+@click.pass_context
+@click.option(
+    'vm_moids',
+    '-m',
+    '--vm',
+    metavar='<vm-moid>',
+    multiple=True,
+    help='VM to run the command on, can be repeated')
+@click.option(
+    'name_pattern',
+    '-n',
+    '--name',
+    metavar='<regex>',
+    help='Run the command on all VMs whose name matches')
+@click.option(
+    'guest_user',
+    '-g',
+    '--guest-user',
+    metavar='<guest-user>',
+    envvar='VGR_GUEST_USER',
+    help='Guest OS user name')
+@click.option(
+    'guest_password',
+    '-p',
+    '--guest-password',
+    metavar='<guest-password>',
+    envvar='VGR_GUEST_PASSWORD',
+    help='Guest OS password')
+@click.option(
+    'rm_cmd',
+    '-r',
+    '--rm',
+    default='/bin/rm',
+    metavar='<rm-cmd>',
+    envvar='VGR_RM_CMD',
+    help='rm cmd')
+@click.option(
+    'max_workers',
+    '-j',
+    '--workers',
+    default=16,
+    metavar='<n>',
+    type=click.IntRange(min=1),
+    help='Max number of VMs to run the command on at the same time')
+@click.option(
+    'capture',
+    '-c',
+    '--capture',
+    type=click.Choice(['files', 'single']),
+    default='files',
+    envvar='VGR_CAPTURE',
+    help='Collect output in two files, or in one framed file fetched with '
+    'a single transfer')
+@click.argument('command')
+def run_many(ctx, vm_moids, name_pattern, guest_user, guest_password, rm_cmd,
+             max_workers, capture, command):
+    """Run command in guest of many VMs
+
+\b
+    Runs the command concurrently on every VM given with --vm and every
+    VM whose name matches --name. The output of each VM is printed as
+    soon as it finishes, followed by a summary.
+\b
+    Examples
+        vgr run-many -m vm-111 -m vm-112 /bin/date
+        vgr run-many -n '^web-' -j 32 '/bin/uname -a'
+    """
+    vs = get_vsphere(ctx)
+    vs.connect()
+    vms = [get_vm(ctx, vm_id) for vm_id in vm_moids]
+    if name_pattern is not None:
+        moids = set(vm._moId for vm in vms)
+        for vm in vs.find_vms(name_pattern):
+            if vm._moId not in moids:
+                moids.add(vm._moId)
+                vms.append(vm)
+    if len(vms) == 0:
+        raise click.UsageError('no VMs selected, use --vm or --name')
+    succeeded = []
+    failed = []
+    errors = []
+    for vm, result, e in vs.execute_program_in_guests(
+            vms,
+            guest_user,
+            guest_password,
+            command,
+            max_workers=max_workers,
             wait_time=1,
             get_output=True,
-            rm_cmd=rm_cmd)
-        stdout = result[1].content.decode()
-        stderr = result[2].content.decode()
+            rm_cmd=rm_cmd,
+            capture=capture):
+        if e is not None:
+            errors.append(vm._moId)
+            click.secho('%s: error: %s' % (vm._moId, e), fg='red', err=True)
+            continue
+        if result[0] == 0:
+            succeeded.append(vm._moId)
+        else:
+            failed.append(vm._moId)
+        click.secho('%s: exit code %s' % (vm._moId, result[0]), bold=True)
+        stdout = output_bytes(result[1]).decode()
+        stderr = output_bytes(result[2]).decode()
         if len(stderr) > 0:
             click.secho(stderr, err=True)
         if len(stdout) > 0:
             click.secho(stdout, err=False)
-        ctx.exit(result[0])
-    except Exception as e:
-        import traceback
-        traceback.print_exc()
-        click.secho(str(e))
+    click.secho('%s VMs: %s succeeded, %s failed, %s errors' %
+                (len(vms), len(succeeded), len(failed), len(errors)))
+    if len(failed) > 0:
+        click.secho('failed: %s' % ' '.join(failed))
+    if len(errors) > 0:
+        click.secho('errors: %s' % ' '.join(errors))
+    ctx.exit(0 if len(failed) + len(errors) == 0 else 1)
+
+
+@vgr.command('run-batch', short_help='run many commands in guest at once')
+@click.pass_context
+@click.argument('vm_moid', metavar='<vm-moid>', envvar='VGR_VM_MOID')
+@click.argument(
+    'commands_file', type=click.File('r'), metavar='<commands-file>')
+@click.option(
+    'guest_user',
+    '-g',
+    '--guest-user',
+    metavar='<guest-user>',
+    envvar='VGR_GUEST_USER',
+    help='Guest OS user name')
+@click.option(
+    'guest_password',
+    '-p',
+    '--guest-password',
+    metavar='<guest-password>',
+    envvar='VGR_GUEST_PASSWORD',
+    help='Guest OS password')
+@click.option(
+    'stop_on_error',
+    '-e',
+    '--stop-on-error',
+    is_flag=True,
+    default=False,
+    help='Do not run the commands after the first failing one')
+@click.option(
+    'as_json',
+    '--json',
+    is_flag=True,
+    default=False,
+    help='Print the results as JSON')
+def run_batch(ctx, vm_moid, commands_file, guest_user, guest_password,
+              stop_on_error, as_json):
+    """Run many commands in guest at once
+
+\b
+    Runs the commands of <commands-file> (- for stdin), one per line,
+    blank lines and lines starting with # ignored, one after the other in
+    a single guest process, and prints the exit code, duration and output
+    of each. The exit code is 1 when a command failed or did not run.
+    """
+    commands = []
+    for line in commands_file:
+        line = line.strip()
+        if len(line) > 0 and not line.startswith('#'):
+            commands.append(line)
+    vs = get_vsphere(ctx)
+    vs.connect()
+    vm = get_vm(ctx, vm_moid)
+    results = vs.execute_commands_in_guest(
+        vm, guest_user, guest_password, commands,
+        stop_on_error=stop_on_error)
+    if as_json:
+        for result in results:
+            for key in ('stdout', 'stderr'):
+                result[key] = result[key].decode('utf-8', 'replace')
+        click.echo(json.dumps(results, indent=4))
+    else:
+        for n, result in enumerate(results):
+            click.secho(
+                '[%s] exit code %s, %.3fs: %s' %
+                (n, result['exit_code'], result['duration'],
+                 result['command']),
+                bold=True)
+            click.echo(result['stderr'], err=True, nl=False)
+            click.echo(result['stdout'], nl=False)
+        if len(results) < len(commands):
+            click.secho(
+                '%s of %s commands not run' %
+                (len(commands) - len(results), len(commands)),
+                err=True)
+    failed = [result for result in results if result['exit_code'] != 0]
+    ctx.exit(0 if len(failed) == 0 and len(results) == len(commands) else 1)
+
+
+@vgr.command(short_help='serve guest jobs to vgr clients')
+@click.pass_context
+@click.option(
+    'jobs',
+    '-j',
+    '--jobs',
+    default=16,
+    metavar='<n>',
+    type=click.IntRange(min=1),
+    help='Max number of jobs running at the same time')
+@click.option(
+    'keepalive',
+    '--keepalive',
+    default=600,
+    metavar='<seconds>',
+    type=click.IntRange(min=1),
+    help='Interval of the checks keeping the vCenter session alive')
+def serve(ctx, jobs, keepalive):
+    """Serve guest jobs to vgr clients
+
+\b
+    Logs in on the vCenter or ESXi and keeps the session alive, logging in
+    again when it expires. run, run-script, upload and download commands
+    given --socket (or VGR_SOCKET) are sent to it over a Unix socket,
+    ~/.vgr/vgr.sock by default, and run without a login of their own.
+    The VM inventory used to find VMs by name is loaded once and then
+    kept up to date with the changes reported by the vCenter.
+\b
+    Example
+        vgr -u user:pass@vcenter serve &
+        VGR_SOCKET=~/.vgr/vgr.sock vgr run vm-111 /bin/date
+    """
+    import signal
+    import sys
+    from vsphere_guest_run.daemon import Daemon
+    from vsphere_guest_run.daemon import SOCKET_PATH
+    vs = get_vsphere(ctx)
+    vs.connect()
+    load_inventory(ctx, refresh=True)
+    daemon = Daemon(
+        vs,
+        functools.partial(get_vm, ctx),
+        path=ctx.obj['socket'] or SOCKET_PATH,
+        jobs=jobs,
+        keepalive=keepalive,
+        log=functools.partial(click.secho, err=True))
+    daemon.bind()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    click.secho('listening on %s' % daemon.path, err=True)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == '__main__':
@@ -2,34 +2,540 @@
 # Copyright (c) 2017 VMware, Inc. All Rights Reserved.
 # SPDX-License-Identifier: BSD-2-Clause
 
+from concurrent.futures import as_completed
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures import wait
+import contextlib
+import functools
+import io
+import itertools
+import math
+import os
+import posixpath
 from pyVim import connect
 import pyVmomi
 from pyVmomi import vim
+import re
 import requests
+import shlex
 import ssl
+import threading
 import time
+from urllib.parse import urlparse
 import uuid
 
+from vsphere_guest_run.events import Event
+from vsphere_guest_run.events import Metrics
+from vsphere_guest_run.scheduler import default_scheduler
+from vsphere_guest_run.tracker import ProcessTracker
+
 RM_CMD = '/bin/rm'
+MAX_WORKERS = 16
+HTTP_POOL_SIZE = 16
+HTTP_TIMEOUT = (30, 300)
+CHUNK_SIZE = 64 * 1024
+PAGE_SIZE = 1000
+VM_PROPERTIES = [
+    "name", "config.uuid", "config.hardware.numCPU",
+    "config.hardware.memoryMB", "guest.guestState", "config.guestFullName",
+    "config.guestId", "config.version"
+]
+VM_INFO_PROPERTIES = [
+    "name", "config.hardware.numCPU", "config.hardware.memoryMB",
+    "config.guestFullName", "config.version", "config.uuid",
+    "config.guestId", "guest.guestState", "guest.toolsRunningStatus"
+]
+LIST_PAGE_SIZE = 1000
+LIST_WORKERS = 8
+SCRIPT_PERMISSIONS = 0o700
+TOOLS_RUNNING = 'guestToolsRunning'
+TOOLS_WAIT_SECONDS = 60
+FOLLOW_MIN_INTERVAL = 0.5
+FOLLOW_MAX_INTERVAL = 8
+CAPTURE_FILES = 'files'
+CAPTURE_SINGLE = 'single'
+CAPTURE_HEADER = b'VGR-CAPTURE'
+CAPTURE_SCRIPT = (
+    '(%(command)s\n) > %(out)s 2> %(err)s; rc=$?; '
+    '{ echo "VGR-CAPTURE $rc $(wc -c < %(out)s) $(wc -c < %(err)s)"; '
+    'cat %(out)s %(err)s; } > %(cap)s.tmp; '
+    'rm -f %(out)s %(err)s%(cleanup)s; mv %(cap)s.tmp %(cap)s; exit $rc')
+CAPTURE_POLL_DELAYS = (0.005, 0.02, 0.05)
+BATCH_HEADER = b'VGR-BATCH'
+BATCH_SCRIPT = ('trap \'rm -f %(out)s %(err)s%(cleanup)s\' EXIT; status=0; '
+                ': > %(cap)s\n%(commands)sexit $status\n')
+BATCH_COMMAND = (
+    's=$(date +%%s%%N); (%(command)s\n) > %(out)s 2> %(err)s; rc=$?; '
+    'e=$(date +%%s%%N); { echo "VGR-BATCH %(index)s $rc $s $e '
+    '$(wc -c < %(out)s) $(wc -c < %(err)s)"; cat %(out)s %(err)s; } '
+    '>> %(cap)s; %(on_error)s\n')
+BATCH_INLINE_MAX = 64 * 1024
+
+
+class RangeNotSupported(Exception):
+    """The ESXi host answered a byte range request with the whole file."""
+
+
+def data_size(data):
+    """Return the number of bytes left to read from data."""
+    if hasattr(data, '__len__'):
+        if hasattr(data, 'tell'):
+            return len(data) - data.tell()
+        return len(data)
+    position = data.tell()
+    try:
+        return os.fstat(data.fileno()).st_size - position
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        end = data.seek(0, os.SEEK_END)
+        data.seek(position)
+        return end - position
+
+
+def read_capture(chunks, stdout, stderr):
+    """Split a CAPTURE_SINGLE file into the stdout and stderr file objects.
+
+    chunks is an iterable of bytes with the content of the capture file.
+    Returns a (exit_code, stdout_size, stderr_size) tuple.
+    """
+    chunks = iter(chunks)
+    data = b''
+    for chunk in chunks:
+        data += chunk
+        if b'\n' in data:
+            break
+    header, _, data = data.partition(b'\n')
+    tokens = header.split()
+    if len(tokens) != 4 or tokens[0] != CAPTURE_HEADER:
+        raise Exception('invalid capture file header: %r' % header[:80])
+    sizes = [int(tokens[2]), int(tokens[3])]
+    remaining = list(sizes)
+    targets = [stdout, stderr]
+    index = 0
+    for data in itertools.chain([data], chunks):
+        while len(data) > 0 and index < 2:
+            n = min(len(data), remaining[index])
+            if n > 0:
+                targets[index].write(data[:n])
+                remaining[index] -= n
+                data = data[n:]
+            if remaining[index] == 0:
+                index += 1
+    for target in targets:
+        target.flush()
+    if remaining != [0, 0]:
+        raise Exception('truncated capture file')
+    return int(tokens[1]), sizes[0], sizes[1]
+
+
+def _guest_time(token):
+    """Return the seconds of a 'date +%s%N' output.
+
+    Without %N support, date prints the seconds followed by N or %N.
+    """
+    if token.isdigit():
+        return int(token) / 1e9
+    return int(re.match(r'\d*', token).group() or 0)
+
+
+def read_batch(data, commands):
+    """Parse the capture file of a GuestBatch into a dict per command.
+
+    Each dict has the command, its exit_code, its duration in seconds and
+    its stdout and stderr as bytes. Commands that did not run, after a
+    failure with stop_on_error, are left out.
+    """
+    results = []
+    position = 0
+    while position < len(data):
+        end = data.find(b'\n', position)
+        if end < 0:
+            raise Exception('truncated batch capture file')
+        tokens = data[position:end].decode('ascii', 'replace').split()
+        if len(tokens) != 7 or tokens[0] != BATCH_HEADER.decode():
+            raise Exception('invalid batch capture header: %r' %
+                            data[position:end][:80])
+        index = int(tokens[1])
+        sizes = [int(tokens[5]), int(tokens[6])]
+        position = end + 1
+        stdout = data[position:position + sizes[0]]
+        position += sizes[0]
+        stderr = data[position:position + sizes[1]]
+        position += sizes[1]
+        if len(stdout) != sizes[0] or len(stderr) != sizes[1]:
+            raise Exception('truncated batch capture file')
+        results.append({
+            'command': commands[index],
+            'exit_code': int(tokens[2]),
+            'duration': max(0, _guest_time(tokens[4]) -
+                            _guest_time(tokens[3])),
+            'stdout': stdout,
+            'stderr': stderr
+        })
+    return results
+
+
+class GuestProgram(object):
+    """The ProgramSpec and output files of a command run in the guest.
+
+    With get_output, the command output is redirected to files named after
+    a new uuid in /tmp, or framed into a single capture file with
+    capture=CAPTURE_SINGLE, which runs the command under /bin/sh.
+    cleanup_files are removed along with the output files.
+    """
+
+    def __init__(self,
+                 command,
+                 get_output=True,
+                 capture=CAPTURE_FILES,
+                 cleanup_files=None):
+        self.command = command
+        self.get_output = get_output
+        self.capture = capture
+        self.cleanup = ''
+        for cleanup_file in cleanup_files or []:
+            self.cleanup += ' %s' % shlex.quote(cleanup_file)
+        self.file_uuid = uuid.uuid1()
+        self.stdout_file = '/tmp/%s.out' % self.file_uuid
+        self.stderr_file = '/tmp/%s.err' % self.file_uuid
+        self.capture_file = '/tmp/%s.cap' % self.file_uuid
+        self.exit_code = None
+        if get_output and capture == CAPTURE_SINGLE:
+            program_path = '/bin/sh'
+            arguments = '-c %s' % shlex.quote(
+                CAPTURE_SCRIPT % {
+                    'command': command,
+                    'out': self.stdout_file,
+                    'err': self.stderr_file,
+                    'cap': self.capture_file,
+                    'cleanup': self.cleanup
+                })
+        else:
+            tokens = command.split()
+            program_path = tokens.pop(0)
+            arguments = ''
+            for token in tokens:
+                arguments += ' %s' % token
+            if get_output:
+                arguments += ' > %s 2> %s' % (self.stdout_file,
+                                              self.stderr_file)
+        self.spec = vim.vm.guest.ProcessManager.ProgramSpec(
+            programPath=program_path, arguments=arguments)
+
+
+def session_scoped(method):
+    """Invalidate the VSphere cache when the session has been lost."""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except vim.fault.NotAuthenticated:
+            self.invalidate_cache()
+            raise
+
+    return wrapper
+
+
+class GuestBatch(object):
+    """The ProgramSpec and capture file of commands run by one /bin/sh.
+
+    Each command runs in a subshell with its output redirected, then its
+    exit code, start and end times and output are appended as a frame to
+    a single capture file, see read_batch(). A script over
+    BATCH_INLINE_MAX bytes does not fit in the arguments of the program,
+    it is uploaded to script_file instead. The temporary files other than
+    the capture file remove themselves when the shell exits.
+    """
+
+    def __init__(self, commands, stop_on_error=False):
+        self.commands = list(commands)
+        self.file_uuid = uuid.uuid1()
+        self.stdout_file = '/tmp/%s.out' % self.file_uuid
+        self.stderr_file = '/tmp/%s.err' % self.file_uuid
+        self.capture_file = '/tmp/%s.cap' % self.file_uuid
+        self.script_file = None
+        on_error = '[ $rc -eq 0 ] || status=$rc;'
+        if stop_on_error:
+            on_error = '[ $rc -eq 0 ] || exit $rc;'
+        body = ''
+        for index, command in enumerate(self.commands):
+            body += BATCH_COMMAND % {
+                'index': index,
+                'command': command,
+                'out': self.stdout_file,
+                'err': self.stderr_file,
+                'cap': self.capture_file,
+                'on_error': on_error
+            }
+        cleanup = ''
+        if len(body) > BATCH_INLINE_MAX:
+            self.script_file = '/tmp/%s.sh' % self.file_uuid
+            cleanup = ' %s' % self.script_file
+        self.script = BATCH_SCRIPT % {
+            'out': self.stdout_file,
+            'err': self.stderr_file,
+            'cap': self.capture_file,
+            'cleanup': cleanup,
+            'commands': body
+        }
+        if self.script_file is None:
+            arguments = '-c %s' % shlex.quote(self.script)
+        else:
+            arguments = self.script_file
+        self.spec = vim.vm.guest.ProcessManager.ProgramSpec(
+            programPath='/bin/sh', arguments=arguments)
 
 
 class VSphere(object):
-    def __init__(self, host, user, password, verify=True, port=443):
+    """Client of the vSphere guest operations of a vCenter or ESXi host.
+
+    verify applies to the vCenter and, unless transfer_verify is given,
+    to the file transfers with the ESXi hosts, which often have
+    self-signed certificates even when the vCenter has not.
+    """
+
+    def __init__(self,
+                 host,
+                 user,
+                 password,
+                 verify=True,
+                 port=443,
+                 session_cache=None,
+                 http_pool_size=HTTP_POOL_SIZE,
+                 http_timeout=HTTP_TIMEOUT,
+                 scheduler=None,
+                 transfer_verify=None):
         self.host = host
         self.user = user
         self.password = password
         self.verify = verify
+        self.transfer_verify = verify if transfer_verify is None else \
+            transfer_verify
         self.port = port
+        self.session_cache = session_cache
+        self.service_instance = None
+        self.http_pool_size = http_pool_size
+        self.http_timeout = http_timeout
+        self._http_lock = threading.Lock()
+        self._http_sessions = {}
+        self.scheduler = scheduler or default_scheduler()
+        self.process_tracker = ProcessTracker(
+            call=functools.partial(self.scheduler.call, host))
+        self.cache_stats = {'hits': 0, 'misses': 0}
+        self._cache_lock = threading.Lock()
+        self.metrics = Metrics()
+        self.sinks = [self.metrics]
+        self._local = threading.local()
+        self.invalidate_cache()
 
     def connect(self):
+        """Login on the vCenter or ESXi host.
+
+        When a session_cache is set, a previously saved session is reattached
+        if it is still valid, and a fresh login is only done otherwise. The
+        cookie of a fresh login is saved for the next time.
+        """
+        context = self._ssl_context()
+        if self.session_cache is not None:
+            with self._phase('reattach', calls=0):
+                if self._reattach(context):
+                    return
+        with self._phase('login', calls=0):
+            service_instance, content = self._call(self._login, context)
+        self.service_instance = service_instance
+        self.invalidate_cache()
+        with self._cache_lock:
+            self._cache['content'] = content
+        if self.session_cache is not None:
+            self.session_cache.save(self.user, self.host, self.port,
+                                    self.service_instance._stub.cookie)
+
+    def _ssl_context(self):
         context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
         if not self.verify:
             context.verify_mode = ssl.CERT_NONE
-        self.service_instance = connect.SmartConnect(
-            host=self.host,
-            user=self.user,
-            pwd=self.password,
-            sslContext=context)
+        return context
+
+    def _login(self, context):
+        stub = connect.SmartStubAdapter(
+            host=self.host, port=self.port, sslContext=context)
+        service_instance = vim.ServiceInstance('ServiceInstance', stub)
+        self._count_calls(1)
+        content = service_instance.RetrieveContent()
+        self._count_calls(1)
+        content.sessionManager.Login(self.user, self.password)
+        return service_instance, content
+
+    def _reattach(self, context):
+        cookie = self.session_cache.load(self.user, self.host, self.port)
+        if cookie is None:
+            return False
+        stub = connect.SmartStubAdapter(
+            host=self.host, port=self.port, sslContext=context)
+        stub.cookie = cookie
+        service_instance = vim.ServiceInstance('ServiceInstance', stub)
+        try:
+            self._count_calls(1)
+            content = service_instance.RetrieveContent()
+            self._count_calls(1)
+            session = content.sessionManager.currentSession
+        except vim.fault.NotAuthenticated:
+            session = None
+        if session is None:
+            self.session_cache.delete(self.user, self.host, self.port)
+            return False
+        self.service_instance = service_instance
+        self.invalidate_cache()
+        with self._cache_lock:
+            self._cache['content'] = content
+        return True
+
+    def logout(self):
+        """Terminate the session and remove it from the session cache."""
+        if self.service_instance is None and self.session_cache is not None:
+            self._reattach(self._ssl_context())
+        if self.service_instance is not None:
+            try:
+                self.get_content().sessionManager.Logout()
+            except vim.fault.NotAuthenticated:
+                pass
+            self.service_instance = None
+            self.invalidate_cache()
+        if self.session_cache is not None:
+            self.session_cache.delete(self.user, self.host, self.port)
+
+    def invalidate_cache(self):
+        """Drop the session scoped handles and credentials.
+
+        Called on connect() and whenever vCenter reports the session is no
+        longer authenticated, the next guest operation fetches them again.
+        """
+        with self._cache_lock:
+            self._cache = {}
+
+    def _cached(self, key, factory):
+        with self._cache_lock:
+            if key in self._cache:
+                self.cache_stats['hits'] += 1
+                return self._cache[key]
+        value = factory()
+        with self._cache_lock:
+            self.cache_stats['misses'] += 1
+            return self._cache.setdefault(key, value)
+
+    def get_content(self):
+        return self._cached('content', self.service_instance.RetrieveContent)
+
+    def get_process_manager(self):
+        return self._cached(
+            'processManager',
+            lambda: self.get_content().guestOperationsManager.processManager)
+
+    def get_file_manager(self):
+        return self._cached(
+            'fileManager',
+            lambda: self.get_content().guestOperationsManager.fileManager)
+
+    def get_credentials(self, user, password):
+        return self._cached(
+            ('credentials', user, password),
+            lambda: vim.vm.guest.NamePasswordAuthentication(
+                username=user, password=password))
+
+    def get_http_session(self, url):
+        """Return the pooled keep-alive HTTP session for the url's host.
+
+        File transfers go to the ESXi host running the VM, one
+        requests.Session is kept per host so its connections are reused
+        across transfers.
+        """
+        host = urlparse(url).netloc
+        with self._http_lock:
+            session = self._http_sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.http_pool_size,
+                    pool_block=True)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._http_sessions[host] = session
+        return session
+
+    def http_stats(self):
+        """Return the number of HTTP requests and connections per host."""
+        stats = {}
+        with self._http_lock:
+            sessions = list(self._http_sessions.items())
+        for host, session in sessions:
+            host_stats = {'requests': 0, 'connections': 0}
+            for adapter in set(session.adapters.values()):
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools[key]
+                    host_stats['requests'] += pool.num_requests
+                    host_stats['connections'] += pool.num_connections
+            host_stats['reused'] = max(
+                0, host_stats['requests'] - host_stats['connections'])
+            stats[host] = host_stats
+        return stats
+
+    def _call(self, fn, *args, **kwargs):
+        """Make an API call through the scheduler, see Scheduler.call()."""
+        return self.scheduler.call(self.host, fn, *args, **kwargs)
+
+    def _call_once(self, fn, *args, **kwargs):
+        return self.scheduler.call_once(self.host, fn, *args, **kwargs)
+
+    def _transfer(self, url, fn, *args, **kwargs):
+        return self.scheduler.transfer(
+            urlparse(url).netloc, fn, *args, **kwargs)
+
+    def add_sink(self, sink):
+        """Call sink(event) with the Event of every completed phase."""
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def emit(self, event):
+        for sink in list(self.sinks):
+            sink(event)
+
+    @contextlib.contextmanager
+    def _phase(self, phase, vm=None, calls=1):
+        """Time a phase of an operation and emit its Event.
+
+        Yields the Event so bytes and calls can be added to it. A phase
+        entered while another one is running in the same thread is
+        accounted to the outer phase instead of emitting its own event.
+        """
+        outer = getattr(self._local, 'event', None)
+        if outer is not None:
+            outer.calls += calls
+            yield outer
+            return
+        event = Event(phase, vm=getattr(vm, '_moId', vm), calls=calls)
+        self._local.event = event
+        start = time.time()
+        try:
+            yield event
+        except Exception as e:
+            event.error = str(e) or e.__class__.__name__
+            raise
+        finally:
+            self._local.event = None
+            event.duration = time.time() - start
+            self.emit(event)
+
+    def _count_calls(self, calls):
+        """Add calls to the phase running in this thread, if any."""
+        event = getattr(self._local, 'event', None)
+        if event is not None:
+            event.calls += calls
 
     def get_vm_by_moid(self, moid):
         vm = vim.VirtualMachine(moid)
@@ -37,19 +543,40 @@ class VSphere(object):
         return vm
 
     def vm_to_dict(self, vm):
-        result = {}
-        result['name'] = vm.name
-        result['moid'] = vm._moId
-        result['config.hardware.numCPU'] = vm.config.hardware.numCPU
-        result['config.hardware.memoryMB'] = vm.config.hardware.memoryMB
-        result['config.guestFullName'] = vm.config.guestFullName
-        result['config.version'] = vm.config.version
-        result['config.uuid'] = vm.config.uuid
-        result['config.guestId'] = vm.config.guestId
-        result['guest.guestState'] = vm.guest.guestState
-        result['guest.toolsRunningStatus'] = vm.guest.toolsRunningStatus
-        return result
+        return self.vms_to_dicts([vm])[0]
 
+    @session_scoped
+    def vms_to_dicts(self, vms, path_set=VM_INFO_PROPERTIES):
+        """Return the properties of many VMs, with one PropertyCollector call.
+
+        vms are VM objects or moids, the dicts are returned in the same
+        order and have a key for every path in path_set, None when unset.
+        """
+        vms = [
+            self.get_vm_by_moid(vm) if isinstance(vm, str) else vm
+            for vm in vms
+        ]
+        property_spec = pyVmomi.vmodl.query.PropertyCollector.PropertySpec()
+        property_spec.type = vim.VirtualMachine
+        property_spec.pathSet = path_set
+        filter_spec = pyVmomi.vmodl.query.PropertyCollector.FilterSpec()
+        filter_spec.objectSet = [
+            pyVmomi.vmodl.query.PropertyCollector.ObjectSpec(obj=vm)
+            for vm in vms
+        ]
+        filter_spec.propSet = [property_spec]
+        results = {}
+        for vm in vms:
+            result = {'moid': vm._moId}
+            for path in path_set:
+                result[path] = None
+            results[vm._moId] = result
+        for obj in self.retrieve_objects([filter_spec]):
+            for prop in obj.propSet:
+                results[obj.obj._moId][prop.name] = prop.val
+        return [results[vm._moId] for vm in vms]
+
+    @session_scoped
     def execute_program_in_guest(self,
                                  vm,
                                  user,
@@ -59,131 +586,728 @@ class VSphere(object):
                                  wait_time=1,
                                  get_output=True,
                                  rm_cmd=RM_CMD,
-                                 callback=None):
-        tokens = command.split()
-        program_path = tokens.pop(0)
-        arguments = ''
-        for token in tokens:
-            arguments += ' %s' % token
-
-        if get_output:
-            file_uuid = uuid.uuid1()
-            stdout_file = '/tmp/%s.out' % file_uuid
-            stderr_file = '/tmp/%s.err' % file_uuid
-            arguments += ' > %s 2> %s' % (stdout_file, stderr_file)
-        creds = vim.vm.guest.NamePasswordAuthentication(
-            username=user, password=password)
-        content = self.service_instance.RetrieveContent()
-        pm = content.guestOperationsManager.processManager
-        ps = vim.vm.guest.ProcessManager.ProgramSpec(
-            programPath=program_path, arguments=arguments)
-        pid = pm.StartProgramInGuest(vm, creds, ps)
-        if not wait_for_completion:
-            return [pid]
-        n = 0
-        while True:
+                                 callback=None,
+                                 stdout=None,
+                                 stderr=None,
+                                 chunk_size=CHUNK_SIZE,
+                                 capture=CAPTURE_FILES,
+                                 follow=False,
+                                 cleanup_files=None):
+        """Run a program in the guest.
+
+        Returns [pid] when not waiting for completion. Otherwise returns
+        [exit_code], followed with get_output by the stdout and stderr of
+        the program as requests.Response objects. When the stdout and stderr
+        binary file objects are given, the output is streamed into them in
+        chunks instead, and the number of bytes written to each is returned
+        in place of the responses.
+
+        With capture=CAPTURE_SINGLE the program runs under /bin/sh, which
+        frames its exit code, stdout and stderr into one guest file. That
+        file is moved into place when the program ends, so it is polled
+        with the InitiateFileTransferFromGuest call that fetches it, and
+        ListProcessesInGuest is only polled for programs still running
+        after CAPTURE_POLL_DELAYS. The file is fetched with a single
+        transfer and removed with DeleteFileInGuest, instead of two
+        transfers and an rm process. In this mode stdout and stderr are
+        returned as bytes when no file objects are given.
+
+        With follow=True the output files are fetched periodically while
+        the program runs and only the new bytes are written to the stdout
+        and stderr file objects, which are then required. The fetch interval
+        backs off while there is no new output. follow implies
+        capture=CAPTURE_FILES.
+
+        cleanup_files are extra guest paths removed together with the output
+        files, without another guest operation.
+        """
+        if capture not in (CAPTURE_FILES, CAPTURE_SINGLE):
+            raise Exception('unknown capture mode: %s' % capture)
+        if follow:
+            if not (get_output and wait_for_completion):
+                raise Exception('follow requires get_output and '
+                                'wait_for_completion')
+            if stdout is None or stderr is None:
+                raise Exception('follow requires stdout and stderr')
+            capture = CAPTURE_FILES
+        program = GuestProgram(
+            command,
+            get_output=get_output,
+            capture=capture,
+            cleanup_files=cleanup_files)
+        with self.scheduler.vm_slot(self.host, vm):
+            creds = self.get_credentials(user, password)
+            with self._phase('start', vm):
+                pid = self._call_once(
+                    self.get_process_manager().StartProgramInGuest, vm,
+                    creds, program.spec)
+            if not wait_for_completion:
+                return [pid]
+            offsets = None
+            info = None
+            if get_output and program.capture == CAPTURE_SINGLE:
+                info = self._poll_capture(vm, creds, program)
+            if info is not None:
+                process = None
+            elif follow:
+                offsets = [0, 0]
+                with self._phase('follow', vm, calls=0):
+                    process = self._follow_process(
+                        vm, user, password, creds, pid,
+                        [program.stdout_file, program.stderr_file],
+                        [stdout, stderr], offsets, chunk_size, callback)
+            else:
+                # the ListProcessesInGuest polls are shared with the other
+                # processes of the VM, each is counted for all the processes
+                # it included, see ProcessTracker
+                with self._phase('wait', vm, calls=0):
+                    process = self.wait_for_process(
+                        vm, creds, pid, wait_time=wait_time, callback=callback)
+            if process is not None:
+                program.exit_code = process.exitCode
+            output = []
+            if get_output:
+                output = self.collect_output(
+                    vm,
+                    user,
+                    password,
+                    program,
+                    stdout=stdout,
+                    stderr=stderr,
+                    chunk_size=chunk_size,
+                    rm_cmd=rm_cmd,
+                    callback=callback,
+                    offsets=offsets,
+                    info=info)
+            result = [program.exit_code] + output
+            if callback is not None:
+                callback('process %s on vm %s finished, exit code: %s' %
+                         (result, vm, program.exit_code))
+            return result
+
+    def _poll_capture(self, vm, creds, program):
+        """Return the FileTransferInformation of a finished CAPTURE_SINGLE.
+
+        Tries to start the transfer of the capture file after each of
+        CAPTURE_POLL_DELAYS, returns None if it is still missing.
+        """
+        with self._phase('wait', vm, calls=0):
+            for delay in CAPTURE_POLL_DELAYS:
+                time.sleep(delay)
+                self._count_calls(1)
+                try:
+                    return self._call(
+                        self.get_file_manager().InitiateFileTransferFromGuest,
+                        vm, creds, program.capture_file)
+                except vim.fault.FileNotFound:
+                    pass
+        return None
+
+    def collect_output(self,
+                       vm,
+                       user,
+                       password,
+                       program,
+                       stdout=None,
+                       stderr=None,
+                       chunk_size=CHUNK_SIZE,
+                       rm_cmd=RM_CMD,
+                       callback=None,
+                       offsets=None,
+                       info=None):
+        """Fetch and remove the output of a finished GuestProgram.
+
+        Returns the [stdout, stderr] entries of the execute_program_in_guest()
+        result. offsets are the bytes already written by follow mode. info is
+        the FileTransferInformation of the capture file when its transfer was
+        already initiated. The exit code framed in the capture file is stored
+        in program.exit_code.
+        """
+        result = []
+        if program.capture == CAPTURE_SINGLE:
+            targets = [stdout, stderr]
+            for n in range(2):
+                if targets[n] is None:
+                    targets[n] = io.BytesIO()
             try:
-                processes = pm.ListProcessesInGuest(vm, creds, [pid])
-                if len(processes) == 0:
-                    raise Exception('process not found (pid=%s) (vm=%s)' %
-                                    (pid, vm))
-                if processes[0].exitCode is not None:
-                    result = [processes[0].exitCode]
-                    if get_output:
-                        r = self.download_file_from_guest(
-                            vm, user, password, stdout_file)
-                        result.append(r)
-                        r = self.download_file_from_guest(
-                            vm, user, password, stderr_file)
-                        result.append(r)
-                        try:
-                            ps = vim.vm.guest.ProcessManager.ProgramSpec(
-                                programPath=rm_cmd,
-                                arguments='-rf /tmp/%s.*' % file_uuid)
-                            r = pm.StartProgramInGuest(vm, creds, ps)
-                        except Exception as e:
-                            if callback is not None:
-                                callback('exception', e)
-                            else:
-                                print(str(e))
+                with self._phase('output', vm, calls=0) as event:
+                    chunks = self.iter_file_from_guest(
+                        vm,
+                        user,
+                        password,
+                        program.capture_file,
+                        chunk_size,
+                        info=info)
+                    sizes = read_capture(chunks, targets[0], targets[1])
+                    event.bytes += sizes[1] + sizes[2]
+                program.exit_code = sizes[0]
+            finally:
+                try:
+                    with self._phase('cleanup', vm, calls=0):
+                        self.delete_file_in_guest(vm, user, password,
+                                                  program.capture_file)
+                except Exception as e:
                     if callback is not None:
-                        callback(
-                            'process %s on vm %s finished, exit code: %s' %
-                            (result, vm, processes[0].exitCode))
-                    return result
+                        callback('exception', e)
+                    else:
+                        print(str(e))
+            result.append(
+                targets[0].getvalue() if stdout is None else sizes[1])
+            result.append(
+                targets[1].getvalue() if stderr is None else sizes[2])
+            return result
+        with self._phase('output', vm, calls=0):
+            for n, (source_file, target) in enumerate(
+                    ((program.stdout_file, stdout), (program.stderr_file,
+                                                     stderr))):
+                if offsets is not None:
+                    offsets[n] += self._fetch_new_output(
+                        vm, user, password, source_file, target, offsets[n],
+                        chunk_size)
+                    r = offsets[n]
+                elif target is None:
+                    r = self.download_file_from_guest(vm, user, password,
+                                                      source_file)
                 else:
-                    if callback is not None:
-                        n += 1
-                        callback(
-                            'waiting for process %s on vm %s to finish (%s)' %
-                            (pid, vm, n))
-                    time.sleep(wait_time)
-            except Exception as e:
-                if str(e).startswith('process not found ('):
-                    raise e
+                    r = self.download_file_to_local(
+                        vm,
+                        user,
+                        password,
+                        source_file,
+                        target,
+                        chunk_size=chunk_size)
+                result.append(r)
+        try:
+            ps = vim.vm.guest.ProcessManager.ProgramSpec(
+                programPath=rm_cmd,
+                arguments='-rf /tmp/%s.*%s' % (program.file_uuid,
+                                               program.cleanup))
+            with self._phase('cleanup', vm):
+                self._call_once(
+                    self.get_process_manager().StartProgramInGuest, vm,
+                    self.get_credentials(user, password), ps)
+        except Exception as e:
+            if callback is not None:
+                callback('exception', e)
+            else:
+                print(str(e))
+        return result
+
+    def _follow_process(self, vm, user, password, creds, pid, source_files,
+                        targets, offsets, chunk_size, callback):
+        future = self.process_tracker.track(
+            self.get_process_manager(), vm, creds, pid, callback=callback)
+        interval = FOLLOW_MIN_INTERVAL
+        n = 0
+        while True:
+            try:
+                return future.result(timeout=interval)
+            except FuturesTimeoutError:
+                pass
+            finally:
+                if future.done():
+                    self._count_calls(future.polls)
+            if callback is not None:
+                n += 1
+                callback('following process %s on vm %s (%s)' % (pid, vm, n))
+            size = 0
+            for index, source_file in enumerate(source_files):
+                written = self._fetch_new_output(
+                    vm, user, password, source_file, targets[index],
+                    offsets[index], chunk_size)
+                offsets[index] += written
+                size += written
+            if size > 0:
+                interval = FOLLOW_MIN_INTERVAL
+            else:
+                interval = min(interval * 2, FOLLOW_MAX_INTERVAL)
+
+    def _fetch_new_output(self, vm, user, password, source_file, target,
+                          offset, chunk_size):
+        """Write the bytes of source_file past offset to target.
+
+        Asks for a byte range and falls back to skipping the first offset
+        bytes when the host sends the whole file. Returns the number of
+        bytes written.
+        """
+        with self._phase('download', vm) as event:
+            written = self._fetch_range(vm, user, password, source_file,
+                                        target, offset, chunk_size)
+            event.bytes += written
+        return written
+
+    def _fetch_range(self,
+                     vm,
+                     user,
+                     password,
+                     source_file,
+                     target,
+                     offset,
+                     chunk_size,
+                     length=None):
+        creds = self.get_credentials(user, password)
+        try:
+            info = self._call(
+                self.get_file_manager().InitiateFileTransferFromGuest, vm,
+                creds, source_file)
+        except vim.fault.FileNotFound:
+            return 0
+        if info.size <= offset:
+            return 0
+        end = ''
+        if length is not None:
+            end = offset + length - 1
+        resp = self._transfer(
+            info.url,
+            self.get_http_session(info.url).get,
+            info.url,
+            headers={'Range': 'bytes=%s-%s' % (offset, end)},
+            verify=self.transfer_verify,
+            timeout=self.http_timeout,
+            stream=True)
+        try:
+            if resp.status_code == 206:
+                skip = 0
+            elif resp.status_code == 200 and length is not None:
+                raise RangeNotSupported(
+                    'host ignored the byte range of %s' % source_file)
+            elif resp.status_code == 200:
+                skip = offset
+            else:
+                raise Exception(
+                    'Error while downloading file: %s' % resp.status_code)
+            written = 0
+            for chunk in resp.iter_content(chunk_size=chunk_size):
+                if skip > 0:
+                    n = min(skip, len(chunk))
+                    chunk = chunk[n:]
+                    skip -= n
+                if length is not None:
+                    chunk = chunk[:length - written]
+                if len(chunk) > 0:
+                    target.write(chunk)
+                    written += len(chunk)
+                if length is not None and written == length:
+                    break
+            target.flush()
+            return written
+        finally:
+            resp.close()
+
+    @session_scoped
+    def download_range_from_guest(self,
+                                  vm,
+                                  user,
+                                  password,
+                                  source_file,
+                                  target,
+                                  offset,
+                                  length,
+                                  chunk_size=CHUNK_SIZE):
+        """Write length bytes of a guest file from offset to target.
+
+        Each call is a transfer of its own, so ranges of a file can be
+        downloaded concurrently. Returns the number of bytes written.
+        Raises RangeNotSupported, before reading the response, when the
+        host sends the whole file instead of the range.
+        """
+        with self._phase('download', vm) as event:
+            written = self._fetch_range(vm, user, password, source_file,
+                                        target, offset, chunk_size, length)
+            event.bytes += written
+        if written != length:
+            raise Exception('short read of %s at %s: %s of %s bytes' %
+                            (source_file, offset, written, length))
+        return written
+
+    def wait_for_process(self, vm, creds, pid, wait_time=1, callback=None):
+        """Block until the guest process exits, return its GuestProcessInfo.
+
+        callback is called every wait_time seconds while waiting. The polls
+        made for the process are added to the calls of the current phase.
+        """
+        future = self.process_tracker.track(
+            self.get_process_manager(), vm, creds, pid, callback=callback)
+        n = 0
+        while True:
+            try:
+                return future.result(timeout=wait_time)
+            except FuturesTimeoutError:
                 if callback is not None:
-                    callback('exception, will retry in a few seconds, vm %s' %
-                             vm, e)
-                else:
-                    print(str(e))
-                    print('will retry again in a few seconds')
-                time.sleep(wait_time * 3)
-
-    def upload_file_to_guest(self, vm, user, password, data, target_file):
-        creds = vim.vm.guest.NamePasswordAuthentication(
-            username=user, password=password)
-        content = self.service_instance.RetrieveContent()
-        file_attribute = vim.vm.guest.FileManager.FileAttributes()
-        url = content.guestOperationsManager.fileManager. \
-            InitiateFileTransferToGuest(vm,
-                                        creds,
-                                        target_file,
-                                        file_attribute,
-                                        len(data),
-                                        False)
-        resp = requests.put(url, data=data, verify=False)
+                    n += 1
+                    callback('waiting for process %s on vm %s to finish (%s)' %
+                             (pid, vm, n))
+            finally:
+                if future.done():
+                    self._count_calls(future.polls)
+
+    def execute_program_in_guests(self,
+                                  vms,
+                                  user,
+                                  password,
+                                  command,
+                                  max_workers=MAX_WORKERS,
+                                  wait_time=1,
+                                  get_output=True,
+                                  rm_cmd=RM_CMD,
+                                  callback=None,
+                                  capture=CAPTURE_FILES):
+        """Run a command on many VMs concurrently.
+
+        Yields a (vm, result, exception) tuple per VM, in completion order.
+        result has the same form as execute_program_in_guest() with
+        wait_for_completion=True; exception is set instead when the command
+        could not be run on that VM.
+        """
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for vm in vms:
+                future = executor.submit(
+                    self.execute_program_in_guest,
+                    vm,
+                    user,
+                    password,
+                    command,
+                    wait_for_completion=True,
+                    wait_time=wait_time,
+                    get_output=get_output,
+                    rm_cmd=rm_cmd,
+                    callback=callback,
+                    capture=capture)
+                futures[future] = vm
+            for future in as_completed(futures):
+                vm = futures[future]
+                try:
+                    yield vm, future.result(), None
+                except Exception as e:
+                    yield vm, None, e
+
+    @session_scoped
+    def execute_commands_in_guest(self,
+                                  vm,
+                                  user,
+                                  password,
+                                  commands,
+                                  wait_time=1,
+                                  stop_on_error=False,
+                                  callback=None,
+                                  chunk_size=CHUNK_SIZE):
+        """Run a list of commands in the guest as a single guest process.
+
+        The commands run one after the other under /bin/sh, each in its own
+        subshell, and their output is framed into one capture file, so a
+        batch costs one StartProgramInGuest, the polls, one transfer and
+        one DeleteFileInGuest whatever the number of commands. Returns a
+        dict per command, see read_batch(). The durations are measured in
+        the guest, to the second when its date does not support %N. With
+        stop_on_error the commands after the first failing one are not
+        run. The output is held in memory.
+        """
+        batch = GuestBatch(commands, stop_on_error=stop_on_error)
+        with self.scheduler.vm_slot(self.host, vm):
+            creds = self.get_credentials(user, password)
+            if batch.script_file is not None:
+                self.upload_file_to_guest(vm, user, password, batch.script,
+                                          batch.script_file)
+            try:
+                with self._phase('start', vm):
+                    pid = self._call_once(
+                        self.get_process_manager().StartProgramInGuest, vm,
+                        creds, batch.spec)
+            except Exception:
+                if batch.script_file is not None:
+                    try:
+                        self.delete_file_in_guest(vm, user, password,
+                                                  batch.script_file)
+                    except Exception:
+                        pass
+                raise
+            with self._phase('wait', vm, calls=0):
+                self.wait_for_process(
+                    vm, creds, pid, wait_time=wait_time, callback=callback)
+            try:
+                with self._phase('output', vm, calls=0) as event:
+                    data = b''.join(
+                        self.iter_file_from_guest(vm, user, password,
+                                                  batch.capture_file,
+                                                  chunk_size))
+                    event.bytes += len(data)
+            finally:
+                try:
+                    with self._phase('cleanup', vm, calls=0):
+                        self.delete_file_in_guest(vm, user, password,
+                                                  batch.capture_file)
+                except Exception as e:
+                    if callback is not None:
+                        callback('exception', e)
+                    else:
+                        print(str(e))
+            results = read_batch(data, batch.commands)
+            if callback is not None:
+                callback('batch of %s commands on vm %s finished, %s run' %
+                         (len(batch.commands), vm, len(results)))
+            return results
+
+    @session_scoped
+    def upload_file_to_guest(self,
+                             vm,
+                             user,
+                             password,
+                             data,
+                             target_file,
+                             file_attribute=None,
+                             overwrite=False):
+        """Upload data to a file in the guest.
+
+        data can be bytes, str, an mmap or a binary file object; file objects
+        and mmaps are streamed from their current position without being
+        read into memory. file_attribute (e.g. PosixFileAttributes with the
+        permissions) is applied to the file as it is created.
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        creds = self.get_credentials(user, password)
+        if file_attribute is None:
+            file_attribute = vim.vm.guest.FileManager.FileAttributes()
+        size = data_size(data)
+        with self._phase('upload', vm) as event:
+            url = self._call(
+                self.get_file_manager().InitiateFileTransferToGuest, vm,
+                creds, target_file, file_attribute, size, overwrite)
+            resp = self._transfer(
+                url,
+                self.get_http_session(url).put,
+                url,
+                data=data,
+                verify=self.transfer_verify,
+                timeout=self.http_timeout)
+            event.bytes += size
         if not resp.status_code == 200:
             raise Exception(
                 'Error while uploading file: %s' % resp.status_code)
         else:
             return True
 
-    def download_file_from_guest(self, vm, user, password, source_file):
-        creds = vim.vm.guest.NamePasswordAuthentication(
-            username=user, password=password)
-        content = self.service_instance.RetrieveContent()
-        info = content.guestOperationsManager.fileManager. \
-            InitiateFileTransferFromGuest(vm,
-                                          creds,
-                                          source_file)
-        return requests.get(info.url, verify=False)
-
-    def list_files_in_guest(self, vm, user, password, file_path, pattern):
-        creds = vim.vm.guest.NamePasswordAuthentication(
-            username=user, password=password)
-        content = self.service_instance.RetrieveContent()
-        return content.guestOperationsManager.fileManager. \
-            ListFilesInGuest(vm,
-                             creds,
-                             file_path,
-                             index=0,
-                             maxResults=1000,
-                             matchPattern=pattern)
+    def upload_local_file_to_guest(self,
+                                   vm,
+                                   user,
+                                   password,
+                                   source,
+                                   target_file,
+                                   file_attribute=None,
+                                   overwrite=False):
+        """Stream a local file (path or file object) to the guest."""
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                return self.upload_file_to_guest(vm, user, password, f,
+                                                 target_file, file_attribute,
+                                                 overwrite)
+        return self.upload_file_to_guest(vm, user, password, source,
+                                         target_file, file_attribute,
+                                         overwrite)
+
+    @session_scoped
+    def get_file_info_in_guest(self, vm, user, password, file_path):
+        """Return the size and attributes of a guest file.
+
+        As a FileTransferInformation, whose url is left unused.
+        """
+        creds = self.get_credentials(user, password)
+        with self._phase('file', vm):
+            return self._call(
+                self.get_file_manager().InitiateFileTransferFromGuest, vm,
+                creds, file_path)
+
+    @session_scoped
+    def download_file_from_guest(self,
+                                 vm,
+                                 user,
+                                 password,
+                                 source_file,
+                                 stream=False,
+                                 info=None):
+        """Download a file from the guest, return the requests.Response.
+
+        info is the FileTransferInformation of source_file when its transfer
+        was already initiated.
+        """
+        creds = self.get_credentials(user, password)
+        with self._phase('download', vm, calls=int(info is None)) as event:
+            if info is None:
+                info = self._call(
+                    self.get_file_manager().InitiateFileTransferFromGuest,
+                    vm, creds, source_file)
+            resp = self._transfer(
+                info.url,
+                self.get_http_session(info.url).get,
+                info.url,
+                verify=self.transfer_verify,
+                timeout=self.http_timeout,
+                stream=stream)
+            if not stream:
+                event.bytes += len(resp.content)
+        return resp
+
+    def iter_file_from_guest(self,
+                             vm,
+                             user,
+                             password,
+                             source_file,
+                             chunk_size=CHUNK_SIZE,
+                             info=None):
+        """Download a file from the guest, yielding it in chunks."""
+        resp = self.download_file_from_guest(
+            vm, user, password, source_file, stream=True, info=info)
+        try:
+            if not resp.status_code == 200:
+                raise Exception(
+                    'Error while downloading file: %s' % resp.status_code)
+            for chunk in resp.iter_content(chunk_size=chunk_size):
+                yield chunk
+        finally:
+            resp.close()
 
+    def download_file_to_local(self,
+                               vm,
+                               user,
+                               password,
+                               source_file,
+                               target,
+                               chunk_size=CHUNK_SIZE):
+        """Download a file from the guest into a local path or file object.
+
+        Memory use is bounded by chunk_size regardless of the file size.
+        Returns the number of bytes written.
+        """
+        if isinstance(target, str):
+            with open(target, 'wb') as f:
+                return self.download_file_to_local(
+                    vm, user, password, source_file, f, chunk_size)
+        with self._phase('download', vm, calls=0) as event:
+            size = 0
+            for chunk in self.iter_file_from_guest(vm, user, password,
+                                                   source_file, chunk_size):
+                target.write(chunk)
+                size += len(chunk)
+            target.flush()
+            event.bytes += size
+        return size
+
+    @session_scoped
+    def list_files_in_guest(self,
+                            vm,
+                            user,
+                            password,
+                            file_path,
+                            pattern,
+                            index=0,
+                            max_results=LIST_PAGE_SIZE):
+        creds = self.get_credentials(user, password)
+        with self._phase('list_files', vm):
+            return self._call(
+                self.get_file_manager().ListFilesInGuest,
+                vm,
+                creds,
+                file_path,
+                index=index,
+                maxResults=max_results,
+                matchPattern=pattern)
+
+    def iter_files_in_guest(self,
+                            vm,
+                            user,
+                            password,
+                            file_path,
+                            pattern=None,
+                            page_size=LIST_PAGE_SIZE):
+        """Yield all the entries of a guest directory, page by page.
+
+        Unlike list_files_in_guest(), directories with more than page_size
+        entries are not truncated. The '.' and '..' entries are skipped.
+        """
+        index = 0
+        while True:
+            info = self.list_files_in_guest(
+                vm,
+                user,
+                password,
+                file_path,
+                pattern,
+                index=index,
+                max_results=page_size)
+            files = info.files or []
+            for file_info in files:
+                if file_info.path not in ('.', '..'):
+                    yield file_info
+            if not info.remaining or len(files) == 0:
+                return
+            index += len(files)
+
+    def walk_files_in_guest(self,
+                            vm,
+                            user,
+                            password,
+                            file_path,
+                            max_workers=LIST_WORKERS,
+                            onerror=None):
+        """Recursively yield (path, file_info) for a guest directory tree.
+
+        Up to max_workers directories are listed concurrently, entries are
+        yielded as each directory listing completes, so the order is not
+        deterministic. Symbolic links are not followed. Errors listing a
+        subdirectory are passed to onerror(path, exception) when given,
+        and raised otherwise.
+        """
+
+        def list_directory(path):
+            return list(self.iter_files_in_guest(vm, user, password, path))
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(list_directory, file_path): file_path}
+            while len(futures) > 0:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    directory = futures.pop(future)
+                    try:
+                        files = future.result()
+                    except Exception as e:
+                        if onerror is None or directory == file_path:
+                            raise
+                        onerror(directory, e)
+                        continue
+                    for file_info in files:
+                        path = posixpath.join(directory, file_info.path)
+                        yield path, file_info
+                        if file_info.type == 'directory':
+                            future = executor.submit(list_directory, path)
+                            futures[future] = path
+
+    @session_scoped
     def move_file_in_guest(self, vm, user, password, src_file_path,
                            trg_file_path, overwrite):
-        creds = vim.vm.guest.NamePasswordAuthentication(
-            username=user, password=password)
-        content = self.service_instance.RetrieveContent()
-        content.guestOperationsManager.fileManager.MoveFileInGuest(
-            vm, creds, src_file_path, trg_file_path, overwrite)
+        creds = self.get_credentials(user, password)
+        with self._phase('file', vm):
+            self._call_once(self.get_file_manager().MoveFileInGuest, vm,
+                            creds, src_file_path, trg_file_path, overwrite)
 
+    @session_scoped
+    def make_directory_in_guest(self,
+                                vm,
+                                user,
+                                password,
+                                directory_path,
+                                create_parents=True):
+        creds = self.get_credentials(user, password)
+        with self._phase('file', vm):
+            self._call_once(self.get_file_manager().MakeDirectoryInGuest, vm,
+                            creds, directory_path, create_parents)
+
+    @session_scoped
     def delete_file_in_guest(self, vm, user, password, file_path):
-        creds = vim.vm.guest.NamePasswordAuthentication(
-            username=user, password=password)
-        content = self.service_instance.RetrieveContent()
-        content.guestOperationsManager.fileManager. \
-            DeleteFileInGuest(vm, creds, file_path)
+        creds = self.get_credentials(user, password)
+        with self._phase('file', vm):
+            self._call_once(self.get_file_manager().DeleteFileInGuest, vm,
+                            creds, file_path)
 
     def execute_script_in_guest(self,
                                 vm,
@@ -196,53 +1320,101 @@ class VSphere(object):
                                 get_output=True,
                                 delete_script=True,
                                 rm_cmd=RM_CMD,
-                                callback=None):
-        target = target_file
-        if target is None:
-            target = '/tmp/%s.sh' % uuid.uuid1()
-        self.upload_file_to_guest(vm, user, password, content, target)
-        cmd = '/bin/chmod u+rx %s' % target
-        self.execute_program_in_guest(
-            vm, user, password, cmd, wait_for_completion=True)
+                                callback=None,
+                                stdout=None,
+                                stderr=None,
+                                chunk_size=CHUNK_SIZE,
+                                capture=CAPTURE_FILES,
+                                follow=False,
+                                interpreter=None):
+        """Upload a script to the guest and run it.
+
+        The script is created executable by the upload itself, or run as
+        an argument of interpreter (e.g. '/bin/bash') when one is given, so
+        no chmod process is needed. When waiting for the output, the script
+        is removed together with the output files.
+        """
+        target, command = self._upload_script(vm, user, password, content,
+                                              target_file, interpreter)
+        delete = wait_for_completion and delete_script
         result = self.execute_program_in_guest(
             vm,
             user,
             password,
-            target,
+            command,
             wait_for_completion=wait_for_completion,
             wait_time=wait_time,
             get_output=get_output,
             rm_cmd=rm_cmd,
-            callback=callback)
-        if wait_for_completion and delete_script:
+            callback=callback,
+            stdout=stdout,
+            stderr=stderr,
+            chunk_size=chunk_size,
+            capture=capture,
+            follow=follow,
+            cleanup_files=[target] if delete and get_output else None)
+        if delete and not get_output:
             self.delete_file_in_guest(vm, user, password, target)
         return result
 
-    def list_vms(self):
-        vm_properties = [
-            "name", "config.uuid", "config", "config.hardware.numCPU",
-            "config.hardware.memoryMB", "guest.guestState",
-            "config.guestFullName", "config.guestId", "config.version"
+    def _upload_script(self, vm, user, password, content, target_file,
+                       interpreter):
+        """Upload a script, return its path and the command running it."""
+        target = target_file
+        if target is None:
+            target = '/tmp/%s.sh' % uuid.uuid1()
+        file_attribute = None
+        if interpreter is None:
+            file_attribute = vim.vm.guest.FileManager.PosixFileAttributes(
+                permissions=SCRIPT_PERMISSIONS)
+        self.upload_file_to_guest(vm, user, password, content, target,
+                                  file_attribute)
+        if interpreter is None:
+            return target, target
+        return target, '%s %s' % (interpreter, target)
+
+    @session_scoped
+    def list_vms(self, path_set=VM_PROPERTIES, page_size=PAGE_SIZE):
+        return list(self.iter_vms(path_set=path_set, page_size=page_size))
+
+    def iter_vms(self, path_set=VM_PROPERTIES, page_size=PAGE_SIZE):
+        """Yield the properties of all the VMs, retrieved page by page."""
+        content = self.get_content()
+        view = self._call_once(content.viewManager.CreateContainerView,
+                               content.rootFolder, [vim.VirtualMachine], True)
+        try:
+            for vm in self.iter_properties(
+                    view_ref=view,
+                    obj_type=vim.VirtualMachine,
+                    path_set=path_set,
+                    include_mors=True,
+                    page_size=page_size):
+                yield vm
+        finally:
+            self._call(view.DestroyView)
+
+    def find_vms(self, pattern):
+        regex = re.compile(pattern)
+        return [
+            vm['obj'] for vm in self.iter_vms(path_set=['name'])
+            if regex.search(vm['name'])
         ]
-        content = self.service_instance.RetrieveContent()
-        view = content.viewManager.CreateContainerView(
-            content.rootFolder, [vim.VirtualMachine], True)
-        vm_data = self.collect_properties(
-            view_ref=view,
-            obj_type=vim.VirtualMachine,
-            path_set=vm_properties,
-            include_mors=True)
-        return vm_data
 
-    # Shamelessly borrowed from:
-    # https://github.com/dnaeon/py-vconnector/blob/master/src/vconnector/core.py
     def collect_properties(self,
                            view_ref,
                            obj_type,
                            path_set=None,
                            include_mors=False):
-        collector = self.service_instance.content.propertyCollector
+        return list(
+            self.iter_properties(
+                view_ref,
+                obj_type,
+                path_set=path_set,
+                include_mors=include_mors))
 
+    # Shamelessly borrowed from:
+    # https://github.com/dnaeon/py-vconnector/blob/master/src/vconnector/core.py
+    def create_filter_spec(self, view_ref, obj_type, path_set=None):
         # Create object specification to define the starting point of
         # inventory navigation
         obj_spec = pyVmomi.vmodl.query.PropertyCollector.ObjectSpec()
@@ -271,12 +1443,22 @@ class VSphere(object):
         filter_spec = pyVmomi.vmodl.query.PropertyCollector.FilterSpec()
         filter_spec.objectSet = [obj_spec]
         filter_spec.propSet = [property_spec]
+        return filter_spec
 
-        # Retrieve properties
-        props = collector.RetrieveContents([filter_spec])
+    def iter_properties(self,
+                        view_ref,
+                        obj_type,
+                        path_set=None,
+                        include_mors=False,
+                        page_size=PAGE_SIZE):
+        """Yield the properties of the objects in view_ref.
 
-        data = []
-        for obj in props:
+        The objects are retrieved with RetrievePropertiesEx and
+        ContinueRetrievePropertiesEx in pages of up to page_size objects,
+        so memory use is bounded by the page size.
+        """
+        filter_spec = self.create_filter_spec(view_ref, obj_type, path_set)
+        for obj in self.retrieve_objects([filter_spec], page_size):
             properties = {}
             for prop in obj.propSet:
                 properties[prop.name] = prop.val
@@ -284,17 +1466,98 @@ class VSphere(object):
             if include_mors:
                 properties['obj'] = obj.obj
 
-            data.append(properties)
-        return data
+            yield properties
+
+    def retrieve_objects(self, filter_specs, page_size=PAGE_SIZE):
+        """Yield the ObjectContent matching filter_specs, page by page."""
+        collector = self.get_content().propertyCollector
+        options = pyVmomi.vmodl.query.PropertyCollector.RetrieveOptions()
+        options.maxObjects = page_size
+        with self._phase('properties'):
+            result = self._call(collector.RetrievePropertiesEx, filter_specs,
+                                options)
+        try:
+            while result is not None:
+                for obj in result.objects:
+                    yield obj
+                if result.token is None:
+                    break
+                with self._phase('properties'):
+                    result = self._call(
+                        collector.ContinueRetrievePropertiesEx, result.token)
+        finally:
+            if result is not None and result.token is not None:
+                self._call(collector.CancelRetrievePropertiesEx, result.token)
 
     def wait_until_tools_ready(self, vm, sleep=5, callback=None):
         while True:
             try:
                 status = vm.guest.toolsRunningStatus
-                callback('vm=%s, status=%s' % (vm, status))
-                if 'guestToolsRunning' == status:
+                if callback is not None:
+                    callback('vm=%s, status=%s' % (vm, status))
+                if TOOLS_RUNNING == status:
                     return
                 time.sleep(sleep)
             except Exception as e:
-                callback('vm=%s, exception' % vm, exception=e)
+                if callback is not None:
+                    callback('vm=%s, exception' % vm, exception=e)
                 time.sleep(sleep)
+
+    def iter_tools_ready(self, vms, timeout=None, callback=None):
+        """Yield each VM as soon as its VMware Tools are running.
+
+        All the VMs are watched with a single PropertyCollector filter on
+        guest.toolsRunningStatus and WaitForUpdatesEx, so a VM is yielded
+        the moment vCenter reports the change and guest operations can be
+        started on it while waiting for the others. Raises an exception
+        listing the VMs still pending when timeout seconds have elapsed.
+        """
+        pending = {}
+        for vm in vms:
+            pending[vm._moId] = vm
+        if len(pending) == 0:
+            return
+        property_spec = pyVmomi.vmodl.query.PropertyCollector.PropertySpec()
+        property_spec.type = vim.VirtualMachine
+        property_spec.pathSet = ['guest.toolsRunningStatus']
+        filter_spec = pyVmomi.vmodl.query.PropertyCollector.FilterSpec()
+        filter_spec.objectSet = [
+            pyVmomi.vmodl.query.PropertyCollector.ObjectSpec(obj=vm)
+            for vm in pending.values()
+        ]
+        filter_spec.propSet = [property_spec]
+        deadline = None if timeout is None else time.time() + timeout
+        collector = self._call_once(
+            self.get_content().propertyCollector.CreatePropertyCollector)
+        try:
+            self._call_once(
+                collector.CreateFilter, filter_spec, partialUpdates=False)
+            options = pyVmomi.vmodl.query.PropertyCollector.WaitOptions()
+            version = ''
+            while len(pending) > 0:
+                options.maxWaitSeconds = TOOLS_WAIT_SECONDS
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Exception(
+                            'timeout waiting for tools on vms: %s' %
+                            ', '.join(sorted(pending)))
+                    options.maxWaitSeconds = int(
+                        min(math.ceil(remaining), TOOLS_WAIT_SECONDS))
+                update_set = self._call(collector.WaitForUpdatesEx, version,
+                                        options)
+                if update_set is None:
+                    continue
+                version = update_set.version
+                for filter_update in update_set.filterSet:
+                    for object_update in filter_update.objectSet:
+                        moid = object_update.obj._moId
+                        for change in object_update.changeSet:
+                            if callback is not None:
+                                callback('vm=%s, status=%s' %
+                                         (moid, change.val))
+                            if change.val == TOOLS_RUNNING and \
+                                    moid in pending:
+                                yield pending.pop(moid)
+        finally:
+            self._call(collector.Destroy)